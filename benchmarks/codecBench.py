@@ -0,0 +1,116 @@
+# Throughput benchmark of railfi.codec against the original bytes-concatenating packet implementation
+# (the original has no conversation IDs, so its packets are 4 bytes shorter)
+# Usage: python benchmarks/codecBench.py [numPackets] [chunkSize]
+
+import os, sys, time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from railfi import codec
+
+
+## Original implementation (before the shared codec) ##
+def legacyGenPacket(packetType, payload):
+    binary = b'RF-'
+    if isinstance(packetType, str):
+        if packetType in codec.packetTypes: packetType = codec.packetTypes.index(packetType)
+        else: raise ValueError('Invalid packet type "{}"'.format(packetType))
+    binary += int.to_bytes(packetType, 1, 'big')
+    if len(payload) >= 2 ** 16: raise ValueError('Payload too long')
+    binary += int.to_bytes(len(payload), 2, 'big')
+    binary += payload
+    return binary
+
+# Receives on every call like the controller version, the loco version stalls when a header arrives without its payload
+class legacyReceiver():
+    def __init__(self, conn):
+        self.conn = conn
+        self.inBuffer = b''
+
+    def recv(self, numPackets, maxLoops=10):
+        try: self.inBuffer += self.conn.recv(4096)
+        except OSError: pass
+        packets = []
+        for i in range(maxLoops):
+            if len(self.inBuffer) < 6:
+                try: self.inBuffer += self.conn.recv(4096)
+                except OSError: pass
+
+            if len(self.inBuffer) >= 6:
+                prefix = self.inBuffer[0:3]
+                if prefix != b'RF-':
+                    self.inBuffer = self.inBuffer[1:]
+
+                packetType = int.from_bytes(self.inBuffer[3:4], 'big')
+                payloadSize = int.from_bytes(self.inBuffer[4:6], 'big')
+                if len(self.inBuffer) < payloadSize + 6:
+                    break
+
+                payload = self.inBuffer[6:payloadSize + 6]
+                self.inBuffer = self.inBuffer[payloadSize + 6:]
+                packets.append((packetType, payload))
+                if len(packets) >= numPackets: break
+        return packets
+
+
+# Plays back a byte stream in fixed size chunks, like a TCP socket would deliver it
+class chunkedSocket():
+    def __init__(self, data, chunkSize):
+        self.data = memoryview(data)
+        self.position = 0
+        self.chunkSize = chunkSize
+
+    def recv(self, size):
+        size = min(size, self.chunkSize)
+        chunk = bytes(self.data[self.position:self.position + size])
+        self.position += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self.chunkSize, len(self.data) - self.position)
+        buffer[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+def timeIt(function):
+    startTime = time.perf_counter()
+    function()
+    return time.perf_counter() - startTime
+
+def benchEncode(numPackets):
+    payload = b'\x32'
+    def legacy():
+        for i in range(numPackets): legacyGenPacket('SET_THROTTLE', payload)
+    def shared():
+        encoder = codec.encoder()
+        for i in range(numPackets): encoder.encode('SET_THROTTLE', payload, i)
+    return timeIt(legacy), timeIt(shared)
+
+def benchDecode(numPackets, chunkSize):
+    legacyStream = b''.join(legacyGenPacket(i % 4, bytes(i % 3)) for i in range(numPackets))
+    encoder = codec.encoder()
+    stream = b''.join(bytes(encoder.encode(i % 4, bytes(i % 3), i)) for i in range(numPackets))
+    def legacy():
+        receiver = legacyReceiver(chunkedSocket(legacyStream, chunkSize))
+        received = 0
+        while received < numPackets: received += len(receiver.recv(1))
+    def shared():
+        conn = chunkedSocket(stream, chunkSize)
+        decoder = codec.decoder()
+        received = 0
+        while received < numPackets:
+            for packet in decoder.packets(): received += 1
+            if received < numPackets: decoder.recvFrom(conn)
+    return timeIt(legacy), timeIt(shared)
+
+def main():
+    numPackets = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    chunkSize = int(sys.argv[2]) if len(sys.argv) > 2 else 1460
+
+    print('{} packets, {} byte receive chunks'.format(numPackets, chunkSize))
+    for name, (legacyTime, sharedTime) in (('encode', benchEncode(numPackets)), ('decode', benchDecode(numPackets, chunkSize))):
+        print('{}: legacy {:.0f} packets/s, codec {:.0f} packets/s ({:.1f}x)'.format(
+            name, numPackets / legacyTime, numPackets / sharedTime, legacyTime / sharedTime))
+
+if __name__ == '__main__':
+    main()
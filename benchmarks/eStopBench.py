@@ -0,0 +1,144 @@
+# Time from pressing "stop everything" on the controller until every loco's throttle is 0, with the fleet busy
+# For each fleet size the locos are set moving, a stream of SET_STATE commands is kept in flight on every loco, then
+# controller.stopAll() is called. Emulated locos (railfi.emulator) note when their throttle reached 0, on the same
+# monotonic clock as the controller (they run on the same machine).
+# Usage: python benchmarks/eStopBench.py [--sizes 1,10,100] [--broadcast 255.255.255.255] [--trials 3] [--json]
+
+import argparse, asyncio, contextlib, io, json, multiprocessing, os, sys, time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from railfi import codec, emulator
+from railfi.controller import controller
+
+
+def percentile(values, fraction):
+    if not len(values): return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+## Emulator processes ##
+def runEmulators(port, count, firstNumber, latency, udpEStop, results):
+    # Reports once connected, then reports the time each loco stopped when the controller hangs up
+    async def run():
+        setupTimes = []
+        locos = []
+        fleet = asyncio.get_running_loop().create_task(emulator.runFleet('127.0.0.1', port, count, firstNumber, latency, setupTimes=setupTimes, udpEStop=udpEStop, locos=locos))
+        while not len(setupTimes) and not fleet.done(): await asyncio.sleep(0.01)
+        results.put(len(setupTimes))
+        await fleet
+        results.put({loco.name: loco.stopTime for loco in locos})
+
+    try: asyncio.run(run())
+    except Exception as error:
+        results.put(repr(error))
+
+
+## Load ##
+async def keepBusy(loco, depth):
+    # Keep <depth> SET_STATE commands in flight until cancelled, so the E_STOP has a queue to jump
+    async def worker(offset):
+        i = offset
+        while True:
+            try: await loco.request('SET_STATE', codec.encodeState({'throttle': 1 + i % 100}))
+            except (RuntimeError, ConnectionError, TimeoutError): pass
+            i += 1
+    await asyncio.gather(*[worker(offset) for offset in range(depth)])
+
+async def trial(args, size, context):
+    railfi = controller(port=args.port, broadcastAddr=args.broadcast)
+    port = await railfi.start()
+    loop = asyncio.get_running_loop()
+
+    results = context.Queue()
+    processes = []
+    firstNumber = 0
+    numProcesses = min(args.processes, size)
+    for i in range(numProcesses):
+        count = size // numProcesses + (1 if i < size % numProcesses else 0)
+        processes.append(context.Process(target=runEmulators, args=(port, count, firstNumber, args.latency, args.broadcast is not None, results), daemon=True))
+        firstNumber += count
+    for process in processes: process.start()
+    for process in processes:
+        result = await loop.run_in_executor(None, results.get)
+        if isinstance(result, str): raise RuntimeError('Emulator process failed: ' + result)
+    while len(railfi.fleet) < size: await asyncio.sleep(0.01)
+
+    # Get everything moving and busy
+    await asyncio.gather(*[loco.request('SET_STATE', codec.encodeState({'throttle': 50})) for loco in railfi.fleet])
+    load = [loop.create_task(keepBusy(loco, args.depth)) for loco in railfi.fleet]
+    await asyncio.sleep(args.loadTime)
+
+    pressTime = time.perf_counter()
+    acknowledged = await railfi.stopAll()
+    for task in load: task.cancel()
+    await asyncio.gather(*load, return_exceptions=True)
+
+    await railfi.stop()
+    stopTimes = {}
+    for process in processes:
+        result = await loop.run_in_executor(None, results.get)
+        if isinstance(result, str): raise RuntimeError('Emulator process failed: ' + result)
+        stopTimes.update(result)
+    for process in processes: await loop.run_in_executor(None, process.join)
+
+    stopped = [stopTime - pressTime for stopTime in stopTimes.values() if stopTime is not None]
+    acks = [value for value in acknowledged.values() if not isinstance(value, Exception)]
+    return {
+        'stopped': len(stopped),
+        'notStopped': len(stopTimes) - len(stopped),
+        'stopMs': [value * 1000 for value in stopped],
+        'ackMs': [value * 1000 for value in acks],
+        'ackFailures': len(acknowledged) - len(acks)
+    }
+
+async def benchFleet(args, size, context):
+    stopMs = []
+    ackMs = []
+    notStopped = ackFailures = 0
+    for i in range(args.trials):
+        result = await trial(args, size, context)
+        stopMs += result['stopMs']
+        ackMs += result['ackMs']
+        notStopped += result['notStopped']
+        ackFailures += result['ackFailures']
+    return {
+        'locos': size,
+        'trials': args.trials,
+        'broadcast': args.broadcast,
+        'notStopped': notStopped,
+        'ackFailures': ackFailures,
+        'stopMs': {'p50': percentile(stopMs, 0.5), 'p95': percentile(stopMs, 0.95), 'max': max(stopMs) if len(stopMs) else None},
+        'ackMs': {'p50': percentile(ackMs, 0.5), 'max': max(ackMs) if len(ackMs) else None}
+    }
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(description='Measure fleet-wide emergency stop time')
+    parser.add_argument('--sizes', default='1,10,50,100', help='comma separated fleet sizes to test')
+    parser.add_argument('--processes', type=int, default=1, help='processes to spread the emulated locos over')
+    parser.add_argument('--trials', type=int, default=3, help='stops per fleet size, each with a fresh fleet')
+    parser.add_argument('--depth', type=int, default=4, help='SET_STATE commands kept in flight per loco while stopping')
+    parser.add_argument('--load-time', dest='loadTime', type=float, default=0.5, help='seconds of load before stopping')
+    parser.add_argument('--latency', type=float, default=0, help='seconds each emulated loco takes to handle a packet')
+    parser.add_argument('--broadcast', metavar='ADDR', help='also broadcast E_STOP over UDP to this address')
+    parser.add_argument('--port', type=int, default=4650, help='first traffic port to try')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    return parser.parse_args()
+
+def main():
+    args = getArgs()
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        # The controller prints every connection, which would drown out the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = asyncio.run(benchFleet(args, size, context))
+        results.append(result)
+        if not args.json:
+            print('{:>5} locos: every throttle at 0 within {:.2f} ms (p50 {:.2f} ms, p95 {:.2f} ms), slowest ACKNOWLEDGE {:.2f} ms, {} not stopped, {} failed'.format(
+                size, result['stopMs']['max'] or 0, result['stopMs']['p50'], result['stopMs']['p95'], result['ackMs']['max'] or 0, result['notStopped'], result['ackFailures']))
+    if args.json: print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# Load test of the headless controller against fleets of emulated locos (railfi.emulator)
+# For each fleet size: how long the locos take to connect, then how many commands per second the controller gets
+# through and their round trip times while every loco is kept busy.
+# Usage: python benchmarks/fleetLoad.py [--sizes 10,100,500] [--processes 4] [--latency 0.002 --jitter 0.001] [--json]
+
+import argparse, asyncio, contextlib, io, json, multiprocessing, os, sys, time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from railfi import codec, emulator
+from railfi.controller import controller
+
+
+def percentile(values, fraction):
+    if not len(values): return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def summarize(values):
+    # Seconds in, milliseconds out
+    return {
+        'p50': percentile(values, 0.5) * 1000,
+        'p95': percentile(values, 0.95) * 1000,
+        'p99': percentile(values, 0.99) * 1000,
+        'max': max(values) * 1000 if len(values) else 0
+    }
+
+
+## Emulator processes ##
+def runEmulators(port, count, firstNumber, latency, jitter, results):
+    # Runs in its own process, reports handshake times once connected and exits when the controller hangs up
+    async def run():
+        setupTimes = []
+        fleet = asyncio.get_running_loop().create_task(emulator.runFleet('127.0.0.1', port, count, firstNumber, latency, jitter, setupTimes=setupTimes))
+        while not len(setupTimes) and not fleet.done(): await asyncio.sleep(0.01)
+        results.put(setupTimes)
+        await fleet
+
+    try: asyncio.run(run())
+    except Exception as error:
+        results.put(repr(error))
+
+
+## Load ##
+async def drive(loco, endTime, depth, rtts):
+    # Keep <depth> commands in flight on one loco until endTime, alternating SET_STATE and GET_STATE
+    loop = asyncio.get_running_loop()
+    async def worker(offset):
+        i = offset
+        while loop.time() < endTime:
+            if i % 2: packetType, payload = 'GET_STATE', b''
+            else: packetType, payload = 'SET_STATE', codec.encodeState({'throttle': i % 101})
+            startTime = time.perf_counter()
+            await loco.request(packetType, payload)
+            rtts.append(time.perf_counter() - startTime)
+            i += 1
+    await asyncio.gather(*[worker(offset) for offset in range(depth)])
+
+async def benchFleet(args, size, context):
+    railfi = controller(port=args.port)
+    port = await railfi.start()
+    loop = asyncio.get_running_loop()
+
+    # Split the fleet as evenly as possible over the processes
+    results = context.Queue()
+    processes = []
+    firstNumber = 0
+    numProcesses = min(args.processes, size)
+    for i in range(numProcesses):
+        count = size // numProcesses + (1 if i < size % numProcesses else 0)
+        processes.append(context.Process(target=runEmulators, args=(port, count, firstNumber, args.latency, args.jitter, results), daemon=True))
+        firstNumber += count
+
+    startTime = time.perf_counter()
+    for process in processes: process.start()
+    setupTimes = []
+    for process in processes:
+        result = await loop.run_in_executor(None, results.get)
+        if isinstance(result, str): raise RuntimeError('Emulator process failed: ' + result)
+        setupTimes.extend(result)
+    while len(railfi.fleet) < size: await asyncio.sleep(0.01)
+    connectTime = time.perf_counter() - startTime
+
+    rtts = []
+    endTime = loop.time() + args.duration
+    loadStartTime = time.perf_counter()
+    await asyncio.gather(*[drive(loco, endTime, args.depth, rtts) for loco in railfi.fleet])
+    loadTime = time.perf_counter() - loadStartTime
+
+    await railfi.stop()
+    for process in processes: await loop.run_in_executor(None, process.join)
+
+    return {
+        'locos': size,
+        'processes': numProcesses,
+        'fleetConnectSeconds': connectTime,
+        'handshakeMs': summarize(setupTimes),
+        'commands': len(rtts),
+        'commandsPerSecond': len(rtts) / loadTime,
+        'rttMs': summarize(rtts)
+    }
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(description='Load test the RailFi controller with emulated locos')
+    parser.add_argument('--sizes', default='1,10,50,100,250', help='comma separated fleet sizes to test')
+    parser.add_argument('--processes', type=int, default=1, help='processes to spread the emulated locos over')
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds of load per fleet size')
+    parser.add_argument('--depth', type=int, default=1, help='commands kept in flight per loco')
+    parser.add_argument('--latency', type=float, default=0, help='seconds each emulated loco waits before handling a packet')
+    parser.add_argument('--jitter', type=float, default=0, help='up to this many random seconds added on top of latency')
+    parser.add_argument('--port', type=int, default=4600, help='first traffic port to try')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    return parser.parse_args()
+
+def main():
+    args = getArgs()
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        # The controller prints every connection, which would drown out the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = asyncio.run(benchFleet(args, size, context))
+        results.append(result)
+        if not args.json:
+            print('{:>5} locos: connected in {:.2f} s (handshake p50 {:.1f} ms, max {:.1f} ms), {:.0f} commands/s, RTT p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+                size, result['fleetConnectSeconds'], result['handshakeMs']['p50'], result['handshakeMs']['max'],
+                result['commandsPerSecond'], result['rttMs']['p50'], result['rttMs']['p95'], result['rttMs']['p99'], result['rttMs']['max']))
+    if args.json: print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
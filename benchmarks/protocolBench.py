@@ -0,0 +1,252 @@
+# Micro and macro benchmarks of the wire protocol: packet encoding, decoding of fragmented, coalesced and corrupt
+# streams, loco firmware dispatch and end-to-end round trips between an emulated loco and the headless controller.
+# Results are written in pytest-benchmark's JSON layout so runs from different commits can be compared, either with
+# --compare here or with pytest-benchmark's own tools.
+# Usage: python benchmarks/protocolBench.py [--filter decode] [--output results.json] [--compare old.json]
+
+import argparse, asyncio, contextlib, datetime, json, os, platform, statistics, subprocess, sys, time
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(repoPath)
+from railfi import codec, emulator, integrity
+from railfi.controller import controller
+
+
+# Plays back a byte stream in fixed size chunks, like a TCP socket would deliver it
+class chunkedSocket():
+    def __init__(self, data, chunkSize):
+        self.data = memoryview(data)
+        self.position = 0
+        self.chunkSize = chunkSize
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self.chunkSize, len(self.data) - self.position)
+        buffer[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+# Swallows whatever the firmware sends or prints
+class nullSink():
+    def sendall(self, data):
+        pass
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def makeStream(numPackets, noise=b'', frameCheck=integrity.NONE):
+    # A mix of the command packets a controller sends, optionally with <noise> in front of every packet
+    encoder = codec.encoder()
+    encoder.setFrameCheck(frameCheck)
+    commands = [('SET_THROTTLE', b'\x32'), ('GET_STATE', b''), ('SET_LIGHT', b'\x00\x01'), ('SET_STATE', b'\x07\x32\x00\x01')]
+    packets = []
+    for i in range(numPackets):
+        packetType, payload = commands[i % len(commands)]
+        packets.append(noise + bytes(encoder.encode(packetType, payload, i * 2)))
+    return b''.join(packets)
+
+
+## Benchmarks ##
+# Each benchmark takes the run's arguments and returns a list of per-operation times in seconds, one per round
+benchmarks = []
+
+def benchmark(group):
+    def register(function):
+        benchmarks.append((group, function.__name__, function))
+        return function
+    return register
+
+def timeRounds(args, operation, numOps):
+    # Calls operation() once per round, which must perform <numOps> operations
+    times = []
+    for i in range(args.rounds):
+        startTime = time.perf_counter()
+        operation()
+        times.append((time.perf_counter() - startTime) / numOps)
+    return times
+
+@benchmark('encode')
+def encodeThrottle(args):
+    encoder = codec.encoder()
+    def operation():
+        for i in range(args.packets): encoder.encode('SET_THROTTLE', b'\x32', i)
+    return timeRounds(args, operation, args.packets)
+
+@benchmark('encode')
+def encodeState(args):
+    encoder = codec.encoder()
+    def operation():
+        for i in range(args.packets): encoder.encode('SET_STATE', codec.encodeState({'throttle': 50, 'direction': 0, 'lights': 1}), i)
+    return timeRounds(args, operation, args.packets)
+
+def decodeStream(args, stream, chunkSize, frameCheck=integrity.NONE):
+    def operation():
+        conn = chunkedSocket(stream, chunkSize)
+        decoder = codec.decoder()
+        decoder.setFrameCheck(frameCheck)
+        received = 0
+        while received < args.packets:
+            for packet in decoder.packets(): received += 1
+            if received < args.packets: decoder.recvFrom(conn)
+    return timeRounds(args, operation, args.packets)
+
+@benchmark('decode')
+def decodeFragmented(args):
+    # Every packet arrives in several pieces
+    return decodeStream(args, makeStream(args.packets), 3)
+
+@benchmark('decode')
+def decodeCoalesced(args):
+    # Many packets arrive in each receive
+    return decodeStream(args, makeStream(args.packets), 4096)
+
+@benchmark('decode')
+def decodeCorrupt(args):
+    # Line noise in front of every packet, including partial prefixes the decoder has to skip over
+    return decodeStream(args, makeStream(args.packets, b'\x00R\xffRF\x01\x02\x03'), 1460)
+
+@benchmark('decode')
+def decodeNoiseBurst(args):
+    # A long burst of line noise in front of every packet
+    return decodeStream(args, makeStream(args.packets, bytes(range(32, 232))), 1460)
+
+@benchmark('decode')
+def decodeCrc16(args):
+    return decodeStream(args, makeStream(args.packets, frameCheck=integrity.CRC16), 4096, integrity.CRC16)
+
+@benchmark('decode')
+def decodeCrc32(args):
+    return decodeStream(args, makeStream(args.packets, frameCheck=integrity.CRC32), 4096, integrity.CRC32)
+
+@benchmark('dispatch')
+def locoDispatch(args):
+    # The firmware's processPacket() in emulator mode, responses are sent to a null socket
+    firmware = emulator.loadFirmware()
+    firmware.controllerSocket = nullSink()
+
+    decoder = codec.decoder()
+    decoder.feed(makeStream(args.packets))
+    packets = [(packetType, conversation, bytes(payload)) for packetType, conversation, payload in decoder.packets()]
+    def operation():
+        for packet in packets: firmware.processPacket(*packet)
+    with contextlib.redirect_stdout(nullSink()):
+        return timeRounds(args, operation, len(packets))
+
+def roundTrips(args, packetType, payload, datagrams=False):
+    # Sequential round trips between the headless controller and an emulated loco over loopback, as datagrams if asked
+    async def run():
+        railfi = controller(port=args.port)
+        port = await railfi.start()
+        loco = emulator.emulatedLoco(emulator.makeConfig(0))
+        await loco.connect('127.0.0.1', port)
+        locoTask = asyncio.get_running_loop().create_task(loco.run())
+        while not len(railfi.fleet): await asyncio.sleep(0.001)
+        session = next(iter(railfi.fleet))
+        if datagrams and not await session.openDatagram(): raise RuntimeError('Emulated loco refused the datagram transport')
+
+        times = []
+        for i in range(args.rounds):
+            startTime = time.perf_counter()
+            for j in range(args.roundTrips):
+                if datagrams: await session.writeDatagrams([(packetType, payload)])
+                else: await session.request(packetType, payload)
+            times.append((time.perf_counter() - startTime) / args.roundTrips)
+
+        await railfi.stop()
+        await locoTask
+        loco.close()
+        return times
+
+    with contextlib.redirect_stdout(nullSink()):
+        return asyncio.run(run())
+
+@benchmark('roundTrip')
+def roundTripSetState(args):
+    return roundTrips(args, 'SET_STATE', codec.encodeState({'throttle': 50, 'direction': 0, 'lights': 1}))
+
+@benchmark('roundTrip')
+def roundTripDatagramSetState(args):
+    return roundTrips(args, 'SET_STATE', codec.encodeState({'throttle': 50, 'direction': 0, 'lights': 1}), True)
+
+@benchmark('roundTrip')
+def roundTripGetState(args):
+    return roundTrips(args, 'GET_STATE', b'')
+
+
+## Results ##
+def stats(times):
+    return {
+        'min': min(times),
+        'max': max(times),
+        'mean': statistics.mean(times),
+        'stddev': statistics.stdev(times) if len(times) > 1 else 0,
+        'median': statistics.median(times),
+        'rounds': len(times),
+        'ops': 1 / statistics.mean(times)
+    }
+
+def commitInfo():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repoPath, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repoPath, stderr=subprocess.DEVNULL) != b''
+        return {'id': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+
+def compare(results, oldPath, threshold):
+    # Prints the change in median time of every benchmark in both runs, returns the names of those that got slower
+    with open(oldPath, 'r') as oldFile:
+        oldResults = {bench['fullname']: bench for bench in json.load(oldFile)['benchmarks']}
+    regressions = []
+    for bench in results['benchmarks']:
+        if bench['fullname'] not in oldResults: continue
+        change = bench['stats']['median'] / oldResults[bench['fullname']]['stats']['median'] - 1
+        if change > threshold: regressions.append(bench['fullname'])
+        print('{:<30} {:+7.1%}{}'.format(bench['fullname'], change, '  REGRESSION' if change > threshold else ''), file=sys.stderr)
+    return regressions
+
+def getArgs():
+    parser = argparse.ArgumentParser(description='Benchmark the RailFi wire protocol and dispatch')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose group/name contains this')
+    parser.add_argument('--rounds', type=int, default=20, help='rounds per benchmark')
+    parser.add_argument('--packets', type=int, default=2000, help='packets per round for encode, decode and dispatch')
+    parser.add_argument('--round-trips', dest='roundTrips', type=int, default=100, help='round trips per round for end-to-end benchmarks')
+    parser.add_argument('--port', type=int, default=4700, help='first traffic port to try for end-to-end benchmarks')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown of the median counted as a regression, 0.1 is 10%%')
+    return parser.parse_args()
+
+def main():
+    args = getArgs()
+    results = {
+        'machine_info': {
+            'node': platform.node(),
+            'machine': platform.machine(),
+            'python_implementation': platform.python_implementation(),
+            'python_version': platform.python_version()
+        },
+        'commit_info': commitInfo(),
+        'datetime': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'benchmarks': []
+    }
+
+    for group, name, function in benchmarks:
+        fullname = group + '/' + name
+        if args.filter not in fullname: continue
+        print('Running {}'.format(fullname), file=sys.stderr)
+        benchStats = stats(function(args))
+        results['benchmarks'].append({'group': group, 'name': name, 'fullname': fullname, 'stats': benchStats})
+        print('  median {:.2f} us, {:.0f} ops/s'.format(benchStats['median'] * 1000000, benchStats['ops']), file=sys.stderr)
+
+    if args.output is None: print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as outputFile: json.dump(results, outputFile, indent=2)
+
+    if args.compare is not None and len(compare(results, args.compare, args.threshold)): sys.exit(1)
+
+if __name__ == '__main__':
+    main()
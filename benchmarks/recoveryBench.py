@@ -0,0 +1,178 @@
+# Time from power-on until a loco takes commands, and from a dropped connection until it is back in its session
+# Runs locomotive/main.py in emulator mode in a temporary directory, with controller credentials in its config like a
+# loco that has been through discovery before. Boot-to-ready is timed from starting the firmware process until the
+# controller has the loco (so it includes starting Python), and as the firmware reports it. Drop-to-recovered aborts
+# the loco's connection from the controller's side and times until the loco has resumed its session.
+# With --discovery the first boot goes through discovery instead, with this script acting as the controller's
+# discovery client, and the boots after it use the credentials the loco saved.
+# Usage: python benchmarks/recoveryBench.py [--boots 3] [--drops 20] [--discovery] [--json]
+
+import argparse, asyncio, contextlib, io, json, os, sys, tempfile, time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from railfi.controller import controller
+
+firmwarePath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'locomotive', 'main.py')
+identity = [
+    'road-name : RailFi',
+    'road-acronym : RF',
+    'loco-number : 0000',
+    'loco-model : benchmark',
+    'password : 12345678',
+    'model-manufacturer : RailFi'
+]
+
+
+def percentile(values, fraction):
+    if not len(values): return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+## Firmware process ##
+class firmware():
+    def __init__(self, directory):
+        self.directory = directory
+        self.process = None
+        self.lines = []     # Everything the firmware printed
+        self.readTask = None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(sys.executable, '-u', firmwarePath, cwd=self.directory, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        self.readTask = asyncio.get_running_loop().create_task(self.read())
+
+    async def read(self):
+        while True:
+            line = await self.process.stdout.readline()
+            if not line: break
+            self.lines.append(line.decode('utf-8', 'replace').rstrip())
+
+    def reported(self, prefix):
+        # ms values from lines like "Ready 12 ms after boot"
+        return [float(line.split()[line.split().index('ms') - 1]) for line in self.lines if line.startswith(prefix)]
+
+    async def stop(self):
+        self.process.terminate()
+        await self.process.wait()
+        await self.readTask
+
+async def discover(port):
+    # Discovery from the controller's side: first contact, password, then the controller's network and address. The
+    # loco reads each field with a single recv(), so they are sent apart.
+    for i in range(200):
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', 2000)
+            break
+        except OSError: await asyncio.sleep(0.01)
+    else: raise ConnectionError('Loco never entered discovery mode')
+    for field in [b'\xff\xff', b'12345678', b'benchmark', b'benchmark', b'127.0.0.1', port.to_bytes(2, 'big')]:
+        writer.write(field)
+        await writer.drain()
+        if field in (b'\xff\xff', b'12345678'):
+            if await reader.readexactly(2) != b'\xff\xff': raise ConnectionError('Loco refused discovery')
+        else: await asyncio.sleep(0.05)
+    await reader.readexactly(2)
+    writer.close()
+
+
+## Trials ##
+async def waitFor(condition, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline: raise TimeoutError('Timed out')
+        await asyncio.sleep(0.001)
+
+async def bench(args):
+    railfi = controller(port=args.port, subscribe={'throttle': 0})
+    port = await railfi.start()
+    connected = []
+    railfi.addListener(lambda event, loco: connected.append((time.perf_counter(), loco)) if event == 'connected' else None)
+
+    with tempfile.TemporaryDirectory() as directory:
+        configPath = os.path.join(directory, 'config.txt')
+        lines = list(identity)
+        if not args.discovery: lines += ['controller-ssid : benchmark', 'controller-ssid-password : benchmark', 'controller-addr : 127.0.0.1', 'controller-traffic-port : {}'.format(port)]
+        with open(configPath, 'w') as configFile: configFile.write('\n'.join(lines))
+
+        bootMs = []
+        reportedBootMs = []
+        discoveryBootMs = None
+        dropMs = []
+        reportedDropMs = []
+        resumed = 0
+        bootPhases = {}     # {phase: [ms]} as reported in the loco's stats
+        for boot in range(args.boots):
+            loco = firmware(directory)
+            startTime = time.perf_counter()
+            numConnected = len(connected)
+            await loco.start()
+            try:
+                if args.discovery and boot == 0: await discover(port)
+                await waitFor(lambda: len(connected) > numConnected)
+                elapsed = (connected[-1][0] - startTime) * 1000
+                if args.discovery and boot == 0: discoveryBootMs = elapsed
+                else: bootMs.append(elapsed)
+                session = connected[-1][1]
+                await waitFor(lambda: len(loco.reported('Ready')))
+                for phase, ms in (await asyncio.wrap_future(session.getStats()))['bootPhases'].items(): bootPhases.setdefault(phase, []).append(ms)
+
+                # Only the last boot's session gets the drops, the others measure booting alone
+                for drop in range(args.drops if boot == args.boots - 1 else 0):
+                    numConnected = len(connected)
+                    await asyncio.wrap_future(session.setState(throttle=20))
+                    dropTime = time.perf_counter()
+                    session.writer.transport.abort()
+                    await waitFor(lambda: len(connected) > numConnected)
+                    dropMs.append((connected[-1][0] - dropTime) * 1000)
+                    if connected[-1][1] is session: resumed += 1
+                    session = connected[-1][1]
+                    await waitFor(lambda: len(loco.reported('Session resumed')) + len(loco.reported('New session')) > drop)
+            finally: await loco.stop()
+            reportedBootMs += loco.reported('Ready')
+            reportedDropMs += loco.reported('Session resumed') + loco.reported('New session')
+            await waitFor(lambda: not len(railfi.fleet))
+
+        with open(configPath) as configFile: saved = 'controller-traffic-port : {}'.format(port) in configFile.read()
+
+    await railfi.stop()
+    return {
+        'boots': len(bootMs),
+        'bootMs': {'p50': percentile(bootMs, 0.5), 'max': max(bootMs) if len(bootMs) else None},
+        'reportedBootMs': {'p50': percentile(reportedBootMs, 0.5), 'max': max(reportedBootMs) if len(reportedBootMs) else None},
+        'bootPhaseMs': {phase: percentile(values, 0.5) for phase, values in bootPhases.items()},
+        'discoveryBootMs': discoveryBootMs,
+        'credentialsSaved': saved,
+        'drops': len(dropMs),
+        'resumed': resumed,
+        'dropMs': {'p50': percentile(dropMs, 0.5), 'p95': percentile(dropMs, 0.95), 'max': max(dropMs) if len(dropMs) else None},
+        'reportedDropMs': {'p50': percentile(reportedDropMs, 0.5), 'max': max(reportedDropMs) if len(reportedDropMs) else None}
+    }
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(description='Measure loco boot-to-ready and drop-to-recovered times')
+    parser.add_argument('--boots', type=int, default=3, help='times to start the firmware')
+    parser.add_argument('--drops', type=int, default=20, help='connection drops during the last boot')
+    parser.add_argument('--discovery', action='store_true', help='go through discovery on the first boot')
+    parser.add_argument('--port', type=int, default=4700, help='first traffic port to try')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    return parser.parse_args()
+
+def main():
+    args = getArgs()
+    # The controller prints every connection, which would drown out the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = asyncio.run(bench(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    if result['discoveryBootMs'] is not None:
+        print('First boot through discovery: ready after {:.1f} ms, credentials {}saved'.format(result['discoveryBootMs'], '' if result['credentialsSaved'] else 'NOT '))
+    print('Boot to ready: p50 {:.1f} ms, max {:.1f} ms over {} boots (firmware reports p50 {:.1f} ms after it started running)'.format(
+        result['bootMs']['p50'], result['bootMs']['max'] or 0, result['boots'], result['reportedBootMs']['p50']))
+    print('Boot phases (p50): ' + ', '.join(['{} {} ms'.format(phase, ms) for phase, ms in result['bootPhaseMs'].items()]))
+    print('Drop to recovered: p50 {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms over {} drops, {} resumed their session (firmware reports p50 {:.1f} ms)'.format(
+        result['dropMs']['p50'], result['dropMs']['p95'], result['dropMs']['max'] or 0, result['drops'], result['resumed'], result['reportedDropMs']['p50']))
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,11 @@
 import sys, time
 
 print('RailFi locomotive firmware booting')
+# Boot-to-ready timing starts here, on the same clock as reactor.ticksMs(). On a real loco ticks start at reset, so
+# this is also how long loading the firmware took.
+bootTicks = time.ticks_ms() if hasattr(time, 'ticks_ms') else time.monotonic_ns() // 1000000
+# Loaded precompiled by the fast boot main.py (setup.sh --fast) rather than run as main.py
+fastBoot = __name__ != '__main__'
 
 # Bootstrap RailFi to run on a locomotive (uPython device) or on a PC (CPython on Linux or Windows)
 
@@ -21,32 +26,38 @@ configRequiredEntries = [
     'model-manufacturer'
 ]
 config = {}
-throttle = 0
 
 DEBUG = 0
 INFO = 1
 ERROR = 2
-reportThres = DEBUG
+reportThres = INFO  # Per-packet detail goes to the trace ring (locoTrace) rather than the serial port
 
 def setReportThres(thres):
     global reportThres
     reportThres = thres
 
 def report(level, msg, *args, **kwargs):
-    if level >= reportThres:
-        print(msg, *args, **kwargs)
+    # msg is only formatted with args if the report is printed, so pass values as args rather than formatting them
+    # first, e.g. report(DEBUG, 'Throttle: {}', value)
+    if level < reportThres: return
+    if len(args): msg = msg.format(*args)
+    print(msg, **kwargs)
 
 
 ## Emulation handling ##
 bootMode = 'real' if sys.implementation.name == 'micropython' else 'emulator' if sys.implementation.name == 'cpython' else 'unknown'
 
 if bootMode == 'real':
-    time.sleep_ms(1000)
     report(INFO, 'Boot mode: real')
 
     from machine import Pin, PWM, freq
 
+    # Holding the boot button within a second of reset drops to the REPL. Fast boot doesn't wait, stop it with Ctrl-C
+    # over USB instead.
     bootPin = Pin(0, Pin.IN)
+    for i in range(0 if fastBoot else 100):
+        if bootPin.value() == 0: break
+        time.sleep_ms(10)
     if bootPin.value() == 0:
         print('Booting to REPL')
         sys.exit()
@@ -54,6 +65,8 @@ if bootMode == 'real':
     import network
     import usocket as socket
     import gc
+    import os
+    from ubinascii import hexlify, unhexlify
     
     freq(240000000)
     gc.collect()
@@ -76,23 +89,19 @@ if bootMode == 'real':
 
     motorDirPin = Pin(10, Pin.OUT, Pin.PULL_DOWN, value=0)
     motorSpeedPWM = PWM(Pin(27, Pin.OUT, Pin.PULL_DOWN, value=0), duty=0, freq=500)
-    throttle = 0
 
-    def setThrottle(value):
-        global throttle; throttle = value
-        motorDir = value >= 0
-        motorSpeed = round(value * 10.23)
+    def setMotor(speed):
+        # speed is in thousandths of a throttle step, negative in reverse. Called by the motion engine (see railfi/motion.py).
+        motorDir = speed >= 0
+        duty = locoMotion.duty(speed if motorDir else -speed)
 
-        report(DEBUG, 'Throttle setting: {} PWM duty: {}'.format(value, motorSpeed))
+        if reportThres <= DEBUG: report(DEBUG, 'Motor speed: {} PWM duty: {}', speed, duty)
 
         motorDirPin.value(int(motorDir))    # When direction switch is set, use int(motorDir != motorFlip)
         if motorDir:
-            motorSpeedPWM.duty(1023 - motorSpeed)
+            motorSpeedPWM.duty(1023 - duty)
         else:
-            motorSpeedPWM.duty(motorSpeed)
-
-    def getThrottle():
-        return throttle
+            motorSpeedPWM.duty(duty)
     
     ap = None   # DO NOT reference outside of platform abstraction functions!!!
     
@@ -111,18 +120,43 @@ if bootMode == 'real':
         gc.collect()
 
     sta = None  # DO NOT reference outside of platform abstraction functions!!!
-    
+    staFailed = [getattr(network, name) for name in ('STAT_WRONG_PASSWORD', 'STAT_NO_AP_FOUND', 'STAT_CONNECT_FAIL') if hasattr(network, name)]
+
+    def waitSTA(timeout):
+        # Returns as soon as the station connects or gives up rather than after a fixed wait
+        deadline = time.ticks_add(time.ticks_ms(), int(timeout * 1000))
+        while not sta.isconnected():
+            if sta.status() in staFailed or time.ticks_diff(deadline, time.ticks_ms()) <= 0: return False
+            time.sleep_ms(5)
+        return True
+
     def startSTA(ssid, password):
         global sta
+        if sta is not None and sta.isconnected(): return    # Reconnecting to the controller, the network is still up
         sta = network.WLAN(network.STA_IF)
         sta.active(True)
-        sta.scan()
-        sta.connect(ssid, password)
-        for i in range(10):
-            if sta.isconnected():
-                break
-            report(INFO, 'Waiting for STA to connect...')
-            time.sleep(0.5)
+
+        # Join the access point used last time directly, scanning every channel for it takes a couple of seconds
+        if 'controller-bssid' in config.keys():
+            try: sta.config(channel=int(config['controller-channel']))
+            except (KeyError, ValueError, OSError): pass
+            sta.connect(ssid, password, bssid=unhexlify(config['controller-bssid']))
+            if waitSTA(5.0):
+                report(DEBUG, sta.ifconfig())
+                return
+            report(INFO, 'Access point moved, scanning for "{}"', ssid)
+            sta.disconnect()
+
+        # Find the strongest access point for ssid and remember it for next time
+        found = [result for result in sta.scan() if result[0] == ssid.encode('utf-8')]   # (ssid, bssid, channel, RSSI, ...)
+        if len(found):
+            best = max(found, key=lambda result: result[3])
+            sta.connect(ssid, password, bssid=best[1])
+        else: sta.connect(ssid, password)
+        if waitSTA(10.0) and len(found):
+            config['controller-bssid'] = hexlify(best[1]).decode()
+            config['controller-channel'] = str(best[2])
+            saveConfig()
         report(DEBUG, sta.ifconfig())
 
     def stopSTA():
@@ -133,10 +167,15 @@ if bootMode == 'real':
 elif bootMode == 'emulator':
     report(INFO, 'Boot mode: emulator')
 
-    import socket
+    import os, socket
 
     sleep = time.sleep
 
+    # Shared modules live one directory up when running from the repository. Plugins live next to config.txt, like
+    # they do on a real loco. railfi.emulator loads the firmware once for every loco, the paths are only added once.
+    for path in (os.path.dirname(os.path.dirname(os.path.abspath(__file__))), os.getcwd()):
+        if path not in sys.path: sys.path.append(path)
+
     # Virtual hardware connections
     lights = [0, 0]
 
@@ -149,25 +188,22 @@ elif bootMode == 'emulator':
     def getLight(light):
         return lights[light]
 
-    throttle = 0
+    motor = 0
 
-    def setThrottle(value):
-        global throttle
-        throttle = value
-
-    def getThrottle():
-        return throttle
+    def setMotor(speed):
+        global motor
+        motor = speed
 
 
     def startAP(apName):
-        report(INFO, 'Pretending to start access point "{}"'.format(apName))
+        report(INFO, 'Pretending to start access point "{}"', apName)
         return '<wifi>', '<ip address>'
 
     def stopAP():
         report(INFO, 'Pretending to stop access point')
 
     def startSTA(ssid, password):
-        report(INFO, 'Pretending to start station and connect to {}'.format(ssid))
+        report(INFO, 'Pretending to start station and connect to {}', ssid)
 
     def stopSTA():
         report(INFO, 'Pretending to stop station')
@@ -175,15 +211,19 @@ elif bootMode == 'emulator':
 
     # Hardware display
     def displayHardware():
-        print('Lights: {} {} | Motor: {}% | Error: {}'.format('H' if lights[0] else ' ', 'R' if lights[1] else ' ', throttle, errorCodes[currentError]))
+        if reportThres > INFO: return
+        print('Lights: {} {} | Motor: {}% | Error: {}'.format('H' if lights[0] else ' ', 'R' if lights[1] else ' ', motor / 1000, errorCodes[currentError]))
 
 else:
     raise RuntimeError('Implementation "{}" not recognized'.format(sys.implementation.name))
 
+hardwareTicks = time.ticks_ms() if hasattr(time, 'ticks_ms') else time.monotonic_ns() // 1000000
+from railfi import capture, codec, datagram, heartbeat, integrity, motion, reactor, sequences, stats, subscriptions, trace
+try: import errno
+except ImportError: import uerrno as errno
 
-# Get current time in seconds
-def now():
-    return time.time_ns() / 1000000000
+locoTrace = trace.traceRing()   # Sent to the controller on GET_TRACE and saved to traceback.log on a crash
+locoTrace.record(trace.BOOT)
 
 
 ## Error handling ##
@@ -200,7 +240,11 @@ def raiseError(code):
         codeNum = errorCodes.index(code)
 
     currentError = codeNum
-    report(ERROR, 'ERROR {}: {}'.format(codeNum, codeName))
+    report(ERROR, 'ERROR {}: {}', codeNum, codeName)
+    locoTrace.record(trace.ERROR, codeNum)
+    # A subscribed controller hears about the error before the loco stops answering
+    try: pushState()
+    except OSError: pass
 
     setLight(0, 0)
     setLight(1, 0)
@@ -225,12 +269,16 @@ def raiseError(code):
 ## Config loading ##
 def getConfig(configPath='config.txt'):
     global config
-    # Open the config file
+    # Open the config file, or the copy saveConfig() was writing if the loco lost power before it replaced the config
     try:
         with open(configPath, 'r') as configFile:
             configText = configFile.read()
     except:
-        raiseError('NO_CONFIG_FILE')
+        try:
+            with open(configPath + '.tmp', 'r') as configFile:
+                configText = configFile.read()
+        except:
+            raiseError('NO_CONFIG_FILE')
 
     # Read the config data
     try:
@@ -248,8 +296,31 @@ def getConfig(configPath='config.txt'):
             raiseError('CONFIG_MISSING_ENTRY')
 
 
+def saveConfig(configPath='config.txt'):
+    # Written to a copy that then replaces the config, so losing power part way never leaves a broken config
+    tempPath = configPath + '.tmp'
+    with open(tempPath, 'w') as configFile:
+        configFile.write('\n'.join([key + ' : ' + config[key] for key in config.keys()]))
+    try: os.rename(tempPath, configPath)
+    except OSError:
+        # Some filesystems won't rename over an existing file. getConfig() falls back to the copy until it is renamed.
+        os.remove(configPath)
+        os.rename(tempPath, configPath)
+
+def saveCredentials(ssid, password, addr, trafficPort):
+    # Keep what discovery found, so the next boot connects straight away
+    config['controller-ssid'] = ssid
+    config['controller-ssid-password'] = password
+    config['controller-addr'] = addr
+    config['controller-traffic-port'] = str(trafficPort)
+    saveConfig()
+    report(INFO, 'Controller credentials saved to config')
+
+
 ## Controller connection ##
 controllerSocket = None
+controllerAddr = None   # Where datagrams are sent once the controller opens the datagram transport
+eStopPort = None    # UDP port E_STOP broadcasts arrive on, the same number as the controller's traffic port
 
 def discoverController():
     report(INFO, '===== Entering discovery mode =====')
@@ -257,10 +328,12 @@ def discoverController():
     apName = 'RailFi_Discover_' + config['road-acronym'] + '_' + config['loco-number']
     port = 2000
     ssid, locoIP = startAP(apName)
-    report(INFO, 'AP Info:\nSSID: {}\nLoco IP: {}\nLoco Handshake Port: {}'.format(ssid, locoIP, port))
+    report(INFO, 'AP Info:\nSSID: {}\nLoco IP: {}\nLoco Handshake Port: {}', ssid, locoIP, port)
 
     # Serve a socket for controllers to connect to
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # A discovery that just finished leaves the port in TIME_WAIT, which would stop a quick reboot from serving it
+    if hasattr(socket, 'SO_REUSEADDR'): sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind(('', port))
     sock.listen(5)
     report(INFO, 'Socket bound')
@@ -319,11 +392,16 @@ def discoverController():
         return (ssid, password, addr, port)
 
 def connectController(ssid, password, addr, trafficPort):  # Establish a connection to the controller and globalize the socket, return bool of success
-    global controllerSocket
+    global controllerSocket, controllerAddr, eStopPort
+    controllerAddr = addr
+    eStopPort = trafficPort
 
-    report(INFO, '===== Connecting to controller "{}" on access point "{}" ====='.format(addr, ssid))
+    report(INFO, '===== Connecting to controller "{}" on access point "{}" =====', addr, ssid)
     startSTA(ssid, password)
+    bootPhase(stats.WIFI)
     trafficSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # The handshake and ANNOUNCE are small writes back to back, which Nagle's algorithm would hold up for a delayed ACK
+    if hasattr(socket, 'TCP_NODELAY'): trafficSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     trafficSocket.settimeout(1.0)
     for i in range(5):
@@ -334,6 +412,7 @@ def connectController(ssid, password, addr, trafficPort):  # Establish a connect
             report(INFO, 'Connection timed out')
             if i == 4:
                 report(INFO, 'Connection timed out too many times')
+                bootPhase(stats.CONTROLLER)
                 return False
     report(INFO, 'Connected to traffic cop')
 
@@ -341,157 +420,794 @@ def connectController(ssid, password, addr, trafficPort):  # Establish a connect
         trafficSocket.send(b'\xde\xad\xbe\xef')
         trafficSocket.close()
         report(INFO, 'First contact incorrect')
+        bootPhase(stats.CONTROLLER)
         return False
-    trafficSocket.sendall(b'\x00\x00')
+    trafficSocket.sendall(b'\x00\x01')     # 0x0001 rather than 0x0000: able to keep the session on this connection
     report(INFO, 'Completed first contact')
 
     dedicatedPort = int.from_bytes(trafficSocket.recv(2), 'big')
     trafficSocket.sendall(b'\x00\x00')
-    report(INFO, 'Directed to port {}'.format(dedicatedPort))
+    if dedicatedPort == 0:
+        controllerSocket = trafficSocket
+        controllerSocket.settimeout(0.1)
+        bootPhase(stats.CONTROLLER)
+        locoTrace.record(trace.CONNECT, 1)
+        report(INFO, 'Connected to controller')
+        return True
+    report(INFO, 'Directed to port {}', dedicatedPort)
 
     trafficSocket.close()
     report(INFO, 'Disconnected from traffic cop')
 
-    controllerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    report(INFO, 'Pausing to let controller initialize dedicated socket')
-    sleep(0.5)
-    controllerSocket.connect((addr, dedicatedPort))
+    # The controller may still be opening the dedicated port, retry rather than wait a fixed time
+    for i in range(50):
+        controllerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            controllerSocket.connect((addr, dedicatedPort))
+            break
+        except OSError:
+            controllerSocket.close()
+            if i == 49:
+                report(INFO, 'Unable to connect to dedicated port')
+                bootPhase(stats.CONTROLLER)
+                return False
+            sleep(0.01)
     controllerSocket.settimeout(0.1)
+    bootPhase(stats.CONTROLLER)
+    locoTrace.record(trace.CONNECT, 0)
     report(INFO, 'Connected to controller')
     return True
     
 
 ## Main section ##
-packetTypes = [
-    'SET_THROTTLE',
-    'GET_THROTTLE',
-    'SET_LIGHT',
-    'GET_LIGHT',
-    'E_STOP',
-    'ACKNOWLEDGE',
-    'ERROR'
-]
-
-inBuffer = b''
-
-def genPacket(packetType, payload):
-    report(DEBUG, 'Generating packet')        
-    binary = b'RF-'
-    
-    # Get packet type as int
-    if isinstance(packetType, str):
-        if packetType in packetTypes: packetType = packetTypes.index(packetType)
-        else: raise ValueError('Invalid packet type "{}"'.format(packetType))
-    elif isinstance(packetType, int): pass
-    else: raise ValueError('Invalid packet type "{}"'.format(packetType))
-
-    binary += int.to_bytes(packetType, 1, 'big')
-    if len(payload) >= 2 ** 16: raise ValueError('Payload too long')
-    binary += int.to_bytes(len(payload), 2, 'big')
-    binary += payload
-
-    report(DEBUG, 'Packet generation results:', binary)
-    return binary
-
-def send(packetType, payload):
-    report(DEBUG, 'Sending packet')
-    controllerSocket.sendall(genPacket(packetType, payload))
-
-def recv(numPackets, maxLoops=10):
-    global inBuffer; conn = controllerSocket
-    report(DEBUG, 'Receiving packets')
-    # try: inBuffer += conn.recv(4096)
-    # except OSError: pass
-    packets = []
-    for i in range(maxLoops):
-        # print('inBuffer:', inBuffer)
-        if len(inBuffer) < 6:
-            # print('Attempting to receive more data')
-            try: inBuffer += conn.recv(4096)
-            except OSError: pass
-
-        if len(inBuffer) >= 6:
-            report(DEBUG, 'Decoding packet from buffer')
-            prefix = inBuffer[0:3]
-            if prefix != b'RF-':
-                # print('Found data that is not a packet, discarding first byte in buffer')
-                inBuffer = inBuffer[1:]
-
-            packetType = int.from_bytes(inBuffer[3:4], 'big')
-            payloadSize = int.from_bytes(inBuffer[4:6], 'big')
-            
-            if len(inBuffer) < payloadSize + 6:
-                report(DEBUG, 'Packet incomplete, waiting to receive more data in buffer')
-                break
+packetTypes = codec.packetTypes
+
+packetEncoder = codec.encoder()
+# The largest payload the controller sends is an uploaded sequence, well inside the receive buffer. A header claiming
+# more than its packet type's limit is corrupt, and is skipped rather than waited on.
+packetDecoder = codec.decoder(4096, codec.maxControllerPayload, codec.controllerPayloads)
+conversations = codec.conversations(isLoco=True)    # Conversations started by the loco
+locoStats = stats.locoStats(len(packetTypes), packetDecoder)    # Sent to the controller on GET_STATS
+
+# Each boot phase is timed from the end of the one before, and sent with the stats
+bootMark = hardwareTicks    # reactor.ticksMs() at the end of the last phase, None once booted
+
+def bootPhase(phase):
+    global bootMark
+    if bootMark is None: return
+    currentTime = reactor.ticksMs()
+    locoStats.bootPhase(phase, reactor.ticksDiff(currentTime, bootMark))
+    bootMark = currentTime
+
+if bootMode == 'real': locoStats.bootPhase(stats.LOAD, bootTicks)
+locoStats.bootPhase(stats.HARDWARE, reactor.ticksDiff(hardwareTicks, bootTicks))
+bootPhase(stats.MODULES)
+
+def genPacket(packetType, payload, conversation):
+    # The returned packet is only valid until the next call to genPacket()
+    return packetEncoder.encode(packetType, payload, conversation)
+
+# "capture : capture.bin" in the config records everything sent to and received from the controller in that file,
+# for replaying with python -m railfi.replay. Writing to flash on every packet slows the loco down, so it is off
+# unless asked for.
+locoCapture = None
+captureStream = None            # Traffic connection
+datagramCaptureStream = None
+
+def startCapture(path):
+    global locoCapture, captureStream, datagramCaptureStream
+    locoCapture = capture.openRecorder(path, 'loco')
+    captureStream = locoCapture.stream('controller')
+    datagramCaptureStream = locoCapture.stream('datagram')
+    eventLoop.callEvery(1.0, locoCapture.flush)
+    report(INFO, 'Capturing traffic to {}', path)
+
+def send(packetType, payload, conversation):
+    # Responses carry the conversation ID of the packet they respond to, and go back the way the packet came
+    packet = genPacket(packetType, payload, conversation)
+    locoStats.bytesOut += len(packet)
+    locoTrace.record(trace.SEND, packet[3], len(packet), conversation)
+    if locoCapture is not None: locoCapture.record(capture.OUT, datagramCaptureStream if replyByDatagram else captureStream, packet)
+    if replyByDatagram and datagramSocket is not None:
+        # Once the controller's datagram port is gone the socket is refused, the controller falls back to TCP
+        try: datagramSocket.send(datagramChannel.wrap(packet))
+        except OSError: closeDatagram()
+    else: controllerSocket.sendall(packet)
+
+# Shared with any other periodic firmware work, use eventLoop.callEvery()/callLater() rather than sleeping.
+# railfi.emulator runs the firmware on its own loop, which it sets as hostLoop before loading the firmware.
+eventLoop = globals().get('hostLoop') or reactor.reactor()
+
+## Motion ##
+# Momentum, see railfi/motion.py. The acceleration, braking and speed curve come from the config.
+def motionStepped():
+    # The speed changes with every ramp step, not just when a packet is handled
+    pushState()
+
+locoMotion = motion.motion(eventLoop, setMotor, motionStepped)
+
+def setThrottle(value):
+    # -100 to 100, negative in reverse. The motor starts moving towards it right away.
+    locoMotion.setThrottle(value)
+
+def getThrottle():
+    return locoMotion.throttle
+
+def getSpeed():
+    return locoMotion.getSpeed()
+
+def stopMotor():
+    # Stops at once, whatever the braking rate
+    locoMotion.stop()
+
+direction = 0   # 0 forward, 1 reverse, kept separately from the throttle so it survives stopping
+
+# The state is handled as values in codec.stateFields order (see codec.encodeStateInto()) in buffers allocated here,
+# so reading and changing it doesn't allocate
+throttleField = codec.stateFields.index('throttle')
+directionField = codec.stateFields.index('direction')
+lightsField = codec.stateFields.index('lights')
+errorField = codec.stateFields.index('error')
+speedField = codec.stateFields.index('speed')
+stateValues = bytearray(len(codec.stateFields))     # Filled by readState()
+requestedState = bytearray(len(codec.stateFields))  # Decoded from SET_STATE
+stateResponse = bytearray(1 + len(codec.stateFields))
+
+def readState():
+    lightMask = 0
+    for i in range(len(lights)):
+        if getLight(i): lightMask |= 1 << i
+    stateValues[throttleField] = abs(getThrottle())
+    stateValues[directionField] = direction
+    stateValues[lightsField] = lightMask
+    stateValues[errorField] = currentError
+    stateValues[speedField] = getSpeed()
+    return stateValues
+
+def applyState(values, fieldMask):
+    # Only the fields in fieldMask are changed
+    global direction
+    if fieldMask & (1 << directionField): direction = 1 if values[directionField] else 0
+    if fieldMask & ((1 << throttleField) | (1 << directionField)):
+        value = min(values[throttleField] if fieldMask & (1 << throttleField) else abs(getThrottle()), 100)
+        setThrottle(-value if direction else value)
+    if fieldMask & (1 << lightsField):
+        for i in range(len(lights)):
+            setLight(i, (values[lightsField] >> i) & 1)
+
+## Packet handlers ##
+# handlers[packetType](conversation, payload) returns the payload of the ACKNOWLEDGE to respond with, or None to not
+# respond. Add packet types with registerHandler(), from a plugin if they don't belong in the firmware itself.
+handlers = [None] * 256
+packetReceiveTime = None    # stats.ticksUs() at which the data of the packet being handled was received
+unknownTypeError = bytes([codec.UNKNOWN_PACKET_TYPE])
+handlerFailedError = bytes([codec.HANDLER_FAILED])
+preemptedError = bytes([codec.PREEMPTED])
+byteResponse = bytearray(1)     # Response of the handlers answering with a single byte
+lastPacketType = 0xff           # Type of the last packet handled, for the alloc-debug trace records
+lastPacketTicks = 0             # reactor.ticksMs() when it was handled
+
+def registerHandler(packetType, handler):
+    handlers[codec.packetTypeNum(packetType)] = handler
+
+def actuated(packetType, b=0, c=0):
+    # Handlers call this right after changing the hardware
+    locoStats.actuated(packetReceiveTime)
+    locoTrace.record(trace.ACTUATE, packetType, b, c)
+
+def handleSetThrottle(conversation, payload):
+    global direction
+    value = payload[0]
+    if value >= 128: value -= 256
+    if value: direction = int(value < 0)
+    setThrottle(value)
+    actuated(codec.SET_THROTTLE, 0, value + 128)
+    return b''
+
+def handleGetThrottle(conversation, payload):
+    byteResponse[0] = getThrottle() & 0xff
+    return byteResponse
+
+def handleSetLight(conversation, payload):
+    setLight(payload[0], payload[1])
+    actuated(codec.SET_LIGHT, payload[0], payload[1])
+    return b''
+
+def handleGetLight(conversation, payload):
+    byteResponse[0] = getLight(payload[0])
+    return byteResponse
+
+def emergencyStop():
+    locoSequencer.stop()
+    stopMotor()
+    actuated(codec.E_STOP)
+    # Datagrams sent before the stop may still be on their way, the controller opens a new channel afterwards
+    closeDatagram()
+
+def handleEStop(conversation, payload):
+    # Anything after the controller's E_STOP on the connection was sent after the stop, so the latch can go
+    global eStopLatched, lastStopId
+    emergencyStop()
+    eStopLatched = False
+    if len(payload) >= 4: lastStopId = int.from_bytes(payload[0:4], 'big')
+    return b''
+
+def handleSetState(conversation, payload):
+    applyState(requestedState, codec.decodeStateInto(payload, requestedState))
+    actuated(codec.SET_STATE, getThrottle() + 128, payload[0])
+    return respondState()
+
+def handleGetState(conversation, payload):
+    return respondState()
+
+def handleSubscribe(conversation, payload):
+    # Answered with the current state, changes are pushed from then on
+    locoSubscriptions.subscribe(subscriptions.decodeSubscribe(payload))
+    return respondState()
+
+def respondState():
+    # The controller learns the whole state from the response, so none of it needs pushing
+    values = readState()
+    locoSubscriptions.learnt(values)
+    codec.encodeStateInto(stateResponse, values)
+    return stateResponse
+
+def handleGetStats(conversation, payload):
+    return locoStats.encode()
+
+def handleResetStats(conversation, payload):
+    locoStats.reset()
+    return b''
+
+def handleGetTrace(conversation, payload):
+    return locoTrace.encode()
+
+def handleOpenDatagram(conversation, payload):
+    # Payload is the controller's datagram port (0 to close the channel), answered with the loco's datagram port
+    port = (payload[0] << 8) | payload[1]
+    closeDatagram()
+    if port == 0: return b'\x00\x00'
+    return int.to_bytes(openDatagram(port), 2, 'big')
+
+def handleConclude(conversation, payload):
+    # Also handles responses to conversations the loco started, which must never be responded to
+    conversations.end(conversation)
+    return None
+
+def handleAcknowledge(conversation, payload):
+    if locoHeartbeat.response(conversation, stats.ticksUs()):
+        heartbeatAnswered()
+        return None
+    if conversation == announceConversation and len(payload) >= 4:
+        if len(payload) >= 5 and payload[4] in frameChecks: setFrameCheck(payload[4])
+        sessionStarted(int.from_bytes(payload[0:4], 'big'))
+    return handleConclude(conversation, payload)
+
+registerHandler(codec.SET_THROTTLE, handleSetThrottle)
+registerHandler(codec.GET_THROTTLE, handleGetThrottle)
+registerHandler(codec.SET_LIGHT, handleSetLight)
+registerHandler(codec.GET_LIGHT, handleGetLight)
+registerHandler(codec.E_STOP, handleEStop)
+registerHandler(codec.ACKNOWLEDGE, handleAcknowledge)
+registerHandler(codec.ERROR, handleConclude)
+registerHandler(codec.CONCLUDE, handleConclude)
+registerHandler(codec.SET_STATE, handleSetState)
+registerHandler(codec.GET_STATE, handleGetState)
+registerHandler(codec.GET_STATS, handleGetStats)
+registerHandler(codec.RESET_STATS, handleResetStats)
+registerHandler(codec.GET_TRACE, handleGetTrace)
+registerHandler(codec.OPEN_DATAGRAM, handleOpenDatagram)
+registerHandler(codec.SUBSCRIBE, handleSubscribe)
+
+def loadPlugins():
+    # Config entry "plugins : sound, extraLights" imports each module and calls its register(registerHandler)
+    if 'plugins' not in config.keys(): return
+    for name in config['plugins'].split(','):
+        name = name.strip()
+        if not len(name): continue
+        __import__(name).register(registerHandler)
+        report(INFO, 'Loaded plugin "{}"', name)
+
+def processPacket(packetType, conversation, payload, receiveTime=None):
+    # receiveTime is the stats.ticksUs() at which the packet's data was received, for the actuation latency histogram
+    global packetReceiveTime, lastPacketType, lastPacketTicks
+    startTime = stats.ticksUs()
+    packetReceiveTime = receiveTime
+    lastPacketType = packetType
+    lastPacketTicks = reactor.ticksMs()
+    locoTrace.record(trace.PACKET, packetType, len(payload), conversation)
+
+    handler = handlers[packetType]
+    if handler is None:
+        locoTrace.record(trace.UNHANDLED, packetType, 0, conversation)
+        if reportThres <= DEBUG: report(DEBUG, 'Unable to process packets of type {}', packetType)
+        send(codec.ERROR, unknownTypeError, conversation)
+        return False
 
-            payload = inBuffer[6:payloadSize + 6]
+    try: response = handler(conversation, payload)
+    except Exception as exception:
+        # A bad payload shouldn't take the loco down, tell the controller instead
+        locoTrace.record(trace.HANDLER_FAILED, packetType, 0, conversation)
+        report(ERROR, 'Handler for packet type {} failed: {}', packetType, repr(exception))
+        send(codec.ERROR, handlerFailedError, conversation)
+        return False
 
-            inBuffer = inBuffer[payloadSize + 6:]
-            report(DEBUG, 'Decoded packet:', (packetType, payload))
-            packets.append((packetType, payload))
+    if response is not None: send(codec.ACKNOWLEDGE, response, conversation)
+    locoStats.processed(packetType, startTime)
+    return True
 
-            if len(packets) >= numPackets: break
+def controllerReadable(sock):
+    receiveTime = stats.ticksUs()
+    try: numBytes = packetDecoder.recvFrom(sock)
+    except OSError as error:
+        # A reset connection stays readable, so it has to be treated as closed rather than tried again
+        if error.args[0] not in droppedErrors: return
+        numBytes = 0
+    locoStats.bytesIn += numBytes
+    locoTrace.record(trace.RECV, 0, numBytes)
+    if locoCapture is not None and numBytes: locoCapture.record(capture.IN, captureStream, packetDecoder.view[packetDecoder.end - numBytes:packetDecoder.end])
+
+    if not numBytes:
+        controllerDropped(sock)
+        return
+    handleBuffered(sock, receiveTime)
+
+def handleBuffered(sock, receiveTime):
+    global packetReceiveTime, partialTimer
+    # An E_STOP jumps the queue: the motor stops before anything buffered ahead of it is handled, and commands ahead
+    # of it that would set the motor running again are refused rather than carried out. An E_STOP with nothing ahead
+    # of it is handled next anyway, and stops the motor then.
+    preempted = packetDecoder.find(codec.E_STOP)
+    if preempted > 0:
+        packetReceiveTime = receiveTime
+        emergencyStop()
+
+    # Handle every complete packet that arrived, not just the first one
+    resyncs = packetDecoder.resyncs
+    rejected = packetDecoder.rejected
+    handled = False
+    try:
+        while True:
+            packetType = packetDecoder.decode()
+            if packetType < 0: break
+            handled = True
+            conversation = packetDecoder.conversation
+            payload = packetDecoder.payload
+            refuse = eStopLatched
+            if preempted > 0:
+                preempted -= 1
+                refuse = True
+            if refuse and packetType in codec.preemptibleTypes:
+                locoTrace.record(trace.PREEMPTED, packetType, 0, conversation)
+                send(codec.ERROR, preemptedError, conversation)
+                continue
+            processPacket(packetType, conversation, payload, receiveTime)
+    except OSError as error:
+        # The controller reset the connection while the loco was answering it
+        if error.args[0] not in droppedErrors: raise
+        controllerDropped(sock)
+        return
+    if packetDecoder.resyncs != resyncs: locoTrace.record(trace.RESYNC, 0, packetDecoder.resyncs - resyncs, packetDecoder.discarded)
+    if packetDecoder.rejected != rejected: locoTrace.record(trace.REJECTED, 0, packetDecoder.rejected - rejected, packetDecoder.rejected)
+
+    # A packet whose rest doesn't arrive in codec.partialTimeout most likely had a corrupt header, which is dropped so
+    # it doesn't hold up the packets behind it. The wait starts over whenever a packet is handled.
+    if not packetDecoder.waiting:
+        if partialTimer is not None: eventLoop.cancel(partialTimer)
+    elif partialTimer is None: partialTimer = eventLoop.callLater(codec.partialTimeout / 1000, partialExpired)
+    elif handled or not partialTimer.active: eventLoop.rescheduleMs(partialTimer, codec.partialTimeout)
+    pushState()
+    locoStats.sampleMemory()
+
+partialTimer = None     # Made once and rescheduled from then on
+
+def partialExpired():
+    packetDecoder.dropPartial()
+    handleBuffered(controllerSocket, stats.ticksUs())
+
+def controllerDropped(sock):
+    # main() returns and run() reconnects
+    locoTrace.record(trace.DISCONNECT)
+    report(INFO, 'Controller connection dropped')
+    eventLoop.unregister(sock)
+    eventLoop.stop()
+
+## State push ##
+# Fields the controller subscribed to are pushed with STATE_CHANGED when they change, call pushState() after changing
+# the state from anywhere but a packet handler (those are covered already)
+locoSubscriptions = subscriptions.subscriptions()
+pushTimer = None    # Pushes changes held back by their minimum interval, made once and rescheduled from then on
+pushBuffer = bytearray(1 + len(codec.stateFields))
+pushPayloads = codec.viewCache(memoryview(pushBuffer))
+
+def pushState():
+    global pushTimer
+    if not locoSubscriptions.numActive: return
+    currentTime = reactor.ticksMs()
+    values = readState()
+    changed = locoSubscriptions.changes(values, currentTime)
+    if changed:
+        size = codec.encodeStateInto(pushBuffer, values, changed)
+        try: send(codec.STATE_CHANGED, pushPayloads.get(size), conversations.oneShot())
+        except OSError: return      # The connection dropped, controllerReadable() notices and everything is pushed again after reconnecting
+        locoSubscriptions.pushed(values, changed, currentTime)
+    if locoSubscriptions.wait is None:
+        if pushTimer is not None: eventLoop.cancel(pushTimer)
+    elif pushTimer is None: pushTimer = eventLoop.callLater(locoSubscriptions.wait / 1000, pushState)
+    else: eventLoop.rescheduleMs(pushTimer, locoSubscriptions.wait)
+
+# A broadcast E_STOP usually overtakes commands the controller sent before it, which must not start the motor again.
+# Until the controller's E_STOP arrives on the connection (or eStopLatchTime passes), those commands are refused.
+# A broadcast carrying the stop ID of an E_STOP already received on the connection arrived late and is ignored.
+eStopLatched = False
+eStopLatchTime = 2.0
+eStopLatchTimer = None
+lastStopId = None
+
+def releaseEStopLatch():
+    global eStopLatched
+    eStopLatched = False
+
+def eStopReadable(sock):
+    # Redundant E_STOP path, controllers may also broadcast it as a UDP datagram. Nothing is sent back.
+    global packetReceiveTime, eStopLatched, eStopLatchTimer
+    packetReceiveTime = stats.ticksUs()
+    try: packet = sock.recv(codec.headerSize + 4)
+    except OSError: return
+    if len(packet) >= codec.headerSize and packet[0:3] == b'RF-' and packet[3] == codec.E_STOP:
+        stopId = int.from_bytes(packet[codec.headerSize:codec.headerSize + 4], 'big') if len(packet) == codec.headerSize + 4 else None
+        if stopId is not None and stopId == lastStopId: return
+        locoTrace.record(trace.PACKET, codec.E_STOP, 0xffff, 0 if stopId is None else stopId)
+        emergencyStop()
+        eStopLatched = True
+        if eStopLatchTimer is not None: eventLoop.cancel(eStopLatchTimer)
+        eStopLatchTimer = eventLoop.callLater(eStopLatchTime, releaseEStopLatch)
+        pushState()
+
+## Datagram transport ##
+# SET_THROTTLE/SET_STATE may also arrive as datagrams once the controller opens the channel, which keeps a congested
+# connection from delivering throttle changes late and in bursts. Stale datagrams are dropped on arrival.
+datagramSocket = None
+datagramChannel = datagram.channel()
+replyByDatagram = False     # Set while handling a datagram, so send() answers with one
+# Port the loco receives datagrams on, "datagram-port : off" in the config keeps the loco on TCP alone. Emulated
+# locos take any free port so several can run on one PC.
+datagramPort = 2001 if bootMode == 'real' else 0
+
+def openDatagram(controllerPort):
+    # Returns the port the loco receives datagrams on
+    global datagramSocket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', datagramPort))
+    port = sock.getsockname()[1] if hasattr(sock, 'getsockname') else datagramPort
+    sock.connect((controllerAddr, controllerPort))  # Only the controller's datagrams are received
+    datagramSocket = sock
+    datagramChannel.reset()
+    eventLoop.register(sock, datagramReadable)
+    report(INFO, 'Datagram transport open on port {}', port)
+    return port
+
+def closeDatagram():
+    global datagramSocket
+    if datagramSocket is None: return
+    eventLoop.unregister(datagramSocket)
+    datagramSocket.close()
+    datagramSocket = None
+
+def datagramReadable(sock):
+    global replyByDatagram
+    receiveTime = stats.ticksUs()
+    stale = datagramChannel.stale
+    try: packetType = datagramChannel.receive(sock)
+    except OSError: return
+    if packetType < 0:
+        if datagramChannel.stale != stale: locoTrace.record(trace.STALE, 0, (datagramChannel.receiveBuffer[0] << 8) | datagramChannel.receiveBuffer[1], datagramChannel.lastSequence)
+        return
+    conversation = datagramChannel.conversation
+    payload = datagramChannel.payload
+    locoStats.bytesIn += datagram.sequenceSize + codec.headerSize + len(payload) + datagramChannel.checkSize
+    if locoCapture is not None: locoCapture.record(capture.IN, datagramCaptureStream, datagramChannel.receiveView[datagram.sequenceSize:datagram.sequenceSize + codec.headerSize + len(payload) + datagramChannel.checkSize])
 
-        # else:
-        #     print('Not enough data in buffer')
-    
-    return packets
+    replyByDatagram = True
+    try:
+        if packetType not in datagram.datagramTypes:
+            # Only writes where the newest value is all that matters may come by datagram, anything else could be
+            # dropped as stale without the controller knowing
+            locoTrace.record(trace.UNHANDLED, packetType, 0, conversation)
+            if packetType not in codec.responseTypes: send(codec.ERROR, unknownTypeError, conversation)
+        elif eStopLatched and packetType in codec.preemptibleTypes:
+            locoTrace.record(trace.PREEMPTED, packetType, 0, conversation)
+            send(codec.ERROR, preemptedError, conversation)
+        else: processPacket(packetType, conversation, payload, receiveTime)
+    except OSError:
+        # The channel closed while handling the datagram and the reply went to TCP, whose failure controllerReadable()
+        # notices on its next read
+        closeDatagram()
+    finally: replyByDatagram = False
+    pushState()
+
+eStopSocket = None
+
+def startEStopListener(port):
+    global eStopSocket
+    if eStopSocket is not None: return      # Still listening from before a reconnect
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Several emulated locos on one PC all need to hear the broadcast
+        if hasattr(socket, 'SO_REUSEADDR'): sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('0.0.0.0', port))
+    except OSError as error:
+        report(INFO, 'Unable to listen for E_STOP broadcasts on port {}: {}', port, repr(error))
+        return
+    eStopSocket = sock
+    eventLoop.register(sock, eStopReadable)
+    report(INFO, 'Listening for E_STOP broadcasts on port {}', port)
+
+## Sequences ##
+# Timed actions uploaded by the controller and run by the loco itself, see railfi/sequences.py. A sequence uploaded
+# with the SAVE flag is kept in sequence<number>.bin next to config.txt and loaded again at boot. Commands from the
+# controller still apply while a sequence runs, an E_STOP or a dropped connection stops it.
+def sequenceAction(action, a, b):
+    global direction
+    if action == sequences.THROTTLE:
+        value = a - 256 if a >= 128 else a
+        if value: direction = int(value < 0)
+        setThrottle(value)
+    elif action == sequences.DIRECTION:
+        direction = 1 if a else 0
+        setThrottle(-abs(getThrottle()) if direction else abs(getThrottle()))
+    elif action == sequences.LIGHT: setLight(a, b)
+    locoTrace.record(trace.STEP, locoSequencer.running, locoSequencer.step - 1, (action << 16) | (a << 8) | b)
+    pushState()
+
+def sequenceFinished(number):
+    locoTrace.record(trace.STEP, number, 0xffff)
+
+locoSequencer = sequences.sequencer(eventLoop, sequenceAction, sequenceFinished)
+
+sequenceDir = ''    # Prefix of the saved sequences' paths, railfi.emulator gives each emulated loco a directory of its own
+
+def sequencePath(number):
+    return sequenceDir + 'sequence{}.bin'.format(number)
+
+def loadSequences():
+    for fileName in os.listdir(sequenceDir) if sequenceDir else os.listdir():
+        if not (fileName.startswith('sequence') and fileName.endswith('.bin')): continue
+        try:
+            with open(sequenceDir + fileName, 'rb') as sequenceFile: locoSequencer.store(int(fileName[8:-4]), sequenceFile.read(), True)
+        except ValueError as error: report(ERROR, 'Unable to load {}: {}', fileName, repr(error))
+
+def handleUploadSequence(conversation, payload):
+    # <number (1B)> <flags (1B)> then the steps, no steps deletes the sequence
+    number = payload[0]
+    save = bool(payload[1] & sequences.SAVE) and len(payload) > 2
+    steps = bytes(payload[2:])
+    locoSequencer.store(number, steps, save)
+    if save:
+        with open(sequencePath(number), 'wb') as sequenceFile: sequenceFile.write(steps)
+    else:
+        try: os.remove(sequencePath(number))
+        except OSError: pass
+    return b''
+
+def handleRunSequence(conversation, payload):
+    # <number (1B)> [<repeats (1B)>, 0 until stopped]
+    locoSequencer.start(payload[0], payload[1] if len(payload) > 1 else 1)
+    return b''
+
+def handleStopSequence(conversation, payload):
+    locoSequencer.stop()
+    return b''
+
+def handleGetSequences(conversation, payload):
+    return locoSequencer.status()
+
+registerHandler(codec.UPLOAD_SEQUENCE, handleUploadSequence)
+registerHandler(codec.RUN_SEQUENCE, handleRunSequence)
+registerHandler(codec.STOP_SEQUENCE, handleStopSequence)
+registerHandler(codec.GET_SEQUENCES, handleGetSequences)
+
+## Heap ##
+# Garbage is collected while the loco is idle, so collections rarely land in the middle of handling a command. With
+# "alloc-debug : on" in the config, the heap allocated by every pass of the event loop is counted and sent with the
+# stats, which should show nothing allocated at all outside of the odd GET_STATS or connection change. Real locos only,
+# CPython doesn't report its heap.
+idleCollectInterval = 1.0
+idleTime = 50       # ms since the last packet before the loco counts as idle
+idleCollectTimer = None
+collectedAlloc = 0  # Heap in use after the last collection
+allocDebug = False
+
+def collectIfIdle():
+    global collectedAlloc
+    if reactor.ticksDiff(reactor.ticksMs(), lastPacketTicks) < idleTime: return
+    allocated = gc.mem_alloc()
+    if allocated <= collectedAlloc: return     # Nothing new to collect
+    startTime = stats.ticksUs()
+    gc.collect()
+    collectedAlloc = gc.mem_alloc()
+    locoTrace.record(trace.COLLECT, 0, max(0, allocated - collectedAlloc) >> 10, stats.ticksDiffUs(stats.ticksUs(), startTime))
+
+def runMeasuringAllocations():
+    # eventLoop.run(), counting the heap allocated by each pass. A pass in which the heap shrank had a collection in
+    # it, so what it allocated isn't known.
+    global lastPacketType
+    eventLoop.running = True
+    while eventLoop.running:
+        lastPacketType = 0xff
+        before = gc.mem_alloc()
+        eventLoop.runOnce()
+        allocated = gc.mem_alloc() - before
+        if allocated < 0: continue
+        locoStats.allocated(allocated)
+        if allocated: locoTrace.record(trace.ALLOC, lastPacketType, min(allocated, 0xffff))
+
+## Session ##
+# The controller answers ANNOUNCE with a session token. A loco reconnecting after a drop presents it again, and the
+# controller resumes the session it kept (state, subscriptions, conversation counters) rather than starting a new one.
+sessionToken = None
+announceConversation = None
+dropTicks = None    # reactor.ticksMs() when the connection dropped, None while connected
+# Sending on a connection the controller reset fails with EPIPE, which MicroPython's errno may not name (lwIP uses 32)
+droppedErrors = (errno.ECONNRESET, errno.ECONNABORTED, errno.ENOTCONN, getattr(errno, 'EPIPE', 32))
+reconnectMaxWait = 2.0
+# Frame checks offered in the ANNOUNCE, the controller picks one (or none) in its ACKNOWLEDGE and every packet after
+# carries it. "frame-checks : crc16" in the config offers only CRC-16, "frame-checks : off" none.
+frameChecks = [integrity.CRC16, integrity.CRC32]
+
+def setFrameCheck(check):
+    packetEncoder.setFrameCheck(check)
+    packetDecoder.setFrameCheck(check)
+    datagramChannel.setFrameCheck(check)
+    if locoCapture is not None: locoCapture.record(capture.CHECK, captureStream, bytes([check]))
+    if check != integrity.NONE: report(INFO, 'Packets carry {} from now on', integrity.checks[check])
+
+def announce():
+    # Tell the controller who this loco is, so it is known by road and number rather than by address. Every
+    # connection starts without a frame check.
+    global announceConversation
+    if packetEncoder.frameCheck != integrity.NONE: setFrameCheck(integrity.NONE)
+    announceConversation = conversations.start()
+    send(codec.ANNOUNCE, codec.encodeIdentity(config, sessionToken, frameChecks), announceConversation)
+
+def sessionStarted(token):
+    global sessionToken, announceConversation, dropTicks
+    resumed = token == sessionToken
+    sessionToken = token
+    announceConversation = None
+    if dropTicks is None: return
+    elapsed = reactor.ticksDiff(reactor.ticksMs(), dropTicks)
+    dropTicks = None
+    locoTrace.record(trace.RECOVERED, int(resumed), 0, elapsed)
+    if resumed:
+        # Pushes sent as the connection dropped may have been lost, the controller gets the whole state again
+        locoSubscriptions.forget()
+        report(INFO, 'Session resumed {} ms after the connection dropped', elapsed)
+    else:
+        # The controller doesn't know this loco any more (it restarted, or took too long to reconnect)
+        locoSubscriptions.subscribe({})
+        report(INFO, 'New session started {} ms after the connection dropped', elapsed)
+
+def connectionLost():
+    # The loco stops, nobody is left to control it
+    global dropTicks
+    dropTicks = reactor.ticksMs()
+    emergencyStop()
+    stopHeartbeats()
+    eventLoop.unregister(controllerSocket)
+    try: controllerSocket.close()
+    except OSError: pass
+    packetDecoder.clear()
+    if partialTimer is not None: eventLoop.cancel(partialTimer)
+    conversations.open.clear()
+
+def reconnect(credentials):
+    # Called once the connection has dropped, retries until the controller is back
+    connectionLost()
+    wait = 0.05     # Backs off to reconnectMaxWait while the controller stays away
+    while True:
+        try:
+            if connectController(*credentials):
+                announce()
+                return
+        except OSError as error:
+            report(INFO, 'Reconnect failed: {}', repr(error))
+        sleep(wait)
+        wait = min(wait * 2, reconnectMaxWait)
+
+## Heartbeat ##
+# The controller starts heartbeats with its first HEARTBEAT, which carries the interval for the loco to heartbeat back
+# at. A loco that misses "heartbeat-budget" heartbeats in a row (3 by default) has lost the controller and brakes to a
+# stop at its braking rate. It stays stopped when the link comes back, until the controller commands it again.
+locoHeartbeat = heartbeat.heartbeat()
+heartbeatTimer = None
+heartbeatIntervalMs = 0
+linkLost = False
+
+def handleHeartbeat(conversation, payload):
+    global heartbeatTimer, heartbeatIntervalMs
+    intervalMs = (payload[0] << 8) | payload[1]
+    if intervalMs != heartbeatIntervalMs:
+        heartbeatIntervalMs = intervalMs
+        if heartbeatTimer is not None: eventLoop.cancel(heartbeatTimer)
+        heartbeatTimer = eventLoop.callEvery(intervalMs / 1000, heartbeatDue) if intervalMs else None
+        report(INFO, 'Heartbeat every {} ms', intervalMs)
+    return b''
+
+def heartbeatDue():
+    currentTime = stats.ticksUs()
+    action = locoHeartbeat.tick(currentTime)
+    if action == heartbeat.WAIT: return
+    if action == heartbeat.LOST: linkFailsafe()
+    conversation = conversations.oneShot()
+    locoHeartbeat.sending(conversation, currentTime)
+    # A dead link fills the socket's send buffer sooner or later, the failsafe doesn't wait on it
+    try: send(codec.HEARTBEAT, b'', conversation)
+    except OSError: pass
+
+def linkFailsafe():
+    global linkLost
+    linkLost = True
+    locoTrace.record(trace.LINK, 0, min(locoHeartbeat.missed, 0xffff), locoHeartbeat.srtt or 0)
+    report(INFO, 'No heartbeat answered in {} tries, stopping', locoHeartbeat.missed)
+    locoSequencer.stop()
+    setThrottle(0)
+    pushState()
+
+def heartbeatAnswered():
+    global linkLost
+    if not linkLost: return
+    linkLost = False
+    locoTrace.record(trace.LINK, 1, 0, locoHeartbeat.srtt)
+    report(INFO, 'Heartbeats answered again')
+
+def stopHeartbeats():
+    global heartbeatTimer, heartbeatIntervalMs, linkLost
+    if heartbeatTimer is not None: eventLoop.cancel(heartbeatTimer)
+    heartbeatTimer = None
+    heartbeatIntervalMs = 0
+    linkLost = False
+    locoHeartbeat.reset()
+
+registerHandler(codec.HEARTBEAT, handleHeartbeat)
 
 def main():
     report(INFO, '===== Beginning main operation =====')
     # Initialization
+    eventLoop.register(controllerSocket, controllerReadable)
+    if eStopPort is not None: startEStopListener(eStopPort)
 
     # Operation
-    while True:
-        packets = recv(1)
-        if len(packets):
-            packet = packets[0]
-            print('===== Processing command packet =====')
-            startTime = now()
-            packetType, payload = packet
-            print('packet:', packet, end=' - ')
-
-            processedPacket = True  # Assume True, set to False only if the two else statements at the end fire
-            if packetType < len(packetTypes):
-
-
-                if packetTypes[packetType] == 'SET_THROTTLE':
-                    print('SET_THROTTLE')
-                    value = int.from_bytes(payload, 'big')
-                    if value >= 128: value -= 256
-                    setThrottle(value)
-                    print('Set throttle to {}'.format(throttle))
-                    send('ACKNOWLEDGE', b'')
-
-                elif packetTypes[packetType] == 'GET_THROTTLE':
-                    print('GET_THROTTLE')
-                    value = getThrottle()
-                    send('ACKNOWLEDGE', int.to_bytes((value + 256) % 256, 1, 'big'))
-                
-                elif packetTypes[packetType] == 'SET_LIGHT':
-                    print('SET_LIGHT')
-                    setLight(payload[0], payload[1])
-                    print('Set light {} to {}'.format(payload[0], payload[1]))
-                    send('ACKNOWLEDGE', b'')
-
-                elif packetTypes[packetType] == 'GET_LIGHT':
-                    print('GET_LIGHT')
-                    value = getLight(payload[0])
-                    send('ACKNOWLEDGE', int.to_bytes(value, 1, 'big'))
-
-
-                else: print('Unable to process packets of type {} at this time'.format(packetTypes[packetType])); processedPacket = False
-            else: print('Unknown packet type:', packetType); processedPacket = False
-
-            endTime = now()
-            print('Time:', endTime - startTime)
-
-        sleep(0.01)
+    if allocDebug: runMeasuringAllocations()
+    else: eventLoop.run()
+
+def configure():
+    # Everything set by the config, once it is loaded
+    global datagramPort, allocDebug, frameChecks
+    if 'capture' in config.keys(): startCapture(config['capture'])
+    locoMotion.configure(config)
+    loadSequences()
+    loadPlugins()
+    if config.get('datagram-port', '') == 'off': registerHandler(codec.OPEN_DATAGRAM, None)
+    elif 'datagram-port' in config.keys(): datagramPort = int(config['datagram-port'])
+    if 'heartbeat-budget' in config.keys(): locoHeartbeat.budget = int(config['heartbeat-budget'])
+    if config.get('frame-checks', '') == 'off': frameChecks = []
+    elif 'frame-checks' in config.keys(): frameChecks = [integrity.checkNum(name.strip()) for name in config['frame-checks'].split(',')]
+    if config.get('alloc-debug', '') == 'on':
+        if bootMode == 'real':
+            allocDebug = True
+            locoStats.measureAllocations()
+            report(INFO, 'Counting allocations per event loop pass')
+        else: report(INFO, 'alloc-debug is only supported on real locos')
 
-if __name__ == '__main__':
+def run():
+    global bootMark, idleCollectTimer
     try:
         getConfig()
+        configure()
+        bootPhase(stats.CONFIG)
         connected = False
+        credentials = None
 
         # Attempt to connect based on config
         credentialsFound = 'controller-ssid' in config.keys()
@@ -509,22 +1225,36 @@ if __name__ == '__main__':
         # Attempt failed, enter discovery mode
         while not connected:
             report(INFO, 'Unable to connect to controller')
-            controllerInfo = discoverController()
-            connected = connectController(*controllerInfo)
+            credentials = discoverController()
+            bootPhase(stats.DISCOVERY)
+            connected = connectController(*credentials)
+            if connected: saveCredentials(*credentials)
         report(INFO, 'Connected to controller, ready to send/recv packets')
+        announce()
+        bootMark = None
+        report(INFO, 'Ready {} ms after boot', reactor.ticksDiff(reactor.ticksMs(), bootTicks))
+        if bootMode == 'real': idleCollectTimer = eventLoop.callEvery(idleCollectInterval, collectIfIdle)
 
-        # All the normal stuff
-        main()
+        # All the normal stuff, until the connection drops
+        while True:
+            main()
+            reconnect(credentials)
 
     except BaseException as exception:
         report(INFO, '===== RailFi locomotive firmware has crashed =====')
+        if locoCapture is not None: locoCapture.close()
         if bootMode == 'real':
             from uio import StringIO; strIO = StringIO()
             sys.print_exception(exception, strIO)
             tb = strIO.getvalue()
-            with open('traceback.log', 'a') as tbFile:
-                tbFile.write(tb)
-                report(INFO, 'Traceback saved to traceback.log')
         else:
             from traceback import format_exc; tb = format_exc()
+        # The trace ring shows what the loco was doing leading up to the crash
+        with open('traceback.log', 'a') as tbFile:
+            tbFile.write(tb)
+            locoTrace.write(tbFile)
+            report(INFO, 'Traceback and trace saved to traceback.log')
         report(INFO, tb, end='')
+
+if __name__ == '__main__':
+    run()
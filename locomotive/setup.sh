@@ -1,9 +1,47 @@
 #! /bin/bash
+# Usage: ./setup.sh <device> [--fast]
+# --fast pushes the firmware and railfi precompiled with mpy-cross (which must match the loco's MicroPython version)
+# into /fast, and a main.py that loads them from there. The loco then skips compiling main.py at boot and doesn't wait
+# for the boot button, stop it with Ctrl-C over USB instead. Running without --fast goes back to the source files.
 echo "Setting up loco on $1"
 echo "boot.py -> boot.py"
 upyfile "$1" push boot.py boot.py
+
+if [ "$2" == "--fast" ]; then
+    build=$(mktemp -d)
+    mkdir "$build/railfi"
+    echo "main.py -> fast/firmware.mpy"
+    mpy-cross -o "$build/firmware.mpy" main.py || exit 1
+    upyfile "$1" push "$build/firmware.mpy" fast/firmware.mpy
+    echo "../railfi -> fast/railfi"
+    for module in __init__ capture codec datagram heartbeat integrity motion reactor sequences stats subscriptions trace; do
+        mpy-cross -o "$build/railfi/$module.mpy" "../railfi/$module.py" || exit 1
+        upyfile "$1" push "$build/railfi/$module.mpy" "fast/railfi/$module.mpy"
+    done
+    # /fast comes first on the path, so the precompiled railfi is found before any source copy left on the loco
+    echo "fast boot -> main.py"
+    printf "import sys\nsys.path.insert(0, '/fast')\nimport firmware\nfirmware.run()\n" > "$build/main.py"
+    upyfile "$1" push "$build/main.py" main.py
+    rm -r "$build"
+    echo "Done"
+    exit 0
+fi
+
 echo "main.py -> main.py"
 upyfile "$1" push main.py main.py
+echo "../railfi -> railfi"
+upyfile "$1" push ../railfi/__init__.py railfi/__init__.py
+upyfile "$1" push ../railfi/capture.py railfi/capture.py
+upyfile "$1" push ../railfi/codec.py railfi/codec.py
+upyfile "$1" push ../railfi/datagram.py railfi/datagram.py
+upyfile "$1" push ../railfi/heartbeat.py railfi/heartbeat.py
+upyfile "$1" push ../railfi/integrity.py railfi/integrity.py
+upyfile "$1" push ../railfi/motion.py railfi/motion.py
+upyfile "$1" push ../railfi/reactor.py railfi/reactor.py
+upyfile "$1" push ../railfi/sequences.py railfi/sequences.py
+upyfile "$1" push ../railfi/stats.py railfi/stats.py
+upyfile "$1" push ../railfi/subscriptions.py railfi/subscriptions.py
+upyfile "$1" push ../railfi/trace.py railfi/trace.py
 # echo "baseConfig.txt > config.txt"
 # upyfile $1 push config.txt baseConfig.txt
 echo "Done"
@@ -1,209 +1,197 @@
-import sys, socket, time
+import os, sys
 
-from PyQt6.QtCore import Qt, QThread, pyqtSignal
+from PyQt6.QtCore import Qt, QObject, QTimer, pyqtSignal, QAbstractListModel, QModelIndex
 from PyQt6.QtWidgets import (
     QApplication, QWidget,
-    QListWidget, QLabel,
+    QListView, QLabel,
     QSlider, QPushButton
 )
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from railfi import codec
+from railfi.controller import threadedController
 
-class locomotive():
-    packetTypes = [
-        'SET_THROTTLE',
-        'GET_THROTTLE',
-        'SET_LIGHT',
-        'GET_LIGHT',
-        'E_STOP',
-        'ACKNOWLEDGE',
-        'ERROR'
-    ]
 
-    def __init__(self, name, conn):
-        self.name = name
-        self.conn = conn
-        self.inBuffer = b''
+def formatMicros(value):
+    # Histogram percentiles are bucket upper bounds, None past the last bucket
+    if value is None: return 'slow'
+    if value >= 1000: return '<{:.0f} ms'.format(value / 1000)
+    return '<{} us'.format(value)
 
-        self.throttle = 0
-        self.lights = [False, False]
+def describeHistogram(histogram):
+    if histogram.total() == 0: return 'no samples'
+    return '{} samples, p50 {}, p95 {}'.format(histogram.total(), formatMicros(histogram.percentile(0.5)), formatMicros(histogram.percentile(0.95)))
 
-        print('Loco interface "{}" initialized'.format(self.name))
-
-        # Synchronize by sending GET_**** packets and setting variables with responses
-        # print('Loco interface "{}" synchronized'.format(self.name))
-    
-    def genPacket(self, packetType, payload):
-        print('Generating packet')        
-        binary = b'RF-'
-        
-        # Get packet type as int
-        if isinstance(packetType, str):
-            if packetType in self.packetTypes: packetType = self.packetTypes.index(packetType)
-            else: raise ValueError('Invalid packet type "{}"'.format(packetType))
-        elif isinstance(packetType, int): pass
-        else: raise ValueError('Invalid packet type "{}"'.format(packetType))
-
-        binary += int.to_bytes(packetType, 1, 'big')
-        if len(payload) >= 2 ** 16: raise ValueError('Payload too long')
-        binary += int.to_bytes(len(payload), 2, 'big')
-        binary += payload
-
-        print('Packet generation results:', binary)
-        return binary
-
-    def send(self, packetType, payload):
-        print('Sending packet')
-        self.conn.sendall(self.genPacket(packetType, payload))
-        print('Sent packet')
-
-    def recv(self, numPackets, maxLoops=10):
-        inBuffer = self.inBuffer; conn = self.conn
-        print('Receiving packets')
-        try: inBuffer += conn.recv(4096)
-        except OSError: pass
-        packets = []
-        for i in range(maxLoops):
-            # print('inBuffer:', inBuffer)
-            if len(inBuffer) < 6:
-                # print('Attempting to receive more data')
-                try: inBuffer += conn.recv(4096)
-                except OSError: pass
-
-            if len(inBuffer) >= 6:
-                # print('Decoding packet from buffer')
-                prefix = inBuffer[0:3]
-                if prefix != b'RF-':
-                    # print('Found data that is not a packet, discarding first byte in buffer')
-                    inBuffer = inBuffer[1:]
-
-                packetType = int.from_bytes(inBuffer[3:4], 'big')
-                payloadSize = int.from_bytes(inBuffer[4:6], 'big')
-                
-                if len(inBuffer) < payloadSize + 6:
-                    # print('Packet incomplete, waiting to receive more data in buffer')
-                    break
-
-                payload = inBuffer[6:payloadSize + 6]
-
-                inBuffer = inBuffer[payloadSize + 6:]
-                # print('Decoded packet:', (packetType, payload))
-                packets.append((packetType, payload))
-
-                if len(packets) >= numPackets: break
-
-            # else:
-            #     print('Not enough data in buffer')
-        
-        return packets
 
-
-# Thread to manage incoming connections on the traffic socket (There should only ever be *ONE* instance of this running at a time!)
-class trafficCop(QThread):
-    newConnection = pyqtSignal(tuple)
+# Delivers results from the controller's thread to the GUI thread
+class guiBridge(QObject):
+    callReady = pyqtSignal(object, object)
 
     def __init__(self, parent, *args):
-        QThread.__init__(self, parent, *args)
-        print('Traffic cop initialized')
-
-    def run(self):
-        while self.parent().runFlag:
-            
-            while self.parent().processingConnection:
-                if not self.parent().runFlag: break
-                print('Traffic cop waiting for parent to finish processing last connection...')
-                time.sleep(0.1)
-
-            try:
-                conn, addr = self.parent().trafficSocket.accept()
-                conn.sendall(b'\x00\x00')
-                if conn.recv(2) != b'\x00\x00':
-                    conn.close()
-                    continue
-
-                dedicatedPort = self.parent().trafficPort + 1   # Start at the first port after the traffic port
-                dedicatedSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                # Walk up port numbers until one works
-                bound = False
-                while not bound:
-                    try: dedicatedSocket.bind(('', dedicatedPort)); bound = True
-                    except OSError: dedicatedPort += 1
-                dedicatedSocket.listen(1)
-                dedicatedSocket.settimeout(1.0)
-
-                conn.sendall(int.to_bytes(dedicatedPort, 2, 'big'))
-                print('Directed new loco to port {}'.format(dedicatedPort))
-
-                conn.close()
-                self.newConnection.emit((dedicatedSocket,))
-
-                # while not self.parent().processingConnection:
-                #     if not self.parent().runFlag: break
-                #     print('Traffic cop waiting for parent to begin processing last connection...')
-                #     time.sleep(0.1)
-
-            except OSError:
-                pass
-        self.finished.emit()
+        QObject.__init__(self, parent, *args)
+        # The bridge lives on the GUI thread, so this connection delivers calls there
+        self.callReady.connect(lambda callback, value: callback(value))
+
+    def callInGui(self, callback, value):
+        # Call callback(value) on the GUI thread
+        self.callReady.emit(callback, value)
+
+    def whenDone(self, future, callback, snapshot=None):
+        # Call callback(result) on the GUI thread once future is done. With a snapshot function, callback(result,
+        # snapshot()) instead, snapshot() being called on the controller's thread as it completes the future.
+        def done(future):
+            if snapshot is None: self.callInGui(lambda future: self.runCallback(callback, future), future)
+            else:
+                value = snapshot()
+                self.callInGui(lambda future: self.runCallback(lambda result: callback(result, value), future), future)
+        future.add_done_callback(done)
+
+    def runCallback(self, callback, future):
+        if future.cancelled(): return
+        error = future.exception()
+        if error is not None:
+            print('Command failed:', repr(error))
+            return
+        callback(future.result())
+
+
+# Connected locos as shown in the loco list. Rows are found by name through an index, and changes are collected and
+# applied on a timer, so hundreds of locos connecting or reporting state cost one update of the view per tick.
+class fleetModel(QAbstractListModel):
+    def __init__(self, parent, flushInterval=100):
+        QAbstractListModel.__init__(self, parent)
+        self.names = []             # Row order
+        self.rows = {}              # {name: row}
+        self.labels = {}            # {name: text shown}, includes locos waiting to be added
+        self.pendingAdds = []
+        self.pendingRemoves = set()
+        self.dirty = set()          # Names whose label changed since the last flush
+
+        self.flushTimer = QTimer(self)
+        self.flushTimer.timeout.connect(self.flush)
+        self.flushTimer.start(flushInterval)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role != Qt.ItemDataRole.DisplayRole or not index.isValid(): return None
+        return self.labels[self.names[index.row()]]
+
+    def nameAt(self, row):
+        if row < 0 or row >= len(self.names): return None
+        return self.names[row]
+
+    def setLoco(self, name, label):
+        # Add a loco or change its label, shown at the next flush
+        if name in self.pendingRemoves: self.pendingRemoves.discard(name)   # Reconnected, keeps its row
+        if name not in self.labels: self.pendingAdds.append(name)
+        else: self.dirty.add(name)
+        self.labels[name] = label
+
+    def removeLoco(self, name):
+        if name in self.rows: self.pendingRemoves.add(name)
+        elif name in self.labels:
+            self.pendingAdds.remove(name)
+            del self.labels[name]
+
+    def flush(self):
+        if len(self.pendingRemoves):
+            # Bottom up, so the rows of the locos still to remove stay valid
+            for row in sorted([self.rows[name] for name in self.pendingRemoves], reverse=True):
+                self.beginRemoveRows(QModelIndex(), row, row)
+                name = self.names.pop(row)
+                del self.labels[name]
+                self.endRemoveRows()
+            self.dirty -= self.pendingRemoves
+            self.pendingRemoves.clear()
+            self.rows = {self.names[row]: row for row in range(len(self.names))}
+
+        if len(self.pendingAdds):
+            first = len(self.names)
+            self.beginInsertRows(QModelIndex(), first, first + len(self.pendingAdds) - 1)
+            for name in self.pendingAdds:
+                self.rows[name] = len(self.names)
+                self.names.append(name)
+            self.pendingAdds.clear()
+            self.endInsertRows()
+
+        if len(self.dirty):
+            rows = [self.rows[name] for name in self.dirty if name in self.rows]
+            self.dirty.clear()
+            if len(rows): self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)), [Qt.ItemDataRole.DisplayRole])
 
 
 class mainWindow(QWidget):
     def __init__(self):
         QWidget.__init__(self)
-        self.runFlag = True
-        self.processingConnection = False
-        self.trafficPort = 4000
 
         self.initUI()
 
-        # Traffic cop setup (for directing locos to dedicated sockets when they connect)
-        self.trafficSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Walk up port numbers until one works
-        bound = False
-        while not bound:
-            try: self.trafficSocket.bind(('', self.trafficPort)); bound = True
-            except OSError: self.trafficPort += 1
-        self.trafficSocket.listen(5)
-        self.trafficSocket.settimeout(0.5)
-        self.trafficCop = trafficCop(self)
-        self.trafficCop.newConnection.connect(self.newLocoConnecting)
-        self.trafficCop.start()
-        print('Started traffic cop')
-
-        self.locos = []     # Contains instances of loco
+        self.locos = {}         # {name: locomotive}, only for reading stats, commands go through the controller
+        self.controls = {}      # {name: {'throttle': 0-100, 'direction': 0/1, 'lights': [bool, ...]}} as set in the UI
+        self.states = {}        # {name: state} as reported by the loco
         self.selectedLoco = None
-        self.throttleUpdatedTime = time.perf_counter()
-        self.throttleUpdateInterval = 1 / 5
+        self.maxWriteRate = 5   # Throttle/light updates per second per loco, slider moves in between are coalesced
+
+        # All loco I/O happens on the controller's thread, the UI only queues commands and renders the results
+        self.bridge = guiBridge(self)
+        # Throttle changes go as datagrams to locos that support it, so a congested network doesn't deliver them in
+        # bursts. Locos push their state, so the UI stays current without polling, throttle changes at most every 100 ms.
+        self.controller = threadedController(maxWriteRate=self.maxWriteRate, broadcastAddr='255.255.255.255', datagrams=True,
+                                             subscribe={'throttle': 100, 'direction': 0, 'lights': 0, 'error': 0})
+        # The state, and whether a newer one is still waiting to be written, are copied on the controller's thread,
+        # which is the only one changing them
+        self.controller.addListener(lambda event, loco: self.bridge.callInGui(lambda snapshot: self.locoEvent(event, loco, *snapshot), (dict(loco.state), 'state' in loco.pendingWrites)))
+        self.trafficPort = self.controller.start()
+        print('Started controller on port {}'.format(self.trafficPort))
+
+        # Poll the selected loco's stats
+        self.statsInterval = 2000  # ms
+        self.statsTimer = QTimer(self)
+        self.statsTimer.timeout.connect(self.pollStats)
+        self.statsTimer.start(self.statsInterval)
 
     def closeEvent(self, event):
-        self.runFlag = False
         print('Waiting for threads to stop')
-        time.sleep(0.6)
+        self.controller.stop()
         event.accept()
 
-    def newLocoConnecting(self, args):
-        dedicatedSocket = args[0]
-        print('Loco connecting')
-        self.processingConnection = True
-
-        try:
-            conn, addr = dedicatedSocket.accept()
-            conn.settimeout(5.0)
-            self.locos.append(locomotive(str(addr), conn))
-            self.locosList.addItem(self.locos[-1].name)
-        except OSError:
-            print('Loco did not connect in time')
-
-        self.processingConnection = False
+    def locoEvent(self, event, loco, state, writePending):
+        if event == 'state':
+            if self.locos.get(loco.name) is loco: self.stateChanged(loco.name, state, writePending)
+        elif event == 'connected':
+            # A loco reconnecting under its announced name takes over its row and controls
+            self.locos[loco.name] = loco
+            if loco.name not in self.controls: self.controls[loco.name] = {'throttle': 0, 'direction': 0, 'lights': [False, False]}
+            self.states[loco.name] = state
+            self.fleetModel.setLoco(loco.name, self.locoLabel(loco.name))
+        elif event == 'disconnected':
+            if self.locos.get(loco.name) is not loco: return
+            del self.locos[loco.name]
+            del self.controls[loco.name]
+            del self.states[loco.name]
+            self.fleetModel.removeLoco(loco.name)
+            if self.selectedLoco == loco.name: self.selectedLoco = None
+
+    def locoLabel(self, name):
+        state = self.states[name]
+        label = '{} {}%'.format(name, state.get('throttle', 0))
+        if state.get('error'): label += ' ERROR'
+        return label
 
 
     ## UI functions ##
     def initUI(self):
         padding = 5
-        self.resize(400, 400)
+        self.resize(640, 400)
         self.setWindowTitle('RailFi controller')
 
-        self.locosList = QListWidget(self)
-        self.locosList.currentItemChanged.connect(self.selectLoco)
+        self.fleetModel = fleetModel(self)
+        self.locosList = QListView(self)
+        self.locosList.setModel(self.fleetModel)
+        self.locosList.setUniformItemSizes(True)
+        self.locosList.selectionModel().currentChanged.connect(self.selectLoco)
         self.locosList.move(padding, padding)
         self.locosList.resize(120, self.height() - (2 * padding))
         
@@ -236,68 +224,147 @@ class mainWindow(QWidget):
         self.directionButton.move(self.locosList.width() + (2 * padding), self.locoName.height() + self.headlightButton.height() + self.rearlightButton.height() + self.throttleLabel.height() + self.throttleSlider.height() + (6 * padding))
         self.directionButton.clicked.connect(self.reverse)
 
+        self.writeStatsLabel = QLabel(self)
+        self.writeStatsLabel.setText('Sent: 0 Coalesced: 0')
+        self.writeStatsLabel.move(self.locosList.width() + (2 * padding), self.locoName.height() + self.headlightButton.height() + self.rearlightButton.height() + self.throttleLabel.height() + self.throttleSlider.height() + self.directionButton.height() + (7 * padding))
+        self.writeStatsLabel.resize(200, 40)
+
+        self.locoStatsLabel = QLabel(self)
+        self.locoStatsLabel.setText('No stats')
+        self.locoStatsLabel.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
+        self.locoStatsLabel.move(self.locosList.width() + 200 + (3 * padding), padding)
+        self.locoStatsLabel.resize(self.width() - self.locosList.width() - 200 - (4 * padding), 300)
+
+        self.resetStatsButton = QPushButton(self)
+        self.resetStatsButton.setText('Reset stats')
+        self.resetStatsButton.move(self.locosList.width() + 200 + (3 * padding), self.locoStatsLabel.height() + (2 * padding))
+        self.resetStatsButton.clicked.connect(self.resetStats)
+
+        self.stopAllButton = QPushButton(self)
+        self.stopAllButton.setText('STOP ALL')
+        self.stopAllButton.move(self.locosList.width() + 200 + (3 * padding), self.locoStatsLabel.height() + self.resetStatsButton.height() + (3 * padding))
+        self.stopAllButton.clicked.connect(self.stopAll)
+
     
     ## Loco Control ##
-    def selectLoco(self, caller):
-        print('Selecting loco "{}"'.format(caller.text()))
-        for loco in self.locos:
-            if loco.name == caller.text():
-                self.selectedLoco = loco
-
-    def _setThrottle(self):
-        print('Setting throttle to', self.selectedLoco.throttle)
-
-        # Perform a SET_THROTTLE
-        self.selectedLoco.send('SET_THROTTLE', int.to_bytes(self.selectedLoco.throttle, 1, 'big', signed=True))
-        response = self.selectedLoco.recv(1)[0]
-        print('Acknowledged:', locomotive.packetTypes[response[0]] == 'ACKNOWLEDGE')
-
-        # Perform as GET_THROTTLE
-        self.selectedLoco.send('GET_THROTTLE', b'')
-        response = self.selectedLoco.recv(1)[0]
-        print('Acknowledged:', locomotive.packetTypes[response[0]] == 'ACKNOWLEDGE')
-
-        # Update locomotive interface and UI
-        throttleStatus = int.from_bytes(response[1], 'big', signed=True)
-        if self.selectedLoco.throttle != throttleStatus: print('DISCREPANCY: {} vs {}'.format(self.selectedLoco.throttle, throttleStatus))
-        self.selectedLoco.throttle = throttleStatus
-        self.throttleLabel.setText('Throttle: {}%'.format(+throttleStatus))
-        self.directionButton.setText('Direction: ' + 'FWD' if throttleStatus >= 0 else 'REV')
+    def selectLoco(self, current, previous):
+        name = self.fleetModel.nameAt(current.row())
+        if name is None: return
+        print('Selecting loco "{}"'.format(name))
+        if name in self.locos:
+            self.selectedLoco = name
+            self.showState(self.selectedLoco)
+
+    def writeState(self, name):
+        # One SET_STATE carries the whole desired state and its response carries the resulting state, so no GET is
+        # needed. Superseded by any newer state not yet sent.
+        controls = self.controls[name]
+        lightMask = 0
+        for i in range(len(controls['lights'])):
+            if controls['lights'][i]: lightMask |= 1 << i
+        state = {'throttle': controls['throttle'], 'direction': controls['direction'], 'lights': lightMask}
+        print('Setting state to', state)
+        loco = self.locos[name]
+        self.bridge.whenDone(self.controller.setState(name, **state), lambda state, writePending: self.stateReceived(name, state, writePending), lambda: 'state' in loco.pendingWrites)
+
+    def stateReceived(self, name, state, writePending):
+        # Response to our own write
+        if name not in self.locos: return
+        self.showWriteStats(self.locos[name])
+        self.stateChanged(name, state, writePending)
+
+    def stateChanged(self, name, state, writePending):
+        # From a response or pushed by the loco, which may only carry the fields that changed. writePending is
+        # whether a newer state was still waiting to be written when it arrived.
+        self.states[name].update(state)
+        self.fleetModel.setLoco(name, self.locoLabel(name))
+
+        # Update the controls, unless a newer state is still on its way
+        if not writePending:
+            controls = self.controls[name]
+            if 'throttle' in state: controls['throttle'] = state['throttle']
+            if 'direction' in state: controls['direction'] = state['direction']
+            if 'lights' in state: controls['lights'] = [bool(state['lights'] & (1 << i)) for i in range(len(controls['lights']))]
+        self.showState(name)
+
+    def showState(self, name):
+        if name != self.selectedLoco: return
+        state = self.states[name]
+        throttle = state.get('throttle', 0)
+        self.throttleLabel.setText('Throttle: {}%'.format(-throttle if state.get('direction') else throttle))
+        self.directionButton.setText('Direction: ' + ('REV' if state.get('direction') else 'FWD'))
+        self.headlightButton.setText('Headlight: ' + ('ON' if state.get('lights', 0) & 1 else 'OFF'))
+        self.locoName.setText(name if not state.get('error') else '{} (error {})'.format(name, state['error']))
 
     def setThrottle(self, value):
         if self.selectedLoco is None: return
         print('===== setThrottle =====')
-        if time.perf_counter() - self.throttleUpdatedTime > self.throttleUpdateInterval:
-            self.selectedLoco.throttle = round(value * 1.01) * (1 if self.selectedLoco.throttle >= 0 else -1)
-            self.throttleUpdatedTime = time.perf_counter()
-        self._setThrottle()
+        self.controls[self.selectedLoco]['throttle'] = round(value * 1.01)
+        self.writeState(self.selectedLoco)
 
     def reverse(self):
         if self.selectedLoco is None: return
         print('===== reverse =====')
-        self.selectedLoco.throttle *= -1
-        self._setThrottle()
+        self.controls[self.selectedLoco]['direction'] = 1 - self.controls[self.selectedLoco]['direction']
+        self.writeState(self.selectedLoco)
         
 
     def toggleHeadlight(self):
         if self.selectedLoco is None: return
         print('===== toggleHeadlight =====')
+        lights = self.controls[self.selectedLoco]['lights']
+        lights[0] = not lights[0]
+        self.writeState(self.selectedLoco)
+
+    def stopAll(self):
+        print('===== stopAll =====')
+        for controls in self.controls.values(): controls['throttle'] = 0
+        if self.selectedLoco is not None:
+            self.throttleSlider.blockSignals(True)
+            self.throttleSlider.setValue(0)
+            self.throttleSlider.blockSignals(False)
+            self.throttleLabel.setText('Throttle: 0%')
+        self.bridge.whenDone(self.controller.stopAll(), self.stoppedAll)
+
+    def stoppedAll(self, results):
+        for name, result in results.items():
+            if isinstance(result, Exception): print('Loco "{}" did not confirm the stop: {}'.format(name, repr(result)))
+            else: print('Loco "{}" stopped in {:.1f} ms'.format(name, result * 1000))
+
+    def showWriteStats(self, loco):
+        print('Loco "{}" writes: {} requested, {} sent, {} coalesced'.format(loco.name, loco.writesRequested, loco.writesSent, loco.writesCoalesced))
+        if loco.name != self.selectedLoco: return
+        self.writeStatsLabel.setText('Sent: {} Coalesced: {}'.format(loco.writesSent, loco.writesCoalesced))
+
+
+    ## Loco stats ##
+    def pollStats(self):
+        if self.selectedLoco is None: return
+        name = self.selectedLoco
+        self.bridge.whenDone(self.controller.getStats(name), lambda locoStats: self.showLocoStats(name, locoStats))
 
-        # Perform a SET_LIGHT
-        self.selectedLoco.send('SET_LIGHT', b'\x00' + (b'\x00' if self.selectedLoco.lights[0] else b'\x01'))
-        response = self.selectedLoco.recv(1)[0]
-        print('Acknowledged:', locomotive.packetTypes[response[0]] == 'ACKNOWLEDGE')
-        
-        # Perform a GET_LIGHT
-        self.selectedLoco.send('GET_LIGHT', b'\x00')
-        response = self.selectedLoco.recv(1)[0]
-        print('Acknowledged:', locomotive.packetTypes[response[0]] == 'ACKNOWLEDGE')
-        
-        # Update locomotive interface and UI
-        headlightStatus = bool(int.from_bytes(response[1], 'big'))
-        self.selectedLoco.lights[0] = headlightStatus
-        self.headlightButton.setText('Headlight: ' + ('ON' if headlightStatus else 'OFF'))
-        print('Updated headlight status')
+    def resetStats(self):
+        if self.selectedLoco is None: return
+        self.bridge.whenDone(self.controller.resetStats(self.selectedLoco), lambda result: self.pollStats())
+
+    def showLocoStats(self, name, locoStats):
+        if name != self.selectedLoco: return
+        lines = [
+            'Up {:.0f} s, {} B in, {} B out'.format(locoStats['uptime'], locoStats['bytesIn'], locoStats['bytesOut']),
+            'Resyncs: {} ({} B discarded), {} packets rejected'.format(locoStats['resyncs'], locoStats['discarded'], locoStats['rejected']),
+            'Lowest free memory: {}'.format('unknown' if locoStats['memFreeLow'] is None else '{} B'.format(locoStats['memFreeLow'])),
+            'Receive to actuate: ' + describeHistogram(locoStats['actuateLatency']),
+            'Processing time:'
+        ]
+        for packetType, histogram in sorted(locoStats['processTime'].items()):
+            typeName = codec.packetTypes[packetType] if packetType < len(codec.packetTypes) else str(packetType)
+            lines.append('  {}: {}'.format(typeName, describeHistogram(histogram)))
+        if len(locoStats['bootPhases']):
+            lines.append('Boot: ' + ', '.join(['{} {} ms'.format(phase, ms) for phase, ms in locoStats['bootPhases'].items()]))
+        if locoStats['allocations'] is not None:
+            allocations = locoStats['allocations']
+            lines.append('Event loop passes allocating: {} of {}'.format(allocations.total() - allocations.counts[0], allocations.total()))
+        self.locoStatsLabel.setText('\n'.join(lines))
 
 
 if __name__ == '__main__':
@@ -0,0 +1 @@
+# RailFi modules shared between the locomotive firmware, the handheld controller and the PC controller
@@ -0,0 +1,128 @@
+# Traffic capture: an append-only binary file of what a loco or the controller sent and received, with timestamps,
+# for finding out what actually happened on the wire and for replaying it with python -m railfi.replay.
+# Written to run unmodified on both MicroPython and CPython.
+try: import os
+except ImportError: import uos as os
+
+from .reactor import ticksMs, ticksDiff
+from .stats import ticksUs, ticksDiffUs
+
+# A capture file starts with magic, then holds records of <kind (1B)> <stream (1B)> <length (uint16)> <us since the
+# record before (uint32)> <data>. Each run of the recorder appends a START record naming the endpoint it ran on, and
+# names its streams (connections) with NAME records before using them.
+magic = b'RFCAP\x01'    # The last byte is the format version
+recordHeaderSize = 8
+maxDelay = 2 ** 32 - 1
+
+kinds = [
+    'START',    # data: the endpoint, "loco" or "controller"
+    'NAME',     # data: the name of a new stream
+    'IN',       # data: bytes received, as they came in
+    'OUT',      # data: a packet sent
+    'RENAME',   # data: the stream's new name, which applies to its records before it too (e.g. once a loco announces itself)
+    'CHECK'     # data: the frame check (1B, see railfi.integrity) the stream's packets carry from here on
+]
+START = 0
+NAME = 1
+IN = 2
+OUT = 3
+RENAME = 4
+CHECK = 5
+
+
+def openRecorder(path, endpoint):
+    # Appends to the capture at path, starting a new file if there isn't one
+    try: isNew = os.stat(path)[6] == 0
+    except OSError: isNew = True
+    return recorder(open(path, 'ab'), endpoint, isNew)
+
+
+class recorder():
+    def __init__(self, file, endpoint, isNew=True):
+        self.file = file
+        self.header = bytearray(recordHeaderSize)
+        self.lastTime = ticksUs()
+        self.lastTimeMs = ticksMs()
+        self.numStreams = 0
+        if isNew: file.write(magic)
+        self._write(START, 0, endpoint.encode())
+
+    def stream(self, name):
+        # Returns the number of a new stream, record() its traffic with it
+        stream = self.numStreams
+        self.numStreams = (stream + 1) % 256
+        self._write(NAME, stream, name.encode())
+        return stream
+
+    def rename(self, stream, name):
+        self._write(RENAME, stream, name.encode())
+
+    def record(self, kind, stream, data):
+        # kind is IN, OUT or CHECK
+        self._write(kind, stream, data)
+
+    def _write(self, kind, stream, data):
+        currentTime = ticksUs()
+        currentTimeMs = ticksMs()
+        delay = ticksDiffUs(currentTime, self.lastTime)
+        # MicroPython's us ticks wrap after 17 minutes, long gaps are timed in ms
+        if ticksDiff(currentTimeMs, self.lastTimeMs) > 60000: delay = ticksDiff(currentTimeMs, self.lastTimeMs) * 1000
+        self.lastTime = currentTime
+        self.lastTimeMs = currentTimeMs
+        header = self.header
+        position = 0
+        while True:
+            # Anything longer than a record holds is split over several records
+            length = min(len(data) - position, 0xffff)
+            delay = max(0, min(delay, maxDelay))
+            header[0] = kind
+            header[1] = stream
+            header[2] = length >> 8
+            header[3] = length & 0xff
+            header[4] = (delay >> 24) & 0xff
+            header[5] = (delay >> 16) & 0xff
+            header[6] = (delay >> 8) & 0xff
+            header[7] = delay & 0xff
+            self.file.write(header)
+            self.file.write(data if position == 0 and length == len(data) else data[position:position + length])
+            position += length
+            delay = 0
+            if position >= len(data): break
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def readCapture(path):
+    # Returns each run of a recorder in the file as {'endpoint': 'loco' or 'controller', 'records': [(seconds since
+    # the START, kind name, stream name, data)]}
+    with open(path, 'rb') as captureFile: contents = captureFile.read()
+    if contents[:len(magic)] != magic: raise ValueError('{} is not a RailFi capture'.format(path))
+    sections = []
+    names = {}
+    position = len(magic)
+    elapsed = 0
+    while position + recordHeaderSize <= len(contents):
+        kind = contents[position]
+        stream = contents[position + 1]
+        length = (contents[position + 2] << 8) | contents[position + 3]
+        delay = (contents[position + 4] << 24) | (contents[position + 5] << 16) | (contents[position + 6] << 8) | contents[position + 7]
+        data = contents[position + recordHeaderSize:position + recordHeaderSize + length]
+        position += recordHeaderSize + length
+        if len(data) < length: break    # Cut short, e.g. by a crash while writing
+        elapsed += delay
+        if kind == START:
+            sections.append({'endpoint': data.decode('utf-8', 'replace'), 'records': []})
+            names = {}
+            elapsed = 0
+        elif not len(sections): raise ValueError('{} has records before its first START'.format(path))
+        # Records hold their stream's [name] until the end, so a rename reaches back to the stream's earlier records
+        elif kind == NAME: names[stream] = [data.decode('utf-8', 'replace')]
+        elif kind == RENAME: names.setdefault(stream, [None])[0] = data.decode('utf-8', 'replace')
+        else: sections[-1]['records'].append((elapsed / 1000000, kinds[kind] if kind < len(kinds) else str(kind), names.setdefault(stream, [str(stream)]), data))
+    for section in sections:
+        section['records'] = [(recordTime, kind, name[0], data) for recordTime, kind, name, data in section['records']]
+    return sections
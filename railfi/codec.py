@@ -0,0 +1,574 @@
+# RF- packet codec shared by the locomotive, the handheld controller and the PC controller
+# Written to run unmodified on both MicroPython and CPython, see docs/protocol.md for the packet structure
+import sys
+
+from . import integrity
+
+packetTypes = [
+    'SET_THROTTLE',
+    'GET_THROTTLE',
+    'SET_LIGHT',
+    'GET_LIGHT',
+    'E_STOP',
+    'ACKNOWLEDGE',
+    'ERROR',
+    'CONCLUDE',
+    'SET_STATE',
+    'GET_STATE',
+    'GET_STATS',
+    'RESET_STATS',
+    'GET_TRACE',
+    'OPEN_DATAGRAM',
+    'SUBSCRIBE',
+    'STATE_CHANGED',
+    'ANNOUNCE',
+    'UPLOAD_SEQUENCE',
+    'RUN_SEQUENCE',
+    'STOP_SEQUENCE',
+    'GET_SEQUENCES',
+    'HEARTBEAT'
+]
+
+packetTypeNums = {name: num for num, name in enumerate(packetTypes)}
+
+# Packet type numbers, for code that handles packets by type rather than by name
+SET_THROTTLE = 0
+GET_THROTTLE = 1
+SET_LIGHT = 2
+GET_LIGHT = 3
+E_STOP = 4
+ACKNOWLEDGE = 5
+ERROR = 6
+CONCLUDE = 7
+SET_STATE = 8
+GET_STATE = 9
+GET_STATS = 10
+RESET_STATS = 11
+GET_TRACE = 12
+OPEN_DATAGRAM = 13
+SUBSCRIBE = 14
+STATE_CHANGED = 15
+ANNOUNCE = 16
+UPLOAD_SEQUENCE = 17
+RUN_SEQUENCE = 18
+STOP_SEQUENCE = 19
+GET_SEQUENCES = 20
+HEARTBEAT = 21
+
+# First byte of an ERROR payload
+errorCodes = [
+    'NO_ERROR',
+    'UNKNOWN_PACKET_TYPE',      # Nothing on the receiving side handles this packet type
+    'HANDLER_FAILED',           # The handler raised, e.g. on a malformed payload
+    'PREEMPTED'                 # Not carried out because an E_STOP sent after it arrived first
+]
+UNKNOWN_PACKET_TYPE = 1
+HANDLER_FAILED = 2
+PREEMPTED = 3
+
+# Commands an E_STOP preempts, anything that could set the motor running again
+preemptibleTypes = (SET_THROTTLE, SET_STATE, RUN_SEQUENCE)
+# Packets that end a conversation, which are never answered
+responseTypes = (ACKNOWLEDGE, ERROR, CONCLUDE)
+
+headerSize = 10     # 'RF-' + packet type + conversation ID + payload size
+maxPayloadSize = 2 ** 16 - 1
+# Largest payload each side is expected to send of a packet type it has no limit for below (e.g. a plugin's). A
+# loco's stats and trace are a few KB.
+maxLocoPayload = 16384
+maxControllerPayload = 4096
+maxConversations = 2 ** 31
+
+# Largest payload of each packet type a controller sends, and a loco sends. A decoder rejects a header claiming more
+# as corrupt, so a corrupt header claims a few bytes at most rather than holding up the packets behind it.
+controllerPayloads = {
+    SET_THROTTLE: 1,
+    GET_THROTTLE: 0,
+    SET_LIGHT: 2,
+    GET_LIGHT: 1,
+    E_STOP: 4,
+    ACKNOWLEDGE: 5,     # Session token and frame check, answering ANNOUNCE
+    ERROR: 1,
+    CONCLUDE: 0,
+    SET_STATE: 9,       # Field mask and up to 8 fields
+    GET_STATE: 0,
+    GET_STATS: 0,
+    RESET_STATS: 0,
+    GET_TRACE: 0,
+    OPEN_DATAGRAM: 2,
+    SUBSCRIBE: 17,      # Field mask and an interval for each of up to 8 fields
+    STATE_CHANGED: 0,
+    ANNOUNCE: 0,
+    UPLOAD_SEQUENCE: 2 + 255 * 5,
+    RUN_SEQUENCE: 2,
+    STOP_SEQUENCE: 0,
+    GET_SEQUENCES: 0,
+    HEARTBEAT: 2
+}
+locoPayloads = {
+    SET_THROTTLE: 0,
+    GET_THROTTLE: 0,
+    SET_LIGHT: 0,
+    GET_LIGHT: 0,
+    E_STOP: 0,
+    ACKNOWLEDGE: maxLocoPayload,
+    ERROR: 1,
+    CONCLUDE: 0,
+    SET_STATE: 0,
+    GET_STATE: 0,
+    GET_STATS: 0,
+    RESET_STATS: 0,
+    GET_TRACE: 0,
+    OPEN_DATAGRAM: 0,
+    SUBSCRIBE: 0,
+    STATE_CHANGED: 9,
+    ANNOUNCE: 1024,
+    UPLOAD_SEQUENCE: 0,
+    RUN_SEQUENCE: 0,
+    STOP_SEQUENCE: 0,
+    GET_SEQUENCES: 0,
+    HEARTBEAT: 0
+}
+# ms a receiver waits for the rest of a packet before dropping its header as corrupt, see decoder.dropPartial()
+partialTimeout = 250
+
+
+# Fields of a loco's state as carried by SET_STATE/GET_STATE/STATE_CHANGED, one byte each: throttle (0-100),
+# direction (0 forward, 1 reverse), lights (bit n is light n), error (the loco's error code, read only) and speed (the
+# throttle the motor is at as it ramps to the throttle, read only). New fields must be added at the end, there is
+# room for 8.
+stateFields = [
+    'throttle',
+    'direction',
+    'lights',
+    'error',
+    'speed'
+]
+
+allFields = (1 << len(stateFields)) - 1    # Field mask with every field set
+
+def encodeState(state):
+    # <field mask (1B)> followed by one byte for each field in the mask, in stateFields order
+    fieldMask = 0
+    values = []
+    for i in range(len(stateFields)):
+        if stateFields[i] in state:
+            fieldMask |= 1 << i
+            values.append(state[stateFields[i]])
+    return bytes([fieldMask] + values)
+
+def decodeState(payload):
+    # Fields this side doesn't know about (newer firmware) are skipped
+    state = {}
+    fieldMask = payload[0]
+    position = 1
+    for i in range(8):
+        if fieldMask & (1 << i):
+            if i < len(stateFields): state[stateFields[i]] = payload[position]
+            position += 1
+    return state
+
+# encodeState()/decodeState() for the loco's hot path, which don't allocate. values holds a value for each field, in
+# stateFields order (e.g. a bytearray).
+def encodeStateInto(buffer, values, fieldMask=allFields):
+    # Returns the payload size
+    buffer[0] = fieldMask
+    size = 1
+    for i in range(len(stateFields)):
+        if fieldMask & (1 << i):
+            buffer[size] = values[i]
+            size += 1
+    return size
+
+def decodeStateInto(payload, values):
+    # Returns the mask of the fields that were in payload and written into values
+    fieldMask = payload[0]
+    position = 1
+    for i in range(8):
+        if fieldMask & (1 << i):
+            if i < len(stateFields): values[i] = payload[position]
+            position += 1
+    return fieldMask & allFields
+
+
+# Config entries a loco announces to the controller on connecting, so it is known by road and number rather than by
+# address. tags is a comma separated list of groups the loco belongs to, e.g. "tags : yard, steam".
+identityEntries = [
+    'road-name',
+    'road-acronym',
+    'loco-number',
+    'loco-model',
+    'model-manufacturer',
+    'tags'
+]
+
+def encodeIdentity(config, sessionToken=None, frameChecks=None):
+    # "<entry> : <value>" lines like config.txt, UTF-8. A loco reconnecting presents the session token the controller
+    # gave it as a "session" line, so the controller can resume its session. frameChecks are the integrity checks
+    # the loco offers, as a "frame-checks" line of names.
+    lines = []
+    for entry in identityEntries:
+        if entry in config: lines.append(entry + ' : ' + config[entry])
+    if sessionToken is not None: lines.append('session : ' + str(sessionToken))
+    if frameChecks: lines.append('frame-checks : ' + ', '.join([integrity.checks[check] for check in frameChecks]))
+    return '\n'.join(lines).encode('utf-8')
+
+def decodeIdentity(payload):
+    identity = {}
+    for line in bytes(payload).decode('utf-8').split('\n'):
+        if ' : ' not in line: continue
+        entry, value = line.split(' : ', 1)
+        identity[entry] = value
+    return identity
+
+def identityName(identity):
+    # Stable name of a loco, e.g. "RF 0000"
+    return identity['road-acronym'] + ' ' + identity['loco-number']
+
+def identityTags(identity):
+    return [tag.strip() for tag in identity.get('tags', '').split(',') if len(tag.strip())]
+
+def identityFrameChecks(identity):
+    # Numbers of the frame checks the loco offers, checks this side doesn't know are left out
+    checks = []
+    for name in identity.get('frame-checks', '').split(','):
+        name = name.strip().upper()
+        if name in integrity.checks: checks.append(integrity.checks.index(name))
+    return checks
+
+
+def packetTypeNum(packetType):
+    if isinstance(packetType, int): return packetType
+    try: return packetTypeNums[packetType]
+    except (KeyError, TypeError): raise ValueError('Invalid packet type "{}"'.format(packetType))
+
+
+# Allocates conversation IDs and keeps track of open conversations. Controllers use even IDs and locomotives odd
+# ones, so both sides can start conversations without coordinating. Each open conversation carries a value (e.g.
+# the future waiting on the response) that is handed back when the conversation ends.
+class conversations():
+    def __init__(self, isLoco):
+        self.offset = 1 if isLoco else 0
+        self.counter = 0
+        self.open = {}
+
+    def __len__(self):
+        return len(self.open)
+
+    def __contains__(self, conversation):
+        return conversation in self.open
+
+    def start(self, value=None):
+        if len(self.open) >= maxConversations: raise RuntimeError('Too many open conversations')
+        while True:
+            conversation = self.counter * 2 + self.offset
+            self.counter = (self.counter + 1) % maxConversations
+            if conversation not in self.open: break
+        self.open[conversation] = value
+        return conversation
+
+    def oneShot(self):
+        # ID for a packet nothing answers (e.g. a pushed state), the conversation is over as soon as it starts so it
+        # is never opened
+        while True:
+            conversation = self.counter * 2 + self.offset
+            self.counter = (self.counter + 1) % maxConversations
+            if conversation not in self.open: return conversation
+
+    def get(self, conversation, default=None):
+        return self.open.get(conversation, default)
+
+    def end(self, conversation, default=None):
+        # Returns the value the conversation was started with (or default if it wasn't open)
+        return self.open.pop(conversation, default)
+
+
+# MicroPython allocates a slice object for every slice, so small payloads are copied byte by byte there. CPython
+# copies a slice faster.
+copyBytewise = sys.implementation.name == 'micropython'
+maxBytewise = 16
+
+# CPython's bytearray.find() scans for the next packet in C, MicroPython's bytearray has no find()
+findMarker = hasattr(bytearray, 'find')
+
+def copyInto(buffer, position, data, size):
+    # buffer[position:position + size] = data
+    for i in range(size): buffer[position + i] = data[i]
+
+
+def receiver(sock):
+    # The method to receive into a buffer with, recv_into() or readinto() on MicroPython sockets without it. Looked
+    # up once per socket, as MicroPython allocates a bound method each time hasattr() finds one.
+    return sock.recv_into if hasattr(sock, 'recv_into') else sock.readinto
+
+
+# MicroPython allocates a new memoryview for every slice, so views that are sliced over and over (packets and
+# payloads of the usual sizes) are made once and kept. Returns view[start:start + size].
+class viewCache():
+    def __init__(self, view, start=0, maxSize=64):
+        self.view = view
+        self.start = start
+        self.views = [None] * (maxSize + 1)
+
+    def get(self, size):
+        if size >= len(self.views): return self.view[self.start:self.start + size]
+        cached = self.views[size]
+        if cached is None:
+            cached = self.view[self.start:self.start + size]
+            self.views[size] = cached
+        return cached
+
+
+# Writes packets into a reusable buffer. The header prefix is written once, each call to encode() only fills in the
+# packet type, conversation ID, payload size and payload. The returned memoryview is only valid until the next call
+# to encode(). Encoding small packets doesn't allocate.
+class encoder():
+    def __init__(self, size=256):
+        self.buffer = bytearray(max(size, headerSize))
+        self.view = memoryview(self.buffer)
+        self.frames = viewCache(self.view)
+        self.buffer[0:3] = b'RF-'
+        self.frameCheck = integrity.NONE  # Trailer added to every packet, see railfi.integrity
+        self.checkSize = 0
+
+    def setFrameCheck(self, check):
+        integrity.prepare(check)
+        self.frameCheck = check
+        self.checkSize = integrity.checkSizes[check]
+
+    def encode(self, packetType, payload=b'', conversation=0):
+        packetType = packetTypeNum(packetType)
+        payloadSize = len(payload)
+        if payloadSize > maxPayloadSize: raise ValueError('Payload too long')
+
+        end = headerSize + payloadSize
+        if end + self.checkSize > len(self.buffer):
+            # Only happens for unusually large payloads, the buffer is kept at the new size afterwards
+            self.buffer = bytearray(end + self.checkSize)
+            self.view = memoryview(self.buffer)
+            self.frames = viewCache(self.view)
+            self.buffer[0:3] = b'RF-'
+
+        buffer = self.buffer
+        buffer[3] = packetType
+        buffer[4] = (conversation >> 24) & 0xff
+        buffer[5] = (conversation >> 16) & 0xff
+        buffer[6] = (conversation >> 8) & 0xff
+        buffer[7] = conversation & 0xff
+        buffer[8] = payloadSize >> 8
+        buffer[9] = payloadSize & 0xff
+        if copyBytewise and payloadSize <= maxBytewise: copyInto(buffer, headerSize, payload, payloadSize)
+        else: self.view[headerSize:end] = payload
+        if self.checkSize:
+            integrity.put(self.frameCheck, buffer, 0, end)
+            end += self.checkSize
+        return self.frames.get(end)
+
+
+# Incrementally decodes packets from a preallocated buffer. Received data is written directly into the free space
+# at the end of the buffer and packets are handed out as (packetType, conversation, payload) where the payload is a
+# memoryview into the buffer. Payload views are only valid until more data is written into the decoder, copy them (bytes())
+# if they need to be kept. Consumed data is reclaimed by moving the unconsumed tail to the front of the buffer,
+# which only ever copies the bytes of a partial packet. Receiving with recvFrom() and decoding with decode() doesn't
+# allocate as long as each receive ends on a packet boundary, which it does unless packets arrive faster than they
+# are handled.
+# Garbage in the stream is skipped to the next 'RF-' in one scan. A header claiming more than its packet type's limit in
+# payloadLimits (maxPayload for types not in it), or a packet failing the frame check, is rejected and the stream
+# searched again from the byte after its 'RF-', so a corrupt header can't swallow the packets behind it.
+class decoder():
+    def __init__(self, size=4096, maxPayload=maxLocoPayload, payloadLimits=None):
+        self.buffer = bytearray(max(size, headerSize))
+        self.view = memoryview(self.buffer)
+        self.payloads = viewCache(self.view, headerSize)   # Payloads of packets at the start of the buffer
+        self.start = 0     # First unconsumed byte
+        self.end = 0       # One past the last received byte
+        self.maxPayload = maxPayload
+        self.limits = [maxPayload] * 256    # Largest payload of each packet type
+        if payloadLimits is not None:
+            for packetType in payloadLimits: self.limits[packetType] = min(payloadLimits[packetType], maxPayload)
+        self.frameCheck = integrity.NONE  # Trailer every packet carries, see railfi.integrity
+        self.checkSize = 0
+        self.searching = False  # Looking for the next packet, the bytes searched so far were garbage
+        self.resyncs = 0   # Times the stream had to be searched for the next packet
+        self.discarded = 0 # Bytes thrown away while searching
+        self.rejected = 0  # Packets thrown away for an implausible size or failing the frame check
+        self.waiting = False    # decode() is waiting on the rest of the packet at the start of the buffer
+        self.conversation = 0   # Of the packet last returned by decode()
+        self.payload = None
+        self.socket = None      # Last socket received from, and its receiver()
+        self.receiveInto = None
+
+    def __len__(self):
+        return self.end - self.start
+
+    def clear(self):
+        # Throw away anything buffered, e.g. the rest of a packet from a connection that dropped
+        self.start = self.end = 0
+        self.searching = False
+        self.waiting = False
+        self.socket = self.receiveInto = None
+
+    def setFrameCheck(self, check):
+        # Packets buffered from here on must carry check's trailer
+        integrity.prepare(check)
+        self.frameCheck = check
+        self.checkSize = integrity.checkSizes[check]
+
+    def _reserve(self, size):
+        # Make room for at least <size> more bytes at the end of the buffer
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buffer) - self.end >= size:
+            return
+
+        pending = self.end - self.start
+        if self.start > 0:
+            self.view[0:pending] = self.view[self.start:self.end]
+            self.start = 0; self.end = pending
+        if len(self.buffer) - self.end < size:
+            newBuffer = bytearray(pending + size)
+            newBuffer[0:pending] = self.view[0:pending]
+            self.buffer = newBuffer
+            self.view = memoryview(newBuffer)
+            self.payloads = viewCache(self.view, headerSize)
+
+    def writable(self, size=1):
+        # Get a view of the free space at the end of the buffer, call commit() with the number of bytes written into it
+        self._reserve(size)
+        return self.view[self.end:]
+
+    def commit(self, numBytes):
+        self.end += numBytes
+
+    def feed(self, data):
+        numBytes = len(data)
+        self._reserve(numBytes)
+        self.view[self.end:self.end + numBytes] = data
+        self.end += numBytes
+
+    def recvFrom(self, sock):
+        # Receive directly into the buffer, returns the number of bytes received (0 if the peer closed the connection)
+        # Socket errors (including timeouts) are left for the caller to handle
+        if self.start == self.end:
+            # Nothing pending, so receive into the whole buffer rather than a slice of it
+            self.start = self.end = 0
+            target = self.buffer
+        else: target = self.writable(headerSize)
+        if sock is not self.socket:
+            self.socket = sock
+            self.receiveInto = receiver(sock)
+        numBytes = self.receiveInto(target)
+        if numBytes is None: numBytes = 0   # Non-blocking MicroPython sockets return None when no data is available
+        self.end += numBytes
+        return numBytes
+
+    def nextPacket(self):
+        # Decode the next complete packet, returns (packetType, conversation, payload) or None if none is buffered
+        packetType = self.decode()
+        if packetType < 0: return None
+        return packetType, self.conversation, self.payload
+
+    def decode(self):
+        # nextPacket() without allocating a tuple, returns the packet type (-1 if no complete packet is buffered) and
+        # leaves the conversation and payload in self.conversation and self.payload
+        buffer = self.buffer
+        self.waiting = False
+        while self.end - self.start >= headerSize:
+            start = self.start
+            if buffer[start] != 0x52 or buffer[start + 1] != 0x46 or buffer[start + 2] != 0x2d:     # b'RF-'
+                # Not the start of a packet, skip to the next one
+                if not self.searching: self.resyncs += 1; self.searching = True
+                self.start = self._findMarker(start + 1)
+                self.discarded += self.start - start
+                continue
+
+            payloadSize = (buffer[start + 8] << 8) | buffer[start + 9]
+            if payloadSize > self.limits[buffer[start + 3]]:
+                self.rejected += 1
+                self.discarded += 1
+                self.start = start + 1
+                continue
+            end = start + headerSize + payloadSize
+            if end + self.checkSize > self.end:
+                # Packet incomplete, make sure the whole packet will fit once it arrives
+                if end + self.checkSize - start > len(buffer): self._reserve(end + self.checkSize - self.end)
+                self.waiting = True
+                return -1
+            if self.checkSize:
+                if not integrity.verify(self.frameCheck, buffer, start, end):
+                    self.rejected += 1
+                    self.discarded += 1
+                    self.start = start + 1
+                    continue
+
+            self.start = end + self.checkSize
+            self.searching = False
+            self.conversation = (buffer[start + 4] << 24) | (buffer[start + 5] << 16) | (buffer[start + 6] << 8) | buffer[start + 7]
+            self.payload = self.payloads.get(payloadSize) if start == 0 else self.view[start + headerSize:end]
+            return buffer[start + 3]
+        return -1
+
+    def dropPartial(self):
+        # Reject the packet decode() is waiting on the rest of, which hasn't arrived in a while (see partialTimeout)
+        # and most likely had a corrupt header. The stream is searched again from the byte after its 'RF-'.
+        if not self.waiting: return
+        self.waiting = False
+        self.rejected += 1
+        self.discarded += 1
+        self.start += 1
+
+    def _findMarker(self, position):
+        # Position of the next 'RF-' from position on, or of the last 2 bytes (which may be the start of one) if
+        # there is none
+        buffer = self.buffer
+        last = self.end - 2
+        if findMarker:
+            found = buffer.find(b'RF-', position, self.end)
+            return found if found >= 0 else max(position, last)
+        while position < last:
+            if buffer[position] == 0x52 and buffer[position + 1] == 0x46 and buffer[position + 2] == 0x2d: return position
+            position += 1
+        return max(position, last)
+
+    def find(self, packetType):
+        # Number of packets buffered ahead of the first complete one of type <packetType>, -1 if there is none. Only
+        # reads headers, nothing is consumed. A packet still arriving may be a corrupt header claiming the packets
+        # after it. With a frame check the search carries on inside it, counting it as one packet ahead, but only
+        # packets passing the check count there. Without one, a packet can't be told from payload bytes that look
+        # like one, so the search stops at it.
+        buffer = self.buffer
+        position = self.start
+        numPackets = 0
+        incomplete = False  # Searching inside a packet that hasn't fully arrived
+        while self.end - position >= headerSize:
+            if buffer[position] != 0x52 or buffer[position + 1] != 0x46 or buffer[position + 2] != 0x2d:
+                position += 1
+                continue
+            payloadSize = (buffer[position + 8] << 8) | buffer[position + 9]
+            if payloadSize > self.limits[buffer[position + 3]]:
+                position += 1
+                continue
+            end = position + headerSize + payloadSize
+            if end + self.checkSize > self.end:
+                if not self.checkSize: return -1
+                if not incomplete: numPackets += 1
+                incomplete = True
+                position += 1
+                continue
+            if self.checkSize and (incomplete or buffer[position + 3] == packetType):
+                if not integrity.verify(self.frameCheck, buffer, position, end):
+                    position += 1
+                    continue
+            if buffer[position + 3] == packetType: return numPackets
+            numPackets += 1
+            position = end + self.checkSize
+        return -1
+
+    def packets(self, maxPackets=None):
+        # Yield every complete packet currently buffered
+        numPackets = 0
+        while maxPackets is None or numPackets < maxPackets:
+            packetType = self.decode()
+            if packetType < 0: return
+            numPackets += 1
+            yield packetType, self.conversation, self.payload
@@ -0,0 +1,5 @@
+# Headless RailFi controller, owns the traffic port listener, the loco sessions and the fleet registry
+from .session import locomotive
+from .server import trafficCop
+from .fleet import fleet
+from .core import controller, threadedController
@@ -0,0 +1,66 @@
+# RailFi controller daemon, run with python -m railfi.controller
+import argparse, asyncio, signal
+
+from .. import codec
+from .core import controller
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(prog='railfi.controller', description='Headless RailFi controller daemon')
+    parser.add_argument('-p', '--port', type=int, default=4000, help='traffic port to listen on (walks upward if taken)')
+    parser.add_argument('-r', '--max-write-rate', type=float, default=5, help='coalesced state writes per second per loco')
+    parser.add_argument('-s', '--status-interval', type=float, default=0, help='seconds between fleet status reports (0 to disable)')
+    parser.add_argument('-d', '--datagrams', action='store_true', help='send state writes as UDP datagrams to locos that support it')
+    parser.add_argument('-u', '--subscribe', type=int, metavar='MS', help='have every loco push its state, throttle changes at most every MS milliseconds')
+    parser.add_argument('-b', '--estop-broadcast', metavar='ADDR', help='also broadcast E_STOP over UDP to this address, e.g. 255.255.255.255')
+    parser.add_argument('-c', '--capture', metavar='FILE', help='capture every loco\'s traffic to FILE, for python -m railfi.replay')
+    parser.add_argument('-f', '--frame-check', choices=['crc16', 'crc32'], help='have locos that offer it add this check to every packet')
+    parser.add_argument('-t', '--heartbeat', type=int, metavar='MS', help='heartbeat every loco every MS milliseconds, locos that miss 3 stop')
+    return parser.parse_args()
+
+def printEvent(event, loco):
+    if event == 'state': print('Loco "{}" state: {}'.format(loco.name, loco.state))
+    elif event == 'link': print('Loco "{}" link {}'.format(loco.name, loco.linkHealth()))
+    else: print('Loco "{}" {}'.format(loco.name, event))
+
+async def printStatus(daemon, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print('===== {} locos connected ====='.format(len(daemon.fleet)))
+        for loco in daemon.fleet:
+            transport = 'TCP' if loco.datagram is None else 'datagrams, {} lost'.format(loco.datagramsLost)
+            print('{}: {} (writes: {} sent, {} coalesced, {})'.format(loco.name, loco.state, loco.writesSent, loco.writesCoalesced, transport))
+            if loco.heartbeatInterval:
+                health = loco.linkHealth()
+                rtt = 'not measured' if health['rtt'] is None else '{:.1f} ms'.format(health['rtt'] * 1000)
+                print('    link {}, round trip {}, {} of {} heartbeats answered'.format(health['state'], rtt, health['answered'], health['sent']))
+
+async def stopAll(daemon):
+    print('===== Emergency stop =====')
+    for name, result in (await daemon.stopAll()).items():
+        if isinstance(result, Exception): print('{}: FAILED {}'.format(name, repr(result)))
+        else: print('{}: stopped in {:.1f} ms'.format(name, result * 1000))
+
+async def main(args):
+    subscription = None
+    if args.subscribe is not None:
+        subscription = {field: 0 for field in codec.stateFields}
+        subscription['throttle'] = args.subscribe
+        subscription['speed'] = args.subscribe     # Changes every ramp step while the loco speeds up or slows down
+    daemon = controller(args.port, args.max_write_rate, args.estop_broadcast, args.datagrams, subscription, args.capture, args.frame_check, None if args.heartbeat is None else args.heartbeat / 1000)
+    daemon.addListener(printEvent)
+    port = await daemon.start()
+    print('RailFi controller listening on port {}'.format(port))
+    # kill -USR1 <pid> stops every loco
+    if hasattr(signal, 'SIGUSR1'):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, lambda: loop.create_task(stopAll(daemon)))
+    try:
+        if args.status_interval > 0: await printStatus(daemon, args.status_interval)
+        else: await asyncio.Event().wait()
+    finally:
+        await daemon.stop()
+
+if __name__ == '__main__':
+    try: asyncio.run(main(getArgs()))
+    except KeyboardInterrupt: print('RailFi controller stopped')
@@ -0,0 +1,302 @@
+import asyncio, random, socket, threading
+
+from .. import capture, codec, heartbeat, integrity, sequences
+
+from .fleet import fleet
+from .server import trafficCop
+
+
+# Headless RailFi controller: accepts locos, keeps the fleet registry and runs every loco session on one asyncio loop.
+# The coroutine API is for code running on that loop, threadedController wraps it for everything else.
+class controller():
+    def __init__(self, port=4000, maxWriteRate=5, broadcastAddr=None, datagrams=False, subscribe=None, capturePath=None, frameCheck=None, heartbeatInterval=None):
+        self.fleet = fleet()
+        self.trafficCop = trafficCop(self._newLoco, port)
+        # 'crc16' or 'crc32' to have every loco that offers it add the check to its packets, see railfi.integrity
+        if frameCheck is not None: self.trafficCop.frameCheck = integrity.checkNum(frameCheck)
+        self.maxWriteRate = maxWriteRate    # Coalesced writes per second per loco
+        self.broadcastAddr = broadcastAddr  # e.g. '255.255.255.255' to also broadcast E_STOP over UDP, None to not
+        self.stopId = random.getrandbits(32)    # Identifies each stopAll() to the locos, random so restarts don't reuse IDs
+        self.datagrams = datagrams          # Open the datagram transport with every loco that supports it
+        self.subscription = subscribe       # {field: minimum ms between pushes} to subscribe every loco to, None to not
+        self.listeners = []                 # listener(event, loco), events are 'connected', 'state', 'link' and 'disconnected'
+        self.resumeWindow = 60.0            # Seconds a dropped loco's session is kept for it to resume
+        self.dropped = {}                   # {name: locomotive} whose connection dropped within resumeWindow
+        self.capturePath = capturePath      # File to capture every loco's traffic to, see railfi.capture
+        self.capture = None
+        self.heartbeatInterval = heartbeatInterval  # Seconds between heartbeats both ways, e.g. 0.05, None to not heartbeat
+        self.heartbeatBudget = heartbeat.defaultBudget  # Missed heartbeats in a row before a loco's link is 'down'
+        self.loop = None
+
+    def addListener(self, listener):
+        # Listeners are called on the loop and must not block
+        self.listeners.append(listener)
+
+    def _emit(self, event, loco):
+        for listener in self.listeners:
+            try: listener(event, loco)
+            except Exception as error: print('Listener failed on "{}":'.format(event), repr(error))
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.capturePath is not None:
+            self.capture = capture.openRecorder(self.capturePath, 'controller')
+            self.trafficCop.capture = self.capture
+        return await self.trafficCop.start()
+
+    async def stop(self):
+        await self.trafficCop.stop()
+        for loco in self.fleet: loco.writer.close()
+        if self.capture is not None: self.capture.close()
+
+    def _newLoco(self, loco):
+        # The loco's previous session, either dropped or still open if the loco reconnected before the old connection
+        # was noticed as gone
+        currentTime = self.loop.time()
+        for name in [name for name in self.dropped if currentTime - self.dropped[name].dropTime > self.resumeWindow]: del self.dropped[name]
+        old = self.fleet.locos.get(loco.name) if loco.name in self.fleet else self.dropped.get(loco.name)
+        if old is not None and loco.presentedToken is not None and loco.presentedToken == old.sessionToken:
+            self.loop.create_task(self._resumeLoco(old, loco))
+            return
+
+        loco.acceptAnnounce(random.getrandbits(32))
+        loco.maxWriteRate = self.maxWriteRate
+        loco.stateListener = lambda loco: self._emit('state', loco)
+        loco.heartbeatInterval = self.heartbeatInterval
+        loco.heartbeat.budget = self.heartbeatBudget
+        loco.linkListener = lambda loco: self._emit('link', loco)
+        self.dropped.pop(loco.name, None)
+        replaced = self.fleet.add(loco)
+        if replaced is not None:
+            print('Loco "{}" reconnected without its session, closing its old connection'.format(loco.name))
+            replaced.close()
+        loco.runTask = self.loop.create_task(self._runLoco(loco))
+        if self.datagrams: self.loop.create_task(self._openDatagram(loco))
+        self._emit('connected', loco)
+        # Subscriptions are renewed, the loco doesn't remember them across a new session
+        subscription = self.subscription if old is None or old.subscribed is None else old.subscribed
+        if subscription is not None: self.loop.create_task(self._subscribe(loco, subscription))
+
+    async def _resumeLoco(self, session, loco):
+        if session.runTask is not None and not session.runTask.done():
+            session.writer.close()
+            await asyncio.gather(session.runTask, return_exceptions=True)
+        self.dropped.pop(session.name, None)
+        session.resume(loco)
+        if session.dropTime is not None: print('Loco "{}" resumed its session {:.0f} ms after it dropped'.format(session.name, (self.loop.time() - session.dropTime) * 1000))
+        session.dropTime = None
+        self.fleet.add(session)
+        session.runTask = self.loop.create_task(self._runLoco(session))
+        if session.datagramWanted: self.loop.create_task(self._openDatagram(session))
+        self._emit('connected', session)
+
+    async def _subscribe(self, loco, subscription):
+        try: await asyncio.wrap_future(loco.subscribe(**subscription))
+        except Exception as error: print('Loco "{}" did not subscribe:'.format(loco.name), repr(error))
+
+    async def _openDatagram(self, loco):
+        try:
+            if not await loco.openDatagram(): print('Loco "{}" does not support the datagram transport'.format(loco.name))
+        except Exception as error:
+            print('Loco "{}" datagram transport failed to open:'.format(loco.name), repr(error))
+
+    async def _runLoco(self, loco):
+        try: await loco.run()
+        finally:
+            loco.dropTime = self.loop.time()
+            # Kept for the loco to resume, unless a new session already took its place
+            if loco.sessionToken is not None and self.fleet.locos.get(loco.name) is loco: self.dropped[loco.name] = loco
+            self.fleet.remove(loco)
+            self._emit('disconnected', loco)
+
+    ## Commands ##
+    async def command(self, name, packetType, payload=b''):
+        # Send any packet and wait for the response, returns (packetType, payload)
+        return await self.fleet.get(name).request(packetType, payload)
+
+    async def setState(self, name, **fields):
+        # Coalesced state change, e.g. setState('RF 0000', throttle=50, direction=0), returns the resulting state
+        return await asyncio.wrap_future(self.fleet.get(name).setState(**fields))
+
+    async def getState(self, name):
+        return await asyncio.wrap_future(self.fleet.get(name).getState())
+
+    async def getStats(self, name):
+        # Histograms and counters kept by the loco, see railfi.stats.decodeStats()
+        return await asyncio.wrap_future(self.fleet.get(name).getStats())
+
+    async def resetStats(self, name):
+        await self.command(name, 'RESET_STATS')
+
+    async def getTrace(self, name):
+        # The loco's recent events, see railfi.trace.decodeTrace()
+        return await asyncio.wrap_future(self.fleet.get(name).getTrace())
+
+    ## Sequences ##
+    async def _sequenceCommand(self, name, packetType, payload=b''):
+        # Returns the ACKNOWLEDGE's payload, raises RuntimeError if the loco answers with an ERROR
+        responseType, response = await self.command(name, packetType, payload)
+        if responseType != codec.ACKNOWLEDGE:
+            error = codec.errorCodes[response[0]] if len(response) and response[0] < len(codec.errorCodes) else 'no reason given'
+            raise RuntimeError('Loco "{}" refused {} ({})'.format(name, packetType, error))
+        return response
+
+    async def uploadSequence(self, name, number, steps, save=False):
+        # steps is [(delay ms, action, a, b)], see railfi.sequences. Saved sequences survive the loco restarting, an
+        # empty sequence deletes it.
+        await self._sequenceCommand(name, 'UPLOAD_SEQUENCE', sequences.encodeUpload(number, steps, save))
+
+    async def runSequence(self, name, number, repeats=1):
+        # repeats=sequences.forever runs it until stopSequence() or an E_STOP
+        await self._sequenceCommand(name, 'RUN_SEQUENCE', sequences.encodeRun(number, repeats))
+
+    async def stopSequence(self, name):
+        await self._sequenceCommand(name, 'STOP_SEQUENCE')
+
+    async def getSequences(self, name):
+        # The sequences the loco has and the one it is running, see railfi.sequences.decodeStatus()
+        return sequences.decodeStatus(await self._sequenceCommand(name, 'GET_SEQUENCES'))
+
+    async def subscribeState(self, name, **intervals):
+        # Have the loco push changes, see locomotive.subscribe(). cachedState() stays current from then on.
+        return await asyncio.wrap_future(self.fleet.get(name).subscribe(**intervals))
+
+    async def openDatagram(self, name):
+        # Send this loco's writes as datagrams, returns False if the loco doesn't support it
+        return await self.fleet.get(name).openDatagram()
+
+    async def closeDatagram(self, name):
+        await self.fleet.get(name).closeDatagram()
+
+    async def stopAll(self):
+        # E_STOP every connected loco at once. Returns {name: seconds until the loco acknowledged, or the exception}.
+        loop = asyncio.get_running_loop()
+        startTime = loop.time()
+        self.stopId = (self.stopId + 1) % 2 ** 32
+        if self.broadcastAddr is not None: self.broadcastEStop(self.stopId)
+
+        async def stop(loco):
+            await asyncio.wrap_future(loco.eStop(self.stopId))
+            return loop.time() - startTime
+        locos = list(self.fleet)
+        results = await asyncio.gather(*[stop(loco) for loco in locos], return_exceptions=True)
+        return {locos[i].name: results[i] for i in range(len(locos))}
+
+    def broadcastEStop(self, stopId):
+        # Redundant path for stopAll(), reaches locos whose TCP connection is stuck. Locos listen on the traffic port number.
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.sendto(bytes(codec.encoder().encode(codec.E_STOP, stopId.to_bytes(4, 'big'))), (self.broadcastAddr, self.trafficCop.port))
+            sock.close()
+        except OSError as error:
+            print('E_STOP broadcast to {} failed:'.format(self.broadcastAddr), repr(error))
+
+    def cachedState(self, name):
+        # Last state reported by the loco, without asking it. Current as long as the loco is subscribed.
+        return dict(self.fleet.get(name).state)
+
+    def names(self, tag=None):
+        # Names of the connected locos, only those tagged <tag> if given
+        if tag is None: return self.fleet.names()
+        return [loco.name for loco in self.fleet.byTag(tag)]
+
+    def linkHealth(self, name):
+        # How the loco's heartbeats are doing, see locomotive.linkHealth()
+        return self.fleet.get(name).linkHealth()
+
+
+# Runs a controller's loop on a background thread. Every method is safe to call from any thread and returns a
+# concurrent.futures.Future, call .result() on it to use the API synchronously.
+class threadedController():
+    def __init__(self, *args, **kwargs):
+        self.controller = controller(*args, **kwargs)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name='railfi-controller', daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+        # Let the loco sessions clean up before closing the loop
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks: task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def start(self):
+        # Returns the port the controller is listening on once it has started
+        self.thread.start()
+        return self.call(self.controller.start()).result()
+
+    def stop(self):
+        if not self.thread.is_alive(): return
+        self.call(self.controller.stop()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def addListener(self, listener):
+        self.controller.addListener(listener)
+
+    def command(self, name, packetType, payload=b''):
+        return self.call(self.controller.command(name, packetType, payload))
+
+    def setState(self, name, **fields):
+        return self.call(self.controller.setState(name, **fields))
+
+    def getState(self, name):
+        return self.call(self.controller.getState(name))
+
+    def stopAll(self):
+        return self.call(self.controller.stopAll())
+
+    def subscribeState(self, name, **intervals):
+        return self.call(self.controller.subscribeState(name, **intervals))
+
+    def cachedState(self, name):
+        return self.call(self._cachedState(name))
+
+    async def _cachedState(self, name):
+        return self.controller.cachedState(name)
+
+    def openDatagram(self, name):
+        return self.call(self.controller.openDatagram(name))
+
+    def closeDatagram(self, name):
+        return self.call(self.controller.closeDatagram(name))
+
+    def getStats(self, name):
+        return self.call(self.controller.getStats(name))
+
+    def resetStats(self, name):
+        return self.call(self.controller.resetStats(name))
+
+    def getTrace(self, name):
+        return self.call(self.controller.getTrace(name))
+
+    def uploadSequence(self, name, number, steps, save=False):
+        return self.call(self.controller.uploadSequence(name, number, steps, save))
+
+    def runSequence(self, name, number, repeats=1):
+        return self.call(self.controller.runSequence(name, number, repeats))
+
+    def stopSequence(self, name):
+        return self.call(self.controller.stopSequence(name))
+
+    def getSequences(self, name):
+        return self.call(self.controller.getSequences(name))
+
+    def names(self, tag=None):
+        return self.call(self._names(tag))
+
+    async def _names(self, tag):
+        return self.controller.names(tag)
+
+    def linkHealth(self, name):
+        return self.call(self._linkHealth(name))
+
+    async def _linkHealth(self, name):
+        return self.controller.linkHealth(name)
@@ -0,0 +1,51 @@
+# Registry of connected locos, only touched from the controller's loop. Locos are indexed by name, which is their
+# announced identity (road acronym and loco number) so it survives reconnects, and by road and tag for group commands.
+class fleet():
+    def __init__(self):
+        self.locos = {}     # {name: locomotive}
+        self.roads = {}     # {road acronym: {name: locomotive}}
+        self.tags = {}      # {tag: {name: locomotive}}
+
+    def __len__(self):
+        return len(self.locos)
+
+    def __iter__(self):
+        return iter(list(self.locos.values()))
+
+    def __contains__(self, name):
+        return name in self.locos
+
+    def add(self, loco):
+        # Returns the session this one replaces (the loco reconnected before its old connection was noticed as gone),
+        # or None
+        old = self.locos.get(loco.name)
+        if old is not None: self._unindex(old)
+        self.locos[loco.name] = loco
+        if loco.road is not None: self.roads.setdefault(loco.road, {})[loco.name] = loco
+        for tag in loco.tags: self.tags.setdefault(tag, {})[loco.name] = loco
+        return old
+
+    def remove(self, loco):
+        if self.locos.get(loco.name) is not loco: return
+        del self.locos[loco.name]
+        self._unindex(loco)
+
+    def _unindex(self, loco):
+        for index, key in [(self.roads, loco.road)] + [(self.tags, tag) for tag in loco.tags]:
+            group = index.get(key)
+            if group is None or group.get(loco.name) is not loco: continue
+            del group[loco.name]
+            if not len(group): del index[key]
+
+    def get(self, name):
+        if name not in self.locos: raise KeyError('No loco named "{}"'.format(name))
+        return self.locos[name]
+
+    def names(self):
+        return list(self.locos.keys())
+
+    def byRoad(self, road):
+        return list(self.roads.get(road, {}).values())
+
+    def byTag(self, tag):
+        return list(self.tags.get(tag, {}).values())
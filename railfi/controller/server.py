@@ -0,0 +1,90 @@
+import asyncio
+
+from .. import integrity
+from .session import locomotive
+
+
+# Handles locos connecting on the traffic port, every connection is handshaken concurrently on the loop. Locos that
+# announce session support (0x0001) keep their session on the traffic connection, older firmware is redirected to a
+# dedicated port like before. Once connected, a loco is named by the identity it announces (ANNOUNCE).
+class trafficCop():
+    def __init__(self, newLoco, port=4000):
+        self.newLoco = newLoco      # Called on the loop with each new locomotive
+        self.port = port
+        self.server = None
+        self.handshakeTimeout = 5.0
+        self.announceTimeout = 1.0      # Firmware that doesn't announce itself is named after its address after this
+        self.legacyRedirects = True     # Set to False to turn away firmware that needs a dedicated port
+        self.capture = None             # railfi.capture.recorder every new loco's traffic is captured with
+        self.frameCheck = integrity.NONE    # Frame check to agree on with locos that offer it, see railfi.integrity
+
+    async def start(self):
+        # Walk up port numbers until one works
+        while True:
+            try:
+                self.server = await asyncio.start_server(self.handleConnection, port=self.port, backlog=512)
+                break
+            except OSError: self.port += 1
+        print('Traffic cop listening on port {}'.format(self.port))
+        return self.port
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handleConnection(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        try:
+            writer.write(b'\x00\x00')
+            await writer.drain()
+            firstContact = await asyncio.wait_for(reader.readexactly(2), self.handshakeTimeout)
+
+            if firstContact == b'\x00\x01':
+                # Port 0 tells the loco to stay on this connection, it confirms with 0x0000
+                writer.write(b'\x00\x00')
+                await writer.drain()
+                if await asyncio.wait_for(reader.readexactly(2), self.handshakeTimeout) != b'\x00\x00':
+                    raise ConnectionError('Bad confirmation')
+            elif firstContact == b'\x00\x00' and self.legacyRedirects:
+                reader, writer = await self.redirect(writer)
+            else:
+                raise ConnectionError('First contact incorrect')
+
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as error:
+            print('Loco {} failed to connect:'.format(addr), repr(error))
+            writer.close()
+            return
+
+        loco = locomotive(str(addr), reader, writer)
+        if self.capture is not None: loco.startCapture(self.capture)
+        loco.wantedFrameCheck = self.frameCheck
+        try: await loco.readAnnounce(self.announceTimeout)
+        except (OSError, asyncio.IncompleteReadError) as error:
+            print('Loco {} failed to connect:'.format(addr), repr(error))
+            writer.close()
+            return
+        print('Loco "{}" connected from {}'.format(loco.name, addr))
+        self.newLoco(loco)
+
+    async def redirect(self, writer):
+        # Compatibility mode, host a dedicated port for this loco alone and wait for it to reconnect there
+        connected = asyncio.get_running_loop().create_future()
+        def dedicatedConnection(reader, writer):
+            if connected.done(): writer.close()
+            else: connected.set_result((reader, writer))
+
+        dedicatedPort = self.port + 1   # Start at the first port after the traffic port
+        while True:
+            try:
+                dedicatedServer = await asyncio.start_server(dedicatedConnection, port=dedicatedPort, backlog=1)
+                break
+            except OSError: dedicatedPort += 1
+
+        try:
+            writer.write(int.to_bytes(dedicatedPort, 2, 'big'))
+            await writer.drain()
+            print('Directed new loco to port {}'.format(dedicatedPort))
+            writer.close()
+            return await asyncio.wait_for(connected, self.handshakeTimeout)
+        finally:
+            dedicatedServer.close()
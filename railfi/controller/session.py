@@ -0,0 +1,593 @@
+import asyncio, collections, socket
+from concurrent.futures import Future
+
+from .. import capture, codec, datagram, heartbeat, integrity, stats, subscriptions, trace
+
+def failFuture(future, error):
+    if future.done(): return
+    if future.running() or future.set_running_or_notify_cancel(): future.set_exception(error)
+
+
+# Controller end of a loco's datagram channel, see railfi.datagram
+class datagramEndpoint(asyncio.DatagramProtocol):
+    def __init__(self, loco):
+        self.loco = loco
+        self.channel = datagram.channel()
+        self.channel.setFrameCheck(loco.frameCheck)
+        self.transport = None
+        self.peer = None    # (addr, port) of the loco, datagrams from anywhere else are ignored
+        self.late = 0       # Responses that arrived after their datagram was resent
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.peer is None or addr[0] != self.peer[0] or addr[1] != self.peer[1]: return
+        if self.loco.capture is not None: self.loco.capture.record(capture.IN, self.loco.captureStream, memoryview(data)[datagram.sequenceSize:])
+        packet = self.channel.unwrap(data)
+        if packet is None: return
+        # A response to a datagram that was already given up on and resent is expected now and then
+        if packet[1] not in self.loco.conversations: self.late += 1
+        else: self.loco.responseReceived(packet[0], packet[1], bytes(packet[2]))
+
+    def send(self, packet):
+        self.transport.sendto(bytes(self.channel.wrap(packet)), self.peer)
+
+    def close(self):
+        self.transport.close()
+
+
+# Controller side of a connected loco. Lives on the controller's asyncio loop, but submit(), write() and setState()
+# may be called from any thread and return concurrent.futures.Future objects.
+class locomotive():
+    packetTypes = codec.packetTypes
+
+    def __init__(self, name, reader, writer):
+        self.name = name            # Announced identity, e.g. "RF 0000", or the address for firmware that doesn't announce
+        self.identity = {}          # Config entries the loco announced, see codec.identityEntries
+        self.road = None
+        self.tags = []
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.encoder = codec.encoder()
+        self.decoder = codec.decoder(maxPayload=codec.maxLocoPayload, payloadLimits=codec.locoPayloads)
+        self.responseTimeout = 5.0
+
+        # Commands waiting to be sent by the I/O worker, as (packetType, payload, future)
+        self.outbox = asyncio.Queue()
+        self.connected = True
+        # Commands sent and waiting on a response, {conversation: (future, timeout handle)}
+        self.conversations = codec.conversations(isLoco=False)
+
+        # Latest-value-wins writes, {key: [commands, futures]}, only the newest commands for each key are ever sent
+        self.pendingWrites = {}
+        self.writeReady = asyncio.Event()
+        self.maxWriteRate = 5       # Writes per second
+        self.writesRequested = 0
+        self.writesSent = 0
+        self.writesCoalesced = 0
+
+        # State as last reported by the loco (kept current by pushes once subscribed), and the state requested with
+        # setState() (merged, not yet confirmed)
+        self.state = {}
+        self.targetState = {}
+        self.subscribed = None      # {field: minimum ms between pushes} as last sent with subscribe()
+        self.pushesReceived = 0
+        self.stateListener = None   # stateListener(loco) is called on the loop whenever self.state changes
+        self.stats = None   # Last stats reported by the loco, see stats.decodeStats()
+
+        # Session resumption, a loco that reconnects presenting sessionToken takes this session back over
+        self.sessionToken = None
+        self.presentedToken = None      # Token the loco announced with, None if it started afresh
+        self.announceConversation = None
+        self.runTask = None
+        self.dropTime = None            # loop.time() when the connection dropped
+        self.resumes = 0
+
+        # Datagram transport for writes, see openDatagram()
+        self.datagram = None            # datagramEndpoint while the channel is open
+        self.datagramWanted = False     # Reopen the channel after an E_STOP closes it
+        self.datagramInFlight = None    # Conversation of the datagram waiting on a response
+        self.datagramTimeout = 0.25     # Seconds before a datagram counts as lost
+        self.datagramRetries = 2        # Resends before a write falls back to TCP
+        self.datagramsLost = 0
+
+        # Traffic capture, see startCapture()
+        self.capture = None
+        self.captureStream = None
+
+        # Heartbeats, see runHeartbeat()
+        self.heartbeatInterval = None   # Seconds between heartbeats, None to not heartbeat
+        self.heartbeat = heartbeat.heartbeat()
+        self.linkState = heartbeat.UP
+        self.heartbeatsSent = collections.deque(maxlen=64)  # Conversations, so late answers to missed ones are dropped quietly
+        self.linkListener = None    # linkListener(loco) is called on the loop whenever self.linkState changes
+
+        # Frame checks, agreed on in acceptAnnounce(), see railfi.integrity
+        self.wantedFrameCheck = integrity.NONE  # Check to use with locos that offer it
+        self.offeredFrameChecks = []    # Checks the loco announced it supports
+        self.frameCheck = integrity.NONE
+
+    def startCapture(self, recorder):
+        # Record everything sent to and received from the loco with recorder (a railfi.capture.recorder)
+        self.capture = recorder
+        self.captureStream = recorder.stream(self.name)
+
+    def setFrameCheck(self, check):
+        # Every packet from here on carries check's trailer, both ways and on both transports
+        self.frameCheck = check
+        self.encoder.setFrameCheck(check)
+        self.decoder.setFrameCheck(check)
+        if self.datagram is not None: self.datagram.channel.setFrameCheck(check)
+        if self.capture is not None: self.capture.record(capture.CHECK, self.captureStream, bytes([check]))
+
+    def genPacket(self, packetType, payload, conversation):
+        # The returned packet is only valid until the next call to genPacket(). Every packet made is sent, so this is
+        # where sent packets are captured.
+        packet = self.encoder.encode(packetType, payload, conversation)
+        if self.capture is not None: self.capture.record(capture.OUT, self.captureStream, packet)
+        return packet
+
+    ## Commands ##
+    def submit(self, packetType, payload=b''):
+        # Queue a command for the I/O worker, returns a Future for the response packet (packetType, payload)
+        future = Future()
+        self.loop.call_soon_threadsafe(self._enqueue, packetType, payload, future)
+        return future
+
+    def _enqueue(self, packetType, payload, future):
+        # Runs on the loop, so it can't race with the worker shutting down
+        if self.connected: self.outbox.put_nowait((packetType, payload, future))
+        else: failFuture(future, ConnectionError('Loco "{}" is not connected'.format(self.name)))
+
+    async def request(self, packetType, payload=b''):
+        return await asyncio.wrap_future(self.submit(packetType, payload))
+
+    def write(self, key, commands):
+        # Queue a write (a list of (packetType, payload) sent back to back, or a function returning one when the write
+        # is sent) that replaces any unsent write with the same key. Returns a Future for the response to the last
+        # command that was sent.
+        future = Future()
+        self.loop.call_soon_threadsafe(self._queueWrite, key, commands, future)
+        return future
+
+    def _queueWrite(self, key, commands, future):
+        if not self.connected:
+            failFuture(future, ConnectionError('Loco "{}" is not connected'.format(self.name)))
+            return
+
+        self.writesRequested += 1
+        if key in self.pendingWrites:
+            self.writesCoalesced += 1
+            pendingWrite = self.pendingWrites[key]
+            pendingWrite[0] = commands
+            pendingWrite[1].append(future)
+        else:
+            self.pendingWrites[key] = [commands, [future]]
+        self.writeReady.set()
+
+    def setState(self, **fields):
+        # Coalesced SET_STATE, fields are merged with earlier unsent ones so nothing set is lost. Returns a Future
+        # for the state reported back by the loco.
+        future = Future()
+        self.loop.call_soon_threadsafe(self._setState, fields, future)
+        return future
+
+    def _setState(self, fields, future):
+        self.targetState.update(fields)
+        stateFuture = Future()
+        self._queueWrite('state', lambda: [('SET_STATE', codec.encodeState(self.targetState))], stateFuture)
+        stateFuture.add_done_callback(lambda done: self._stateReceived(done, future))
+
+    def getState(self):
+        # Returns a Future for the state reported by the loco
+        future = Future()
+        self.submit('GET_STATE').add_done_callback(lambda done: self._stateReceived(done, future))
+        return future
+
+    def _stateReceived(self, responseFuture, future):
+        if responseFuture.exception() is not None:
+            failFuture(future, responseFuture.exception())
+            return
+        packetType, payload = responseFuture.result()
+        if packetType != codec.ACKNOWLEDGE:
+            failFuture(future, RuntimeError('Loco "{}" refused the command, error {}'.format(self.name, payload[0] if len(payload) else None)))
+            return
+        try: state = codec.decodeState(payload)
+        except IndexError as error:
+            failFuture(future, error)
+            return
+        self.updateState(state)
+        if future.set_running_or_notify_cancel(): future.set_result(state)
+
+    def updateState(self, state):
+        self.state.update(state)
+        if self.stateListener is not None: self.stateListener(self)
+
+    def subscribe(self, **intervals):
+        # Have the loco push changes to the given fields, e.g. subscribe(throttle=100, error=0) pushes throttle changes
+        # at most every 100 ms and error changes right away. No fields unsubscribes. Returns a Future for the state.
+        future = Future()
+        self.subscribed = intervals
+        self.submit('SUBSCRIBE', subscriptions.encodeSubscribe(intervals)).add_done_callback(lambda done: self._stateReceived(done, future))
+        return future
+
+    def eStop(self, stopId=None):
+        # Stop the loco ahead of everything else queued for it, returns a Future for the response. stopId ties this
+        # E_STOP to a broadcast one, see controller.stopAll().
+        future = Future()
+        self.loop.call_soon_threadsafe(self._eStop, stopId, future)
+        return future
+
+    def _eStop(self, stopId, future):
+        if not self.connected:
+            failFuture(future, ConnectionError('Loco "{}" is not connected'.format(self.name)))
+            return
+        preempted = RuntimeError('Loco "{}" was emergency stopped'.format(self.name))
+
+        # Nothing still waiting here may set the motor running again. The coalesced state write stays, it now
+        # carries a throttle of 0.
+        self.targetState['throttle'] = 0
+        if self.datagramInFlight is not None:
+            pending = self.conversations.end(self.datagramInFlight)
+            self.datagramInFlight = None
+            if pending is not None:
+                pending[1].cancel()
+                failFuture(pending[0], preempted)
+        # The loco closes the datagram channel when it stops, so datagrams still on their way are never applied
+        if self.datagram is not None:
+            self.datagram.close()
+            self.datagram = None
+            if self.datagramWanted: future.add_done_callback(lambda done: self.loop.create_task(self.reopenDatagram()))
+        for key in list(self.pendingWrites.keys()):
+            if key == 'state': continue
+            for pendingFuture in self.pendingWrites.pop(key)[1]: failFuture(pendingFuture, preempted)
+        keep = []
+        while not self.outbox.empty():
+            command = self.outbox.get_nowait()
+            if command is not None and codec.packetTypeNum(command[0]) in codec.preemptibleTypes: failFuture(command[2], preempted)
+            else: keep.append(command)
+        for command in keep: self.outbox.put_nowait(command)
+
+        # Written straight to the socket rather than queued, the loco stops before handling anything sent before it
+        if not future.set_running_or_notify_cancel(): return
+        try:
+            conversation = self.conversations.start()
+            self.conversations.open[conversation] = (future, self.loop.call_later(self.responseTimeout, self.expire, conversation))
+            payload = b'' if stopId is None else stopId.to_bytes(4, 'big')
+            self.writer.write(bytes(self.genPacket(codec.E_STOP, payload, conversation)))
+        except Exception as error:
+            failFuture(future, error)
+
+    ## Datagram transport ##
+    async def openDatagram(self):
+        # Ask the loco to take writes as datagrams from now on, returns True if it agreed. Firmware without the
+        # datagram transport answers ERROR and the loco stays on TCP alone.
+        self.datagramWanted = True
+        if self.datagram is not None: return True
+        peer = self.writer.get_extra_info('peername')
+        if peer is None or ':' in peer[0]: return False     # Locos only speak IPv4
+        transport, endpoint = await self.loop.create_datagram_endpoint(lambda: datagramEndpoint(self), local_addr=('0.0.0.0', 0), family=socket.AF_INET)
+        try:
+            packetType, payload = await self.request('OPEN_DATAGRAM', int.to_bytes(transport.get_extra_info('sockname')[1], 2, 'big'))
+        except BaseException:
+            transport.close()
+            raise
+        if packetType != codec.ACKNOWLEDGE or len(payload) < 2:
+            transport.close()
+            self.datagramWanted = False
+            return False
+        endpoint.peer = (peer[0], int.from_bytes(payload[0:2], 'big'))
+        if self.datagram is not None: self.datagram.close()
+        self.datagram = endpoint
+        return True
+
+    async def reopenDatagram(self):
+        if not self.connected or not self.datagramWanted: return
+        try: await self.openDatagram()
+        except Exception as error: print('Loco "{}" datagram transport not reopened:'.format(self.name), repr(error))
+
+    async def closeDatagram(self):
+        # Back to TCP alone
+        self.datagramWanted = False
+        if self.datagram is None: return
+        self.datagram.close()
+        self.datagram = None
+        await self.request('OPEN_DATAGRAM', b'\x00\x00')
+
+    async def writeDatagrams(self, commands):
+        # Sends commands as datagrams one at a time, returns the response to the last one. A datagram without a
+        # response in datagramTimeout is sent again (with a new sequence number, so the loco never applies both),
+        # after datagramRetries the command goes over TCP instead.
+        result = None
+        for packetType, payload in commands:
+            result = None
+            for attempt in range(self.datagramRetries + 1):
+                if self.datagram is None or not self.connected: break
+                future = Future()
+                future.set_running_or_notify_cancel()
+                conversation = self.conversations.start()
+                self.conversations.open[conversation] = (future, self.loop.call_later(self.datagramTimeout, self.expire, conversation))
+                self.datagramInFlight = conversation
+                self.datagram.send(self.genPacket(packetType, payload, conversation))
+                try: result = await asyncio.wrap_future(future)
+                except TimeoutError:
+                    self.datagramsLost += 1
+                    continue
+                finally:
+                    if self.datagramInFlight == conversation: self.datagramInFlight = None
+                break
+            if result is None: result = await self.request(packetType, payload)
+        return result
+
+    def getStats(self):
+        # Returns a Future for the loco's stats as decoded by stats.decodeStats()
+        future = Future()
+        self.submit('GET_STATS').add_done_callback(lambda done: self._statsReceived(done, future))
+        return future
+
+    def _statsReceived(self, responseFuture, future):
+        if responseFuture.exception() is not None:
+            failFuture(future, responseFuture.exception())
+            return
+        packetType, payload = responseFuture.result()
+        if packetType != codec.packetTypeNum('ACKNOWLEDGE'):
+            failFuture(future, RuntimeError('Loco "{}" does not report stats'.format(self.name)))
+            return
+        try: self.stats = stats.decodeStats(payload)
+        except (ValueError, IndexError) as error:
+            failFuture(future, error)
+            return
+        if future.set_running_or_notify_cancel(): future.set_result(self.stats)
+
+    def getTrace(self):
+        # Returns a Future for the loco's trace ring as decoded by trace.decodeTrace(), oldest record first
+        future = Future()
+        self.submit('GET_TRACE').add_done_callback(lambda done: self._traceReceived(done, future))
+        return future
+
+    def _traceReceived(self, responseFuture, future):
+        if responseFuture.exception() is not None:
+            failFuture(future, responseFuture.exception())
+            return
+        packetType, payload = responseFuture.result()
+        if packetType != codec.packetTypeNum('ACKNOWLEDGE'):
+            failFuture(future, RuntimeError('Loco "{}" does not keep a trace'.format(self.name)))
+            return
+        try: records = trace.decodeTrace(payload)
+        except (ValueError, IndexError) as error:
+            failFuture(future, error)
+            return
+        if future.set_running_or_notify_cancel(): future.set_result(records)
+
+    ## I/O ##
+    async def runWrites(self):
+        # Sends pending writes one at a time, no faster than maxWriteRate. Writes queued while one is in flight
+        # collapse into the newest value, which is always sent eventually.
+        loop = asyncio.get_running_loop()
+        lastWriteTime = loop.time() - 1
+        while self.connected:
+            await self.writeReady.wait()
+            self.writeReady.clear()
+
+            while len(self.pendingWrites):
+                await asyncio.sleep(max(0, lastWriteTime + 1 / self.maxWriteRate - loop.time()))
+                key = next(iter(self.pendingWrites))
+                commands, futures = self.pendingWrites.pop(key)
+                if callable(commands): commands = commands()
+                lastWriteTime = loop.time()
+
+                result = error = None
+                try:
+                    if self.datagram is not None and all(codec.packetTypeNum(command[0]) in datagram.datagramTypes for command in commands):
+                        result = await self.writeDatagrams(commands)
+                    else:
+                        # The loco handles packets in order, so the commands are pipelined rather than sent one by one
+                        commandFutures = []
+                        for packetType, payload in commands:
+                            commandFutures.append(Future())
+                            self.outbox.put_nowait((packetType, payload, commandFutures[-1]))
+                        result = (await asyncio.gather(*[asyncio.wrap_future(future) for future in commandFutures]))[-1]
+                    self.writesSent += 1
+                except asyncio.CancelledError:
+                    for future in futures: failFuture(future, ConnectionError('Loco "{}" disconnected'.format(self.name)))
+                    raise
+                except Exception as exception:
+                    error = exception
+
+                for future in futures:
+                    if not future.set_running_or_notify_cancel(): continue
+                    if error is None: future.set_result(result)
+                    else: future.set_exception(error)
+
+    async def readAnnounce(self, timeout):
+        # Wait for the loco to announce itself, returns False if it didn't (older firmware) and keeps the address as name
+        try: packetType, conversation, payload = await asyncio.wait_for(self.recvPacket(self.reader), timeout)
+        except asyncio.TimeoutError: return False
+        if packetType != codec.ANNOUNCE:
+            print('Loco "{}" sent packet type {} before announcing itself, dropped'.format(self.name, packetType))
+            return False
+        try:
+            identity = codec.decodeIdentity(payload)
+            name = codec.identityName(identity)
+        except (UnicodeError, KeyError):
+            self.writer.write(bytes(self.genPacket(codec.ERROR, bytes([codec.HANDLER_FAILED]), conversation)))
+            return False
+        try: self.presentedToken = int(identity.pop('session')) if 'session' in identity else None
+        except ValueError: self.presentedToken = None
+        self.offeredFrameChecks = codec.identityFrameChecks(identity)
+        identity.pop('frame-checks', None)
+        self.identity = identity
+        self.name = name
+        if self.capture is not None: self.capture.rename(self.captureStream, name)
+        self.road = identity['road-acronym']
+        self.tags = codec.identityTags(identity)
+        self.announceConversation = conversation    # Answered by acceptAnnounce() once the controller picked a session
+        return True
+
+    def acceptAnnounce(self, token):
+        # The ACKNOWLEDGE carries the session token, firmware that doesn't resume sessions ignores it. A loco offering
+        # frame checks is told which one to use, 0 for none, and uses it for everything after the ACKNOWLEDGE.
+        self.sessionToken = token
+        if self.announceConversation is None: return
+        check = self.wantedFrameCheck if self.wantedFrameCheck in self.offeredFrameChecks else integrity.NONE
+        payload = token.to_bytes(4, 'big') + (bytes([check]) if len(self.offeredFrameChecks) else b'')
+        # The loco has gone back to no check to announce itself, even when resuming a session that had one
+        if self.frameCheck != integrity.NONE: self.setFrameCheck(integrity.NONE)
+        self.writer.write(bytes(self.genPacket(codec.ACKNOWLEDGE, payload, self.announceConversation)))
+        self.announceConversation = None
+        if check != integrity.NONE: self.setFrameCheck(check)
+
+    def resume(self, other):
+        # Take over the connection of other, a new session the loco reconnected with presenting this session's token.
+        # State, subscriptions, settings and conversation counters carry on. Anything that was in flight when the
+        # connection dropped has already failed.
+        self.reader, self.writer, self.decoder = other.reader, other.writer, other.decoder
+        # The new connection goes on being captured to its own stream, which has seen its handshake and ANNOUNCE
+        self.capture, self.captureStream = other.capture, other.captureStream
+        self.identity, self.road, self.tags = other.identity, other.road, other.tags
+        self.offeredFrameChecks = other.offeredFrameChecks
+        self.outbox = asyncio.Queue()
+        self.writeReady = asyncio.Event()
+        self.connected = True
+        self.resumes += 1
+        self.announceConversation = other.announceConversation
+        self.acceptAnnounce(self.sessionToken)
+
+    async def recvPacket(self, reader):
+        # Returns the next packet as (packetType, conversation, payload), the payload is copied out of the receive buffer
+        while True:
+            packet = self.decoder.nextPacket()
+            if packet is not None: return packet[0], packet[1], bytes(packet[2])
+            if self.decoder.waiting:
+                # The rest of a packet that doesn't arrive in time most likely never will, its header was corrupt
+                try: data = await asyncio.wait_for(reader.read(4096), codec.partialTimeout / 1000)
+                except asyncio.TimeoutError:
+                    self.decoder.dropPartial()
+                    continue
+            else: data = await reader.read(4096)
+            if not data: raise ConnectionError('Loco "{}" closed the connection'.format(self.name))
+            if self.capture is not None: self.capture.record(capture.IN, self.captureStream, data)
+            self.decoder.feed(data)
+
+    def expire(self, conversation):
+        # No response in time, a late response will find the conversation closed and be dropped
+        pending = self.conversations.end(conversation)
+        if pending is not None: failFuture(pending[0], TimeoutError('Loco "{}" did not respond in time'.format(self.name)))
+
+    def responseReceived(self, packetType, conversation, payload):
+        # Matches responses to open conversations by conversation ID, so they may arrive in any order and by either transport
+        if packetType == codec.HEARTBEAT:
+            # The loco checking on the link, answered straight away
+            self.writer.write(bytes(self.genPacket(codec.ACKNOWLEDGE, b'', conversation)))
+            return
+        if self.heartbeat.response(conversation, stats.ticksUs()):
+            if packetType == codec.ERROR:
+                print('Loco "{}" does not support heartbeats'.format(self.name))
+                self.heartbeatInterval = None
+            self.setLinkState(self.heartbeat.state())
+            return
+        if packetType == codec.STATE_CHANGED:
+            # Pushed by the loco, not a response to anything
+            self.pushesReceived += 1
+            try: self.updateState(codec.decodeState(payload))
+            except IndexError: print('Loco "{}" pushed a malformed state'.format(self.name))
+            return
+        pending = self.conversations.end(conversation)
+        if pending is None:
+            if conversation in self.heartbeatsSent: return
+            print('Loco "{}" sent a packet for unknown conversation {}'.format(self.name, conversation))
+            return
+        future, timeout = pending
+        timeout.cancel()
+        if not future.done(): future.set_result((packetType, payload))
+
+    async def runReceive(self, reader):
+        try:
+            while True: self.responseReceived(*(await self.recvPacket(reader)))
+        except OSError as error:
+            print('Loco "{}" receive failed:'.format(self.name), repr(error))
+        finally:
+            # Wake the sender so it notices the connection is gone
+            self.connected = False
+            self.outbox.put_nowait(None)
+
+    def setLinkState(self, state):
+        if state == self.linkState: return
+        self.linkState = state
+        if self.linkListener is not None: self.linkListener(self)
+
+    def linkHealth(self):
+        # {'state': 'up', 'degraded' or 'down', 'rtt' and 'timeout': smoothed round trip time and heartbeat timeout
+        # in seconds (rtt None until measured), 'missed': heartbeats missed in a row, 'sent', 'answered'}
+        return {
+            'state': heartbeat.linkStates[self.linkState],
+            'rtt': None if self.heartbeat.srtt is None else self.heartbeat.srtt / 1000000,
+            'timeout': self.heartbeat.timeout / 1000000,
+            'missed': self.heartbeat.missed,
+            'sent': self.heartbeat.sent,
+            'answered': self.heartbeat.answered
+        }
+
+    async def runHeartbeat(self):
+        # Heartbeats the loco every heartbeatInterval, ahead of any queued commands. The payload tells the loco to
+        # heartbeat back at the same interval. A heartbeat is only sent once the last one was answered or timed out.
+        payload = heartbeat.encodeHeartbeat(int(self.heartbeatInterval * 1000))
+        self.heartbeat.reset()
+        self.setLinkState(heartbeat.UP)
+        while self.heartbeatInterval:
+            currentTime = stats.ticksUs()
+            if self.heartbeat.tick(currentTime) != heartbeat.WAIT:
+                conversation = self.conversations.oneShot()
+                self.heartbeat.sending(conversation, currentTime)
+                self.heartbeatsSent.append(conversation)
+                self.writer.write(bytes(self.genPacket(codec.HEARTBEAT, payload, conversation)))
+            self.setLinkState(self.heartbeat.state())
+            await asyncio.sleep(self.heartbeatInterval)
+
+    async def run(self):
+        # I/O worker, sends queued commands as soon as they arrive without waiting for earlier responses. Returns
+        # once the connection is gone.
+        loop = asyncio.get_running_loop()
+        reader, writer = self.reader, self.writer
+        tasks = [loop.create_task(self.runReceive(reader)), loop.create_task(self.runWrites())]
+        if self.heartbeatInterval: tasks.append(loop.create_task(self.runHeartbeat()))
+        try:
+            while self.connected:
+                command = await self.outbox.get()
+                if command is None: break
+                packetType, payload, future = command
+                if not future.set_running_or_notify_cancel(): continue
+                try:
+                    conversation = self.conversations.start()
+                    self.conversations.open[conversation] = (future, loop.call_later(self.responseTimeout, self.expire, conversation))
+                    writer.write(bytes(self.genPacket(packetType, payload, conversation)))
+                    await writer.drain()
+                except ConnectionError as error:
+                    failFuture(future, error)
+                    break
+                except Exception as error:
+                    failFuture(future, error)
+        finally:
+            # Fail anything queued or waiting on a response so nobody waits on a dead loco
+            self.connected = False
+            for task in tasks: task.cancel()
+            if self.datagram is not None:
+                self.datagram.close()
+                self.datagram = None
+            error = ConnectionError('Loco "{}" disconnected'.format(self.name))
+            for future, timeout in list(self.conversations.open.values()):
+                timeout.cancel()
+                failFuture(future, error)
+            self.conversations.open.clear()
+            for commands, futures in self.pendingWrites.values():
+                for future in futures: failFuture(future, error)
+            self.pendingWrites.clear()
+            while not self.outbox.empty():
+                command = self.outbox.get_nowait()
+                if command is not None: failFuture(command[2], error)
+            writer.close()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
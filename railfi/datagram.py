@@ -0,0 +1,110 @@
+# Datagram transport for control traffic where only the newest value matters, negotiated per loco with OPEN_DATAGRAM
+# (see docs/protocol.md). Each datagram is a sequence number followed by one RF- packet. A datagram older than the
+# newest one already received is stale and is dropped on arrival rather than applied late.
+# Written to run unmodified on both MicroPython and CPython.
+from . import codec, integrity
+
+sequenceSize = 2    # uint16, wraps around
+sequencePeriod = 2 ** 16
+
+# Packet types a controller may send as datagrams, losing one only delays the state until the next write
+datagramTypes = (codec.SET_THROTTLE, codec.SET_STATE)
+
+
+def isNewer(sequence, last):
+    # Serial number arithmetic, so sequence numbers can wrap around
+    difference = (sequence - last) % sequencePeriod
+    return 0 < difference < sequencePeriod // 2
+
+
+# One side of a datagram channel. Keeps the sequence numbers for both directions and buffers allocated once, so
+# sending with wrap() and receiving with receive() don't allocate.
+class channel():
+    def __init__(self, size=256):
+        self.sendBuffer = bytearray(sequenceSize + max(size, codec.headerSize))
+        self.sendView = memoryview(self.sendBuffer)
+        self.sendFrames = codec.viewCache(self.sendView)
+        self.receiveBuffer = bytearray(sequenceSize + max(size, codec.headerSize))
+        self.receiveView = memoryview(self.receiveBuffer)
+        self.receivePayloads = codec.viewCache(self.receiveView, sequenceSize + codec.headerSize)
+        self.conversation = 0   # Of the packet last returned by receive()
+        self.payload = None
+        self.socket = None      # Last socket received from, and its codec.receiver()
+        self.receiveInto = None
+        self.frameCheck = integrity.NONE  # Frame check the packets carry, the same as on the connection
+        self.checkSize = 0
+        self.reset()
+
+    def setFrameCheck(self, check):
+        # Packets passed to wrap() already carry the trailer, received ones are checked
+        integrity.prepare(check)
+        self.frameCheck = check
+        self.checkSize = integrity.checkSizes[check]
+
+    def reset(self):
+        # A new channel starts both sequences over
+        self.nextSequence = 0
+        self.lastSequence = None    # Newest sequence number received
+        self.sent = 0
+        self.received = 0
+        self.stale = 0              # Datagrams dropped for arriving after a newer one
+        self.malformed = 0
+
+    def wrap(self, packet):
+        # Returns the datagram carrying packet, only valid until the next call to wrap()
+        end = sequenceSize + len(packet)
+        if end > len(self.sendBuffer):
+            self.sendBuffer = bytearray(end)
+            self.sendView = memoryview(self.sendBuffer)
+            self.sendFrames = codec.viewCache(self.sendView)
+        sequence = self.nextSequence
+        self.nextSequence = (sequence + 1) % sequencePeriod
+        self.sendBuffer[0] = sequence >> 8
+        self.sendBuffer[1] = sequence & 0xff
+        if codec.copyBytewise and len(packet) <= codec.headerSize + codec.maxBytewise: codec.copyInto(self.sendBuffer, sequenceSize, packet, len(packet))
+        else: self.sendView[sequenceSize:end] = packet
+        self.sent += 1
+        return self.sendFrames.get(end)
+
+    def check(self, datagram, size):
+        # Returns the packet type of the first <size> bytes of datagram, or -1 if the datagram is malformed or stale.
+        # The conversation is left in self.conversation.
+        if size < sequenceSize + codec.headerSize or datagram[2] != 0x52 or datagram[3] != 0x46 or datagram[4] != 0x2d:   # b'RF-'
+            self.malformed += 1
+            return -1
+        if sequenceSize + codec.headerSize + ((datagram[10] << 8) | datagram[11]) + self.checkSize != size:
+            self.malformed += 1
+            return -1
+        if self.checkSize and not integrity.verify(self.frameCheck, datagram, sequenceSize, size - self.checkSize):
+            self.malformed += 1
+            return -1
+
+        sequence = (datagram[0] << 8) | datagram[1]
+        if self.lastSequence is not None and not isNewer(sequence, self.lastSequence):
+            self.stale += 1
+            return -1
+        self.lastSequence = sequence
+        self.received += 1
+        self.conversation = (datagram[6] << 24) | (datagram[7] << 16) | (datagram[8] << 8) | datagram[9]
+        return datagram[5]
+
+    def unwrap(self, datagram):
+        # Returns (packetType, conversation, payload) or None if the datagram is malformed or stale. The payload is a
+        # view into datagram.
+        packetType = self.check(datagram, len(datagram))
+        if packetType < 0: return None
+        if not isinstance(datagram, memoryview): datagram = memoryview(datagram)
+        return packetType, self.conversation, datagram[sequenceSize + codec.headerSize:len(datagram) - self.checkSize]
+
+    def receive(self, sock):
+        # Receive one datagram into the receive buffer, returns its packet type or -1 (see check()). The conversation
+        # and payload are left in self.conversation and self.payload, the payload is only valid until the next
+        # receive(). Socket errors are left for the caller to handle.
+        if sock is not self.socket:
+            self.socket = sock
+            self.receiveInto = codec.receiver(sock)
+        numBytes = self.receiveInto(self.receiveBuffer)
+        if not numBytes: return -1
+        packetType = self.check(self.receiveBuffer, numBytes)
+        if packetType >= 0: self.payload = self.receivePayloads.get(numBytes - sequenceSize - codec.headerSize - self.checkSize)
+        return packetType
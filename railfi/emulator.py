@@ -0,0 +1,281 @@
+# Emulated locomotives for load testing controllers. Each one runs its own copy of the loco firmware
+# (locomotive/main.py in emulator mode), loaded in-process and run on the emulator's asyncio loop, so many of them
+# share one process and what they say is what a real loco would say. Only the connection handshake is done here, on
+# asyncio, before the connection is handed to the firmware.
+# Run a fleet against a controller with python -m railfi.emulator
+import argparse, asyncio, contextlib, importlib.util, io, os, random, socket, sys, tempfile, time, traceback
+
+from . import codec, trace
+
+firmwarePath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'locomotive', 'main.py')
+
+
+def loadFirmware(hostLoop=None):
+    # A copy of the firmware of its own, as it is after booting and before reading its config. It runs on hostLoop
+    # (something with railfi.reactor's interface), or on a railfi.reactor of its own if there is none.
+    spec = importlib.util.spec_from_file_location('locoFirmware', firmwarePath)
+    firmware = importlib.util.module_from_spec(spec)
+    firmware.hostLoop = hostLoop
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(firmware)
+    return firmware
+
+
+# A timer on asyncio with the parts of railfi.reactor's timers the firmware uses
+class timer():
+    def __init__(self, interval, callback):
+        self.interval = interval    # Seconds, None for one-shot timers
+        self.callback = callback
+        self.active = False
+        self.handle = None
+
+
+# railfi.reactor's interface on the running asyncio loop, for a loco's firmware. Readable sockets are handled latency
+# plus up to jitter seconds late, to emulate a slow loco. A callback that raises crashes the loco, as it would crash
+# the firmware: its loop stops and the exception is kept in crash.
+class asyncioReactor():
+    def __init__(self, latency=0, jitter=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.readers = {}       # {socket: (file descriptor, callback)}
+        self.timers = set()     # Active timers, cancelled by close()
+        self.running = False
+        self.stopped = None     # Future set by stop()
+        self.crash = None
+
+    ## Sockets ##
+    def register(self, sock, callback):
+        self.readers[sock] = (sock.fileno(), callback)
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._readable, sock)
+
+    def unregister(self, sock):
+        # The firmware unregisters sockets before closing them, but the descriptor is kept in case it didn't
+        reader = self.readers.pop(sock, None)
+        if reader is not None: asyncio.get_running_loop().remove_reader(reader[0])
+
+    def _readable(self, sock):
+        delay = self.latency + random.random() * self.jitter
+        if not delay:
+            self._call(self.readers[sock][1], sock)
+            return
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self.readers[sock][0])
+        loop.call_later(delay, self._delayedReadable, sock)
+
+    def _delayedReadable(self, sock):
+        if sock not in self.readers: return     # Unregistered in the meantime
+        self._call(self.readers[sock][1], sock)
+        if sock in self.readers: asyncio.get_running_loop().add_reader(self.readers[sock][0], self._readable, sock)
+
+    ## Timers ##
+    def callLater(self, delay, callback):
+        return self._schedule(timer(None, callback), delay)
+
+    def callEvery(self, interval, callback):
+        interval = max(0.001, interval)
+        return self._schedule(timer(interval, callback), interval)
+
+    def rescheduleMs(self, oldTimer, delayMs):
+        return self._schedule(oldTimer, delayMs / 1000)
+
+    def cancel(self, oldTimer):
+        oldTimer.active = False
+        if oldTimer.handle is not None: oldTimer.handle.cancel()
+        self.timers.discard(oldTimer)
+
+    def _schedule(self, newTimer, delay):
+        if newTimer.handle is not None: newTimer.handle.cancel()
+        newTimer.active = True
+        newTimer.handle = asyncio.get_running_loop().call_later(delay, self._due, newTimer)
+        self.timers.add(newTimer)
+        return newTimer
+
+    def _due(self, dueTimer):
+        if dueTimer.interval is None:
+            dueTimer.active = False
+            self.timers.discard(dueTimer)
+        else: dueTimer.handle = asyncio.get_running_loop().call_later(dueTimer.interval, self._due, dueTimer)
+        self._call(dueTimer.callback)
+
+    ## Loop ##
+    def _call(self, callback, *args):
+        try: callback(*args)
+        except Exception as exception:
+            traceback.print_exc()
+            self.crash = exception
+            self.close()
+
+    def stop(self):
+        self.running = False
+        if self.stopped is not None and not self.stopped.done(): self.stopped.set_result(None)
+
+    def close(self):
+        # Stops the loop for good, nothing registered on it is called again
+        for oldTimer in list(self.timers): self.cancel(oldTimer)
+        for sock in list(self.readers.keys()): self.unregister(sock)
+        self.stop()
+
+
+def makeConfig(locoNumber, roadAcronym='EM', tags='emulated'):
+    return {
+        'road-name': 'RailFi Emulated',
+        'road-acronym': roadAcronym,
+        'loco-number': '{:04d}'.format(locoNumber),
+        'loco-model': 'emulator',
+        'password': '12345678',
+        'model-manufacturer': 'RailFi',
+        'tags': tags
+    }
+
+
+class emulatedLoco():
+    def __init__(self, config, latency=0, jitter=0, datagramLoss=0):
+        self.config = config
+        self.name = codec.identityName(config)
+        self.datagramLoss = datagramLoss    # Fraction of received datagrams dropped, to emulate a lossy network
+        self.stopTime = None        # time.perf_counter() when the motor last came to a standstill
+
+        self.reactor = asyncioReactor(latency, jitter)
+        self.firmware = loadFirmware(self.reactor)
+        firmware = self.firmware
+        firmware.setReportThres(firmware.ERROR)
+        # Sequences saved to flash go to a directory of this loco's own, which goes when the loco is closed (or at exit)
+        self.sequenceDir = tempfile.TemporaryDirectory(prefix='railfi-loco-')
+        firmware.sequenceDir = self.sequenceDir.name + os.sep
+        firmware.config = dict(config)  # e.g. "acceleration" and "braking" as in a loco's config.txt
+        firmware.configure()
+
+        # Watch the motor and the datagrams on their way into the firmware
+        self.setMotor = firmware.locoMotion.setMotor
+        firmware.locoMotion.setMotor = self.driveMotor
+        self.receiveDatagram = firmware.datagramChannel.receive
+        firmware.datagramChannel.receive = self.lossyReceive
+
+    ## Connection ##
+    async def connect(self, addr, port, legacy=False):
+        # Handshake with the controller's traffic cop, then hand the connection to the firmware, which announces
+        # itself. Returns the time the handshake took in seconds.
+        startTime = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        sock = await self.openSocket(addr, port)
+        try:
+            if await self.recvExactly(sock, 2) != b'\x00\x00': raise ConnectionError('First contact incorrect')
+            await loop.sock_sendall(sock, b'\x00\x00' if legacy else b'\x00\x01')
+            dedicatedPort = int.from_bytes(await self.recvExactly(sock, 2), 'big')
+            await loop.sock_sendall(sock, b'\x00\x00')
+        except BaseException:
+            sock.close()
+            raise
+        if dedicatedPort != 0:
+            sock.close()
+            sock = await self.openSocket(addr, dedicatedPort)
+
+        firmware = self.firmware
+        sock.settimeout(0.1)    # As the firmware leaves its own connection
+        firmware.controllerSocket = sock
+        firmware.controllerAddr = addr
+        firmware.locoTrace.record(trace.CONNECT, int(dedicatedPort == 0))
+        firmware.announce()
+        self.reactor.register(sock, firmware.controllerReadable)
+        return time.perf_counter() - startTime
+
+    async def openSocket(self, addr, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        try: await asyncio.get_running_loop().sock_connect(sock, (addr, port))
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def recvExactly(self, sock, numBytes):
+        data = b''
+        while len(data) < numBytes:
+            received = await asyncio.get_running_loop().sock_recv(sock, numBytes - len(data))
+            if not received: raise ConnectionError('Controller closed the connection')
+            data += received
+        return data
+
+    def listenEStop(self, port):
+        # Listen for E_STOP broadcasts on the traffic port number, like the firmware does once it is connected
+        self.firmware.startEStopListener(port)
+
+    async def run(self):
+        # Answer commands until the controller disconnects. Like the firmware, a loco that loses its connection stops.
+        self.reactor.running = True
+        self.reactor.stopped = asyncio.get_running_loop().create_future()
+        try: await self.reactor.stopped
+        finally:
+            if self.firmware.controllerSocket.fileno() >= 0: self.firmware.connectionLost()
+        if self.reactor.crash is not None: raise self.reactor.crash
+
+    def close(self):
+        firmware = self.firmware
+        if firmware.controllerSocket is not None and firmware.controllerSocket.fileno() >= 0: firmware.connectionLost()
+        firmware.closeDatagram()
+        if firmware.eStopSocket is not None:
+            self.reactor.unregister(firmware.eStopSocket)
+            firmware.eStopSocket.close()
+            firmware.eStopSocket = None
+        self.reactor.close()
+        self.sequenceDir.cleanup()
+
+    ## Instruments ##
+    def driveMotor(self, speed):
+        if speed == 0 and self.firmware.motor != 0: self.stopTime = time.perf_counter()
+        self.setMotor(speed)
+
+    def lossyReceive(self, sock):
+        if self.datagramLoss and random.random() < self.datagramLoss:
+            sock.recv(65536)    # Lost on the way
+            return -1
+        return self.receiveDatagram(sock)
+
+
+async def runFleet(addr, port, count, firstNumber=0, latency=0, jitter=0, legacy=False, setupTimes=None, udpEStop=False, locos=None, datagramLoss=0, extraConfig=None):
+    # Connect <count> emulated locos concurrently and run them until cancelled or disconnected. Pass a list as locos
+    # to get hold of the emulated locos. extraConfig entries (e.g. {'acceleration': '25'}) go in every loco's config.
+    if locos is None: locos = []
+    configs = [makeConfig(firstNumber + i) for i in range(count)]
+    if extraConfig is not None:
+        for config in configs: config.update(extraConfig)
+    locos.extend([emulatedLoco(config, latency, jitter, datagramLoss) for config in configs])
+    try:
+        times = await asyncio.gather(*[loco.connect(addr, port, legacy) for loco in locos])
+        if udpEStop:
+            for loco in locos: loco.listenEStop(port)
+        if setupTimes is not None: setupTimes.extend(times)
+        await asyncio.gather(*[loco.run() for loco in locos])
+    finally:
+        for loco in locos: loco.close()
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(prog='railfi.emulator', description='Run a fleet of emulated RailFi locos')
+    parser.add_argument('-a', '--addr', default='127.0.0.1', help='controller address')
+    parser.add_argument('-p', '--port', type=int, default=4000, help='controller traffic port')
+    parser.add_argument('-n', '--count', type=int, default=1, help='number of locos to emulate')
+    parser.add_argument('-f', '--first-number', type=int, default=0, help='loco number of the first loco')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='seconds added before handling each receive')
+    parser.add_argument('-j', '--jitter', type=float, default=0, help='up to this many random seconds added on top of latency')
+    parser.add_argument('--legacy', action='store_true', help='use the dedicated port handshake of older firmware')
+    parser.add_argument('--udp-estop', action='store_true', help='listen for E_STOP broadcasts on the traffic port number')
+    parser.add_argument('--datagram-loss', type=float, default=0, help='fraction of received datagrams to drop')
+    parser.add_argument('--acceleration', help='throttle steps per second the locos speed up at, as in a loco\'s config')
+    parser.add_argument('--braking', help='throttle steps per second the locos slow down at, as in a loco\'s config')
+    return parser.parse_args()
+
+async def main(args):
+    setupTimes = []
+    extraConfig = {}
+    if args.acceleration is not None: extraConfig['acceleration'] = args.acceleration
+    if args.braking is not None: extraConfig['braking'] = args.braking
+    fleet = asyncio.get_running_loop().create_task(runFleet(args.addr, args.port, args.count, args.first_number, args.latency, args.jitter, args.legacy, setupTimes, args.udp_estop, datagramLoss=args.datagram_loss, extraConfig=extraConfig))
+    while not len(setupTimes) and not fleet.done(): await asyncio.sleep(0.1)
+    if len(setupTimes): print('{} locos connected, slowest handshake {:.1f} ms'.format(len(setupTimes), max(setupTimes) * 1000))
+    await fleet
+
+if __name__ == '__main__':
+    try: asyncio.run(main(args=getArgs()))
+    except KeyboardInterrupt: pass
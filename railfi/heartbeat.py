@@ -0,0 +1,83 @@
+# Heartbeats, so a loco and the controller notice a dead link within a few heartbeat intervals rather than when a
+# TCP connection finally gives up. Each side sends HEARTBEAT every interval and the other answers it with an
+# ACKNOWLEDGE. A heartbeat not answered within the timeout is missed, and the timeout adapts to the link's round
+# trip time the way TCP's retransmission timeout does (RFC 6298). See docs/protocol.md.
+# Written to run unmodified on both MicroPython and CPython.
+from .stats import ticksDiffUs
+
+minTimeout = 20000      # us, keeps a fast link's timeout above Wi-Fi's usual jitter
+maxTimeout = 1000000
+initialTimeout = 250000     # Until the first round trip has been measured
+defaultBudget = 3       # Missed heartbeats in a row before the link counts as lost
+
+# What tick() says to do
+SEND = 0    # Send the next heartbeat
+WAIT = 1    # The last heartbeat may still be answered, don't send another yet
+LOST = 2    # The budget just ran out, the link is lost (send the next heartbeat anyway, it may come back)
+
+# Link states, in the order they get worse
+UP = 0
+DEGRADED = 1    # Heartbeats missed, but fewer than the budget
+DOWN = 2
+linkStates = ['up', 'degraded', 'down']
+
+
+def encodeHeartbeat(intervalMs):
+    # Controller's HEARTBEAT payload, the interval the loco should heartbeat at (0 to stop)
+    return bytes([intervalMs >> 8, intervalMs & 0xff])
+
+
+# One direction's heartbeats: the one outstanding heartbeat and the round trip estimate. Times are stats.ticksUs(),
+# all in integer microseconds so nothing here allocates on MicroPython.
+class heartbeat():
+    def __init__(self, budget=defaultBudget):
+        self.budget = budget
+        self.reset()
+
+    def reset(self):
+        self.srtt = None        # Smoothed round trip time, None until measured
+        self.rttvar = 0         # Round trip time variation
+        self.timeout = initialTimeout
+        self.outstanding = False
+        self.conversation = None    # Of the outstanding heartbeat
+        self.sentTime = 0
+        self.missed = 0         # In a row
+        self.sent = 0
+        self.answered = 0
+
+    def state(self):
+        if self.missed >= self.budget: return DOWN
+        if self.missed: return DEGRADED
+        return UP
+
+    def tick(self, now):
+        # Call every interval, before sending
+        if self.outstanding:
+            if ticksDiffUs(now, self.sentTime) < self.timeout: return WAIT
+            self.outstanding = False
+            self.missed += 1
+            if self.missed == self.budget: return LOST
+        return SEND
+
+    def sending(self, conversation, now):
+        self.outstanding = True
+        self.conversation = conversation
+        self.sentTime = now
+        self.sent += 1
+
+    def response(self, conversation, now):
+        # Call with every response, returns True if it answered the outstanding heartbeat. A response to a heartbeat
+        # that was already counted as missed isn't measured.
+        if not self.outstanding or conversation != self.conversation: return False
+        self.outstanding = False
+        self.answered += 1
+        self.missed = 0
+        rtt = ticksDiffUs(now, self.sentTime)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt >> 1
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) >> 2
+            self.srtt += (rtt - self.srtt) >> 3
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, minTimeout), maxTimeout)
+        return True
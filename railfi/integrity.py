@@ -0,0 +1,101 @@
+# Frame checks, a CRC trailer on every RF- packet that a loco and the controller may agree on when the loco announces
+# itself (see docs/protocol.md), so a frame corrupted on the way is dropped rather than carried out.
+# Written to run unmodified on both MicroPython and CPython.
+import sys
+
+try: from array import array
+except ImportError: from uarray import array
+
+checks = [
+    'NONE',
+    'CRC16',    # CRC-16/CCITT-FALSE: polynomial 0x1021, initial value 0xffff, not reflected
+    'CRC32'     # CRC-32 as in zlib and Ethernet
+]
+NONE = 0
+CRC16 = 1
+CRC32 = 2
+checkSizes = (0, 2, 4)  # Trailer bytes, big-endian
+
+# CPython's binascii computes both in C. MicroPython works through tables built the first time a check is used, and
+# keeps CRC-32 in two 16 bit halves, as anything over 30 bits would be a heap allocated int there.
+useBinascii = sys.implementation.name != 'micropython'
+if useBinascii: import binascii
+
+table16 = None
+table32High = None
+table32Low = None
+
+
+def checkNum(check):
+    # Accepts a name (any case) or a number
+    if isinstance(check, int): return check
+    try: return checks.index(check.upper())
+    except ValueError: raise ValueError('Unknown frame check "{}"'.format(check))
+
+def prepare(check):
+    # Builds the tables for check, call it when the check is agreed on so the first frame doesn't take the time
+    global table16, table32High, table32Low
+    if useBinascii: return
+    if check == CRC16 and table16 is None:
+        table = array('H', [0] * 256)
+        for i in range(256):
+            crc = i << 8
+            for bit in range(8): crc = ((crc << 1) ^ 0x1021) & 0xffff if crc & 0x8000 else (crc << 1) & 0xffff
+            table[i] = crc
+        table16 = table
+    elif check == CRC32 and table32Low is None:
+        high = array('H', [0] * 256)
+        low = array('H', [0] * 256)
+        for i in range(256):
+            crc = i
+            for bit in range(8): crc = (crc >> 1) ^ 0xedb88320 if crc & 1 else crc >> 1
+            high[i] = crc >> 16
+            low[i] = crc & 0xffff
+        table32High = high
+        table32Low = low
+
+def put(check, buffer, start, end):
+    # Writes the trailer of check for buffer[start:end] at buffer[end:]
+    if check == CRC16:
+        crc = crc16(buffer, start, end)
+        buffer[end] = crc >> 8
+        buffer[end + 1] = crc & 0xff
+    elif check == CRC32:
+        if useBinascii:
+            crc = binascii.crc32(memoryview(buffer)[start:end]) & 0xffffffff
+            high = crc >> 16
+            low = crc & 0xffff
+        else: high, low = crc32Halves(buffer, start, end)
+        buffer[end] = high >> 8
+        buffer[end + 1] = high & 0xff
+        buffer[end + 2] = low >> 8
+        buffer[end + 3] = low & 0xff
+
+def verify(check, buffer, start, end):
+    # Whether the trailer at buffer[end:] matches buffer[start:end]
+    if check == CRC16: return crc16(buffer, start, end) == (buffer[end] << 8) | buffer[end + 1]
+    if check == CRC32:
+        if useBinascii: return binascii.crc32(memoryview(buffer)[start:end]) & 0xffffffff == int.from_bytes(buffer[end:end + 4], 'big')
+        high, low = crc32Halves(buffer, start, end)
+        return high == (buffer[end] << 8) | buffer[end + 1] and low == (buffer[end + 2] << 8) | buffer[end + 3]
+    return True
+
+def crc16(buffer, start, end):
+    if useBinascii: return binascii.crc_hqx(memoryview(buffer)[start:end], 0xffff)
+    if table16 is None: prepare(CRC16)
+    table = table16
+    crc = 0xffff
+    for i in range(start, end): crc = ((crc << 8) & 0xffff) ^ table[(crc >> 8) ^ buffer[i]]
+    return crc
+
+def crc32Halves(buffer, start, end):
+    # Returns the CRC-32 as (high 16 bits, low 16 bits)
+    if table32Low is None: prepare(CRC32)
+    tableHigh = table32High
+    tableLow = table32Low
+    high = low = 0xffff
+    for i in range(start, end):
+        index = (low ^ buffer[i]) & 0xff
+        low = ((low >> 8) | ((high & 0xff) << 8)) ^ tableLow[index]
+        high = (high >> 8) ^ tableHigh[index]
+    return high ^ 0xffff, low ^ 0xffff
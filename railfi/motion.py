@@ -0,0 +1,77 @@
+# Momentum: the throttle is the speed the loco is heading for, and the motor is ramped to it on a timer at the
+# acceleration and braking rates from the loco's config, so one command is all it takes however smooth the ramp.
+# Speeds are kept in thousandths of a throttle step, so slow rates and the speed curve stay in integer maths.
+# Written to run unmodified on both MicroPython and CPython.
+
+interval = 20   # ms between ramp steps
+
+
+# Runs on an event loop with callEvery()/rescheduleMs()/cancel() like railfi.reactor's. setMotor(speed) drives the
+# motor (thousandths of a step, negative in reverse) and stepped() is called after every step the timer makes.
+class motion():
+    def __init__(self, eventLoop, setMotor, stepped=None):
+        self.eventLoop = eventLoop
+        self.setMotor = setMotor
+        self.stepped = stepped
+        self.accelerationRate = 0   # Thousandths of a step per ramp step, 0 to change speed at once
+        self.brakingRate = 0
+        self.speedCurve = [(step * 1023 + 50) // 100 for step in range(101)]   # PWM duty (0-1023) at each throttle step
+        self.throttle = 0           # -100 to 100, negative in reverse
+        self.speed = 0              # Where the ramp is, negative in reverse
+        self.timer = None
+
+    def configure(self, config):
+        # "acceleration : 40" and "braking : 80" are in throttle steps per second. "speed-curve : 0, 30, 45, 60, 80, 100"
+        # sets the duty (%) at evenly spaced throttle steps from 0 to 100, in between is interpolated.
+        if 'acceleration' in config.keys(): self.accelerationRate = int(float(config['acceleration']) * interval)
+        if 'braking' in config.keys(): self.brakingRate = int(float(config['braking']) * interval)
+        if 'speed-curve' in config.keys():
+            points = [float(point) for point in config['speed-curve'].split(',')]
+            if len(points) < 2: raise ValueError('speed-curve needs at least 2 points')
+            for step in range(101):
+                position = step * (len(points) - 1) / 100
+                low = min(int(position), len(points) - 2)
+                duty = points[low] + (points[low + 1] - points[low]) * (position - low)
+                self.speedCurve[step] = max(0, min(1023, int(duty * 10.23 + 0.5)))
+
+    def duty(self, speed):
+        # PWM duty for a speed (thousandths of a step, not negative) from the speed curve
+        step = speed // 1000
+        if step >= 100: return self.speedCurve[100]
+        low = self.speedCurve[step]
+        return low + (self.speedCurve[step + 1] - low) * (speed % 1000) // 1000
+
+    def setThrottle(self, value):
+        # The motor starts moving towards it right away
+        self.throttle = value
+        self.step()
+
+    def getSpeed(self):
+        # The throttle step the motor is at right now
+        return (abs(self.speed) + 500) // 1000
+
+    def stop(self):
+        # Stops at once, whatever the braking rate
+        self.throttle = 0
+        self.speed = 0
+        self.setMotor(0)
+        if self.timer is not None: self.eventLoop.cancel(self.timer)
+
+    def step(self):
+        # Moves the motor one step of the ramp, and keeps the timer going until the throttle is reached
+        target = self.throttle * 1000
+        if (self.speed > 0 and target < 0) or (self.speed < 0 and target > 0): target = 0   # Stop before reversing
+        rate = self.accelerationRate if abs(target) > abs(self.speed) else self.brakingRate
+        if rate <= 0 or abs(target - self.speed) <= rate: self.speed = target
+        elif target > self.speed: self.speed += rate
+        else: self.speed -= rate
+        self.setMotor(self.speed)
+
+        if self.speed == self.throttle * 1000:
+            if self.timer is not None: self.eventLoop.cancel(self.timer)
+        elif self.timer is None: self.timer = self.eventLoop.callEvery(interval / 1000, self._due)
+        elif not self.timer.active: self.eventLoop.rescheduleMs(self.timer, interval)
+
+    def _due(self):
+        self.step()
+        if self.stepped is not None: self.stepped()
@@ -0,0 +1,123 @@
+# Event loop built on select.poll, runs on both MicroPython and CPython
+# Sleeps until a registered socket is readable or the next timer is due, so an idle loco does no work at all
+
+try: import uselect as select
+except ImportError: import select
+import time
+
+if hasattr(time, 'ticks_ms'):
+    ticksMs = time.ticks_ms
+    ticksDiff = time.ticks_diff
+    ticksAdd = time.ticks_add
+else:
+    def ticksMs():
+        return time.monotonic_ns() // 1000000
+
+    def ticksDiff(a, b):
+        return a - b
+
+    def ticksAdd(a, b):
+        return a + b
+
+
+class timer():
+    def __init__(self, deadline, interval, callback):
+        self.deadline = deadline
+        self.interval = interval    # None for one-shot timers
+        self.callback = callback
+        self.active = True
+
+
+class reactor():
+    def __init__(self):
+        self.poller = select.poll()
+        self.ipoll = hasattr(self.poller, 'ipoll')  # Checked once, hasattr() allocates on MicroPython
+        self.handlers = {}
+        self.timers = []
+        self.running = False
+        self.generation = 0     # Changes whenever a socket is registered or unregistered
+
+    ## Sockets ##
+    def register(self, sock, callback):
+        # callback(sock) is called every time sock is readable (or has hung up / errored)
+        self.poller.register(sock, select.POLLIN)
+        # MicroPython's poll() reports the socket object, CPython's reports the file descriptor
+        self.handlers[sock] = (sock, callback)
+        if hasattr(sock, 'fileno'): self.handlers[sock.fileno()] = (sock, callback)
+        self.generation += 1
+
+    def unregister(self, sock):
+        try: self.poller.unregister(sock)
+        except (KeyError, ValueError, OSError): pass
+        self.handlers.pop(sock, None)
+        if hasattr(sock, 'fileno'): self.handlers.pop(sock.fileno(), None)
+        self.generation += 1
+
+    ## Timers ##
+    def _addTimer(self, newTimer):
+        # Keep timers sorted by deadline, there are only ever a handful of them
+        for i in range(len(self.timers)):
+            if ticksDiff(newTimer.deadline, self.timers[i].deadline) < 0:
+                self.timers.insert(i, newTimer)
+                return newTimer
+        self.timers.append(newTimer)
+        return newTimer
+
+    def callLater(self, delay, callback):
+        # Call callback() once after <delay> seconds
+        return self._addTimer(timer(ticksAdd(ticksMs(), int(delay * 1000)), None, callback))
+
+    def callEvery(self, interval, callback):
+        # Call callback() every <interval> seconds until the timer is cancelled
+        intervalMs = max(1, int(interval * 1000))
+        return self._addTimer(timer(ticksAdd(ticksMs(), intervalMs), intervalMs, callback))
+
+    def rescheduleMs(self, oldTimer, delayMs):
+        # Move a timer (due, pending or cancelled) to <delayMs> ms from now, reusing it rather than making a new one
+        if oldTimer in self.timers: self.timers.remove(oldTimer)
+        oldTimer.deadline = ticksAdd(ticksMs(), delayMs)
+        oldTimer.active = True
+        return self._addTimer(oldTimer)
+
+    def cancel(self, oldTimer):
+        oldTimer.active = False
+        if oldTimer in self.timers: self.timers.remove(oldTimer)
+
+    def _runTimers(self):
+        currentTime = ticksMs()
+        while len(self.timers) and ticksDiff(self.timers[0].deadline, currentTime) <= 0:
+            dueTimer = self.timers.pop(0)
+            if dueTimer.interval is not None:
+                # Schedule from the old deadline so periodic timers don't drift, but never fall behind
+                dueTimer.deadline = ticksAdd(dueTimer.deadline, dueTimer.interval)
+                if ticksDiff(dueTimer.deadline, currentTime) <= 0: dueTimer.deadline = ticksAdd(currentTime, dueTimer.interval)
+                self._addTimer(dueTimer)
+            dueTimer.callback()
+
+    ## Loop ##
+    def runOnce(self, maxWait=None):
+        # Wait for socket activity or the next timer (at most <maxWait> seconds if given), then handle it
+        timeout = -1
+        if len(self.timers):
+            timeout = max(0, ticksDiff(self.timers[0].deadline, ticksMs()))
+        if maxWait is not None:
+            maxWaitMs = int(maxWait * 1000)
+            timeout = maxWaitMs if timeout < 0 else min(timeout, maxWaitMs)
+
+        # MicroPython's ipoll() hands out the events without allocating a list of them, but stops being valid once a
+        # socket is registered or unregistered. The sockets left unhandled are still readable on the next pass.
+        generation = self.generation
+        for event in self.poller.ipoll(timeout) if self.ipoll else self.poller.poll(timeout):
+            handler = self.handlers.get(event[0])
+            if handler is not None: handler[1](handler[0])
+            if self.generation != generation: break
+
+        self._runTimers()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.runOnce()
+
+    def stop(self):
+        self.running = False
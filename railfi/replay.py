@@ -0,0 +1,216 @@
+# Replays a traffic capture (see railfi.capture) into a loco or a controller, at the speed it was captured or faster,
+# and measures how long the packets take to be answered compared to the capture.
+#   python -m railfi.replay capture.bin --into loco --port 4000        # plays the controller, for a loco to connect to
+#   python -m railfi.replay capture.bin --into controller --port 4000  # plays every captured loco
+# The handshake isn't part of a capture, it is done afresh. Everything after it is sent as captured, including
+# packets that went by datagram, so the replayed side sees the same packets in the same order with the same timing.
+import argparse, asyncio, json
+
+from . import capture, codec
+
+# Responses and packets nothing answers
+unansweredTypes = (codec.ACKNOWLEDGE, codec.ERROR, codec.CONCLUDE, codec.STATE_CHANGED)
+
+
+def percentile(values, fraction):
+    if not len(values): return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def summarize(latencies):
+    return {'count': len(latencies), 'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95), 'p99': percentile(latencies, 0.99), 'max': max(latencies) if len(latencies) else None}
+
+
+# Matches responses to the packets they answer by conversation, for one connection
+class responseTimer():
+    def __init__(self):
+        # Either side's traffic, so the larger of the two limits
+        self.sentDecoder = codec.decoder(maxPayload=codec.maxLocoPayload)
+        self.receivedDecoder = codec.decoder(maxPayload=codec.maxLocoPayload)
+        self.waiting = {}       # {conversation: time sent}
+        self.latencies = []     # Seconds
+        self.packetsSent = 0
+        self.packetsReceived = 0
+
+    def sent(self, data, sendTime):
+        self.sentDecoder.feed(data)
+        for packetType, conversation, payload in self.sentDecoder.packets():
+            self.packetsSent += 1
+            if packetType not in unansweredTypes: self.waiting[conversation] = sendTime
+
+    def setFrameCheck(self, check):
+        # From a CHECK record, both directions carry the trailer from here on
+        self.sentDecoder.setFrameCheck(check)
+        self.receivedDecoder.setFrameCheck(check)
+
+    def received(self, data, receiveTime):
+        self.receivedDecoder.feed(data)
+        for packetType, conversation, payload in self.receivedDecoder.packets():
+            self.packetsReceived += 1
+            if packetType in (codec.ACKNOWLEDGE, codec.ERROR) and conversation in self.waiting:
+                self.latencies.append(receiveTime - self.waiting.pop(conversation))
+
+
+def capturedLatencies(records, requestKind):
+    # Response times as captured, requests are the records of requestKind and responses the others
+    timers = {}
+    for recordTime, kind, stream, data in records:
+        timer = timers.setdefault(stream, responseTimer())
+        if kind == 'CHECK': timer.setFrameCheck(data[0])
+        elif kind == requestKind: timer.sent(data, recordTime)
+        else: timer.received(data, recordTime)
+    return [latency for timer in timers.values() for latency in timer.latencies]
+
+def selectSection(sections, index):
+    try: return sections[index]
+    except IndexError: raise SystemExit('The capture has {} sections'.format(len(sections)))
+
+def streamsFor(section, into, loco=None):
+    # {stream name: [(time, kind, data)]} to replay, and the record kind that is sent. A loco's capture is one loco,
+    # its datagram stream is sent over TCP with the rest.
+    endpoint = section['endpoint']
+    sentKind = capture.IN if (endpoint == 'loco') == (into == 'loco') else capture.OUT
+    sentKind = capture.kinds[sentKind]
+    streams = {}
+    for recordTime, kind, stream, data in section['records']:
+        if endpoint == 'loco': stream = 'loco'
+        elif loco is not None and stream != loco: continue
+        streams.setdefault(stream, []).append((recordTime, kind, data))
+    if into == 'loco' and len(streams) > 1:
+        raise SystemExit('The capture has {} locos, pick one with --loco: {}'.format(len(streams), ', '.join(streams.keys())))
+    return streams, sentKind
+
+
+async def play(records, sentKind, writer, timer, speed, startTime):
+    # Sends the records of sentKind at their captured times divided by speed (0 for as fast as possible), returns
+    # the seconds the replay fell behind the capture's timing at worst and the seconds it took
+    loop = asyncio.get_running_loop()
+    behind = 0
+    for recordTime, kind, data in records:
+        if kind == 'CHECK': timer.setFrameCheck(data[0])
+        if kind != sentKind: continue
+        if speed > 0:
+            due = startTime + recordTime / speed
+            wait = due - loop.time()
+            if wait > 0: await asyncio.sleep(wait)
+            else: behind = max(behind, -wait)
+        timer.sent(data, loop.time())
+        writer.write(data)
+        await writer.drain()
+    return behind, loop.time() - startTime
+
+async def listen(reader, timer):
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await reader.read(4096)
+        if not data: return
+        timer.received(data, loop.time())
+
+async def replayConnection(reader, writer, records, sentKind, speed, startTime, linger):
+    timer = responseTimer()
+    listenTask = asyncio.get_running_loop().create_task(listen(reader, timer))
+    try:
+        behind, elapsed = await play(records, sentKind, writer, timer, speed, startTime)
+        # Give the last packets time to be answered
+        try: await asyncio.wait_for(asyncio.shield(listenTask), linger)
+        except asyncio.TimeoutError: pass
+    finally:
+        listenTask.cancel()
+        writer.close()
+    return timer, behind, elapsed
+
+async def intoLoco(args, records, sentKind):
+    # Plays the controller: waits for the loco to connect and handshake, then replays
+    connected = asyncio.get_running_loop().create_future()
+    async def handleConnection(reader, writer):
+        if connected.done():
+            writer.close()
+            return
+        try:
+            writer.write(b'\x00\x00')
+            await writer.drain()
+            if await reader.readexactly(2) != b'\x00\x01': raise ConnectionError('The loco needs a dedicated port, which replays don\'t support')
+            writer.write(b'\x00\x00')
+            await writer.drain()
+            await reader.readexactly(2)
+        except (OSError, asyncio.IncompleteReadError) as error:
+            print('Loco failed to connect:', repr(error))
+            writer.close()
+            return
+        connected.set_result((reader, writer))
+    server = await asyncio.start_server(handleConnection, port=args.port)
+    print('Waiting for a loco on port {}'.format(args.port))
+    reader, writer = await connected
+    server.close()
+    loop = asyncio.get_running_loop()
+    return [await replayConnection(reader, writer, records, sentKind, args.speed, loop.time(), args.linger)]
+
+async def intoController(args, streams, sentKind):
+    # Plays every loco in the capture, each on its own connection
+    loop = asyncio.get_running_loop()
+    async def replayLoco(records, startTime):
+        reader, writer = await asyncio.open_connection(args.addr, args.port)
+        if await reader.readexactly(2) != b'\x00\x00': raise ConnectionError('First contact incorrect')
+        writer.write(b'\x00\x01')
+        await writer.drain()
+        await reader.readexactly(2)
+        writer.write(b'\x00\x00')
+        await writer.drain()
+        return await replayConnection(reader, writer, records, sentKind, args.speed, startTime, args.linger)
+    startTime = loop.time()
+    return await asyncio.gather(*[replayLoco(records, startTime) for records in streams.values()])
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(prog='railfi.replay', description='Replay a RailFi traffic capture into a loco or a controller')
+    parser.add_argument('capture', help='capture file, from "capture" in a loco\'s config or the controller\'s --capture')
+    parser.add_argument('-i', '--into', choices=['loco', 'controller'], required=True, help='what to replay into')
+    parser.add_argument('-a', '--addr', default='127.0.0.1', help='controller address, for --into controller')
+    parser.add_argument('-p', '--port', type=int, default=4000, help='controller traffic port, or the port to wait for the loco on')
+    parser.add_argument('-l', '--loco', help='only replay this loco from a controller\'s capture')
+    parser.add_argument('-s', '--section', type=int, default=-1, help='which recorder run in the file to replay (default the last)')
+    parser.add_argument('--speed', type=float, default=1, help='replay this many times faster than captured, 0 for as fast as possible')
+    parser.add_argument('--linger', type=float, default=1, help='seconds to wait for responses after the last packet')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    return parser.parse_args()
+
+async def replay(args):
+    section = selectSection(capture.readCapture(args.capture), args.section)
+    streams, sentKind = streamsFor(section, args.into, args.loco)
+    if not len(streams): raise SystemExit('Nothing to replay')
+    if args.into == 'loco': results = await intoLoco(args, list(streams.values())[0], sentKind)
+    else: results = await intoController(args, streams, sentKind)
+
+    captured = capturedLatencies([record for record in section['records'] if args.loco is None or section['endpoint'] == 'loco' or record[2] == args.loco], sentKind)
+    replayed = [latency for timer, behind, elapsed in results for latency in timer.latencies]
+    return {
+        'endpoint': section['endpoint'],
+        'into': args.into,
+        'locos': len(streams),
+        'speed': args.speed,
+        'capturedSeconds': section['records'][-1][0] if len(section['records']) else 0,
+        'replayedSeconds': max([elapsed for timer, behind, elapsed in results]),
+        'maxBehindMs': max([behind for timer, behind, elapsed in results]) * 1000,
+        'packetsSent': sum([timer.packetsSent for timer, behind, elapsed in results]),
+        'packetsReceived': sum([timer.packetsReceived for timer, behind, elapsed in results]),
+        'unanswered': sum([len(timer.waiting) for timer, behind, elapsed in results]),
+        'capturedResponseMs': summarize([latency * 1000 for latency in captured]),
+        'replayedResponseMs': summarize([latency * 1000 for latency in replayed])
+    }
+
+def main():
+    args = getArgs()
+    result = asyncio.run(replay(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print('Replayed {} captured seconds of {} traffic into {} ({} loco{}) in {:.2f} s, at worst {:.1f} ms behind'.format(
+        round(result['capturedSeconds'], 2), result['endpoint'], result['into'], result['locos'], '' if result['locos'] == 1 else 's', result['replayedSeconds'], result['maxBehindMs']))
+    print('{} packets sent, {} received, {} left unanswered'.format(result['packetsSent'], result['packetsReceived'], result['unanswered']))
+    for label, key in (('Captured', 'capturedResponseMs'), ('Replayed', 'replayedResponseMs')):
+        latencies = result[key]
+        if not latencies['count']: print('{} response times: none'.format(label))
+        else: print('{} response times: p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms over {}'.format(label, latencies['p50'], latencies['p95'], latencies['p99'], latencies['max'], latencies['count']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# Timed command sequences the locomotive runs by itself (station stops, shunting moves, light shows), so the timing
+# doesn't depend on the controller's commands making it across the network at the right moment. The controller
+# uploads a sequence once with UPLOAD_SEQUENCE and then only has to send RUN_SEQUENCE. See docs/protocol.md.
+# Written to run unmodified on both MicroPython and CPython.
+from .reactor import ticksMs, ticksDiff, ticksAdd
+
+stepSize = 5        # 2B delay (ms after the step before), 1B action, 1B a, 1B b
+maxSteps = 255
+maxSequences = 255  # Numbered 0-254, 0xff means none in the status
+forever = 0         # Repeats for a sequence that runs until it is stopped
+
+# What a step does, new actions must be added at the end
+actions = [
+    'WAIT',         # Nothing, for pauses longer than a step's delay
+    'THROTTLE',     # a: throttle (-100 to 100, negative in reverse)
+    'DIRECTION',    # a: 0 forward, 1 reverse
+    'LIGHT'         # a: light, b: 1 on, 0 off
+]
+WAIT = 0
+THROTTLE = 1
+DIRECTION = 2
+LIGHT = 3
+
+# UPLOAD_SEQUENCE flags
+SAVE = 1    # Keep the sequence in flash, so it survives the loco restarting
+
+
+def encodeSteps(steps):
+    # steps is [(delay ms, action, a, b)] where the action is a name or number, b may be left out
+    payload = bytearray(len(steps) * stepSize)
+    for i in range(len(steps)):
+        step = steps[i]
+        action = step[1] if isinstance(step[1], int) else actions.index(step[1])
+        delay = int(step[0])
+        if not 0 <= delay <= 0xffff: raise ValueError('Step delays are 0-65535 ms, use WAIT steps for longer')
+        position = i * stepSize
+        payload[position] = delay >> 8
+        payload[position + 1] = delay & 0xff
+        payload[position + 2] = action
+        payload[position + 3] = step[2] & 0xff
+        payload[position + 4] = (step[3] if len(step) > 3 else 0) & 0xff
+    return bytes(payload)
+
+def decodeSteps(payload):
+    # Returns [(delay ms, action name, a, b)], THROTTLE's a is signed
+    steps = []
+    for position in range(0, len(payload) - stepSize + 1, stepSize):
+        action = payload[position + 2]
+        a = payload[position + 3]
+        if action == THROTTLE and a >= 128: a -= 256
+        steps.append(((payload[position] << 8) | payload[position + 1], actions[action] if action < len(actions) else action, a, payload[position + 4]))
+    return steps
+
+def encodeUpload(number, steps, save=False):
+    # UPLOAD_SEQUENCE payload, <number (1B)> <flags (1B)> then the steps. No steps deletes the sequence.
+    return bytes([number, SAVE if save else 0]) + encodeSteps(steps)
+
+def encodeRun(number, repeats=1):
+    # RUN_SEQUENCE payload, repeats is 1-255 or forever
+    return bytes([number, repeats])
+
+def decodeStatus(payload):
+    # GET_SEQUENCES response, returns {'running': number or None, 'step': index of the next step, 'repeats': runs
+    # left after this one (None forever), 'stored': {number: {'steps': count, 'saved': bool}}}
+    status = {
+        'running': None if payload[0] == 0xff else payload[0],
+        'step': payload[1],
+        'repeats': None if payload[2] == 0xff else payload[2],
+        'stored': {}
+    }
+    for i in range(payload[3]):
+        position = 4 + 3 * i
+        status['stored'][payload[position]] = {'steps': payload[position + 1], 'saved': bool(payload[position + 2] & SAVE)}
+    return status
+
+
+# Stores sequences and runs one at a time on the loco's event loop. apply(action, a, b) carries out a step (a is
+# unsigned, as received) and finished(number) is called when a sequence ends or is stopped. Steps are timed from the
+# previous step's deadline rather than from when it actually ran, so lateness doesn't add up over a long sequence.
+class sequencer():
+    def __init__(self, eventLoop, apply, finished=None):
+        self.eventLoop = eventLoop
+        self.apply = apply
+        self.finished = finished
+        self.stored = {}        # {number: steps as bytes}
+        self.saved = {}         # {number: True} for sequences kept in flash
+        self.running = None     # Number of the sequence running
+        self.steps = None
+        self.step = 0           # Index of the next step
+        self.repeat = 0         # Runs left after this one, None to run forever
+        self.deadline = 0       # ticksMs() the next step is due at
+        self.timer = None
+
+    def store(self, number, steps, saved=False):
+        # steps as received in UPLOAD_SEQUENCE, an empty sequence deletes it. Raises ValueError if they are malformed.
+        if number >= maxSequences: raise ValueError('Sequence numbers are 0-{}'.format(maxSequences - 1))
+        if len(steps) % stepSize or len(steps) // stepSize > maxSteps: raise ValueError('Malformed sequence')
+        for position in range(2, len(steps), stepSize):
+            if steps[position] >= len(actions): raise ValueError('Unknown action {}'.format(steps[position]))
+        if self.running == number: self.stop()
+        if not len(steps):
+            self.stored.pop(number, None)
+            self.saved.pop(number, None)
+            return
+        self.stored[number] = bytes(steps)
+        if saved: self.saved[number] = True
+        else: self.saved.pop(number, None)
+
+    def start(self, number, repeats=1):
+        # Raises KeyError if the sequence isn't stored. Starting a sequence stops the one running.
+        steps = self.stored[number]
+        if repeats == forever and not sum([steps[position] | steps[position + 1] for position in range(0, len(steps), stepSize)]):
+            raise ValueError('A sequence without delays can\'t run forever')
+        self.stop()
+        self.running = number
+        self.steps = steps
+        self.step = 0
+        self.repeat = None if repeats == forever else repeats - 1
+        self.deadline = ticksMs()
+        self._schedule()
+
+    def stop(self):
+        if self.running is None: return
+        number = self.running
+        self.running = None
+        self.steps = None
+        self.step = 0
+        self.repeat = 0
+        if self.timer is not None: self.eventLoop.cancel(self.timer)
+        if self.finished is not None: self.finished(number)
+
+    def _schedule(self):
+        steps = self.steps
+        position = self.step * stepSize
+        self.deadline = ticksAdd(self.deadline, (steps[position] << 8) | steps[position + 1])
+        delay = max(0, ticksDiff(self.deadline, ticksMs()))
+        if self.timer is None: self.timer = self.eventLoop.callLater(delay / 1000, self._due)
+        else: self.eventLoop.rescheduleMs(self.timer, delay)
+
+    def _due(self):
+        # Runs every step that is due, then waits for the next one
+        while self.running is not None and ticksDiff(self.deadline, ticksMs()) <= 0:
+            steps = self.steps
+            position = self.step * stepSize
+            self.step += 1
+            self.apply(steps[position + 2], steps[position + 3], steps[position + 4])
+            if self.running is None: return     # apply() stopped it
+            if self.step * stepSize >= len(steps):
+                if self.repeat is not None and self.repeat <= 0:
+                    self.stop()
+                    return
+                if self.repeat is not None: self.repeat -= 1
+                self.step = 0
+            position = self.step * stepSize
+            self.deadline = ticksAdd(self.deadline, (steps[position] << 8) | steps[position + 1])
+        if self.running is not None: self.eventLoop.rescheduleMs(self.timer, max(0, ticksDiff(self.deadline, ticksMs())))
+
+    def status(self):
+        # GET_SEQUENCES response, see decodeStatus()
+        payload = bytearray(4 + 3 * len(self.stored))
+        payload[0] = 0xff if self.running is None else self.running
+        payload[1] = self.step
+        payload[2] = 0xff if self.repeat is None else min(self.repeat, 0xfe)
+        payload[3] = len(self.stored)
+        position = 4
+        for number in sorted(self.stored.keys()):
+            payload[position] = number
+            payload[position + 1] = len(self.stored[number]) // stepSize
+            payload[position + 2] = SAVE if number in self.saved else 0
+            position += 3
+        return payload
@@ -0,0 +1,233 @@
+# Fixed-bucket histograms and counters kept by the locomotive, and the GET_STATS payload they are sent in
+# Written to run unmodified on both MicroPython and CPython. Recording never allocates, so it is safe on the hot path.
+import time
+
+from .reactor import ticksMs, ticksDiff
+
+try: import gc
+except ImportError: gc = None
+
+if hasattr(time, 'ticks_us'):
+    ticksUs = time.ticks_us
+    ticksDiffUs = time.ticks_diff
+else:
+    def ticksUs():
+        return time.perf_counter_ns() // 1000
+
+    def ticksDiffUs(a, b):
+        return a - b
+
+def memFree():
+    # Free heap in bytes, None where the implementation doesn't report it
+    if gc is not None and hasattr(gc, 'mem_free'): return gc.mem_free()
+    return None
+
+def memAlloc():
+    # Heap in use in bytes, None where the implementation doesn't report it
+    if gc is not None and hasattr(gc, 'mem_alloc'): return gc.mem_alloc()
+    return None
+
+
+statsVersion = 1
+numBuckets = 20     # Bucket 0 is 0 us, bucket n is [2 ** (n - 1), 2 ** n) us, the last bucket takes everything from 2 ** 18 us up
+maxCount = 2 ** 32 - 1
+memUnknown = 2 ** 32 - 1
+
+# Stages of the loco's boot, timed by the firmware and sent with the stats. New phases must be added at the end.
+bootPhases = [
+    'LOAD',         # Reset until the firmware starts running (boot.py, loading or compiling main.py), real locos only
+    'HARDWARE',     # Setting up the hardware
+    'MODULES',      # Importing the railfi modules
+    'CONFIG',       # Reading config.txt and loading plugins
+    'DISCOVERY',    # Discovery mode, only if the config has no working controller contact
+    'WIFI',         # Joining the controller's network
+    'CONTROLLER'    # Connecting to the controller and the handshake
+]
+LOAD = 0
+HARDWARE = 1
+MODULES = 2
+CONFIG = 3
+DISCOVERY = 4
+WIFI = 5
+CONTROLLER = 6
+
+def bucketBounds(bucket):
+    # (low, high) in microseconds, high is None for the last bucket
+    if bucket == 0: return 0, 1
+    if bucket == numBuckets - 1: return 2 ** (bucket - 1), None
+    return 2 ** (bucket - 1), 2 ** bucket
+
+
+class histogram():
+    def __init__(self):
+        self.counts = [0] * numBuckets
+
+    def record(self, us):
+        bucket = 0
+        while us > 0 and bucket < numBuckets - 1:
+            us >>= 1
+            bucket += 1
+        if self.counts[bucket] < maxCount: self.counts[bucket] += 1
+
+    def reset(self):
+        for i in range(numBuckets): self.counts[i] = 0
+
+    def total(self):
+        return sum(self.counts)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the given fraction of samples, in microseconds (None if it's the last bucket)
+        total = self.total()
+        if total == 0: return 0
+        running = 0
+        for bucket in range(numBuckets):
+            running += self.counts[bucket]
+            if running >= fraction * total: return bucketBounds(bucket)[1]
+        return None
+
+
+def putUint32(buffer, position, value):
+    buffer[position] = (value >> 24) & 0xff
+    buffer[position + 1] = (value >> 16) & 0xff
+    buffer[position + 2] = (value >> 8) & 0xff
+    buffer[position + 3] = value & 0xff
+
+def getUint32(payload, position):
+    return (payload[position] << 24) | (payload[position + 1] << 16) | (payload[position + 2] << 8) | payload[position + 3]
+
+
+# Everything the loco measures about itself. The decoder's resync counters are read when encoding, so they don't have
+# to be counted twice.
+class locoStats():
+    def __init__(self, numPacketTypes, decoder=None):
+        self.decoder = decoder
+        self.processTime = [histogram() for i in range(numPacketTypes)]    # Per packet type, receive handling to response sent
+        self.actuateLatency = histogram()   # Data received to the hardware being changed
+        self.bootTimes = [None] * len(bootPhases)  # ms spent in each boot phase, kept through reset()
+        self.allocations = None     # Bytes allocated by each pass of the event loop, only kept by measureAllocations()
+        self.reset()
+
+    def reset(self):
+        for processTime in self.processTime: processTime.reset()
+        self.actuateLatency.reset()
+        if self.allocations is not None: self.allocations.reset()
+        self.startTime = ticksMs()
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.memFreeLow = memUnknown
+        if self.decoder is not None:
+            self.decoder.resyncs = 0
+            self.decoder.discarded = 0
+            self.decoder.rejected = 0
+
+    def processed(self, packetType, startTime):
+        # Call with the ticksUs() taken when handling of the packet started
+        if packetType < len(self.processTime): self.processTime[packetType].record(ticksDiffUs(ticksUs(), startTime))
+
+    def actuated(self, receiveTime):
+        # Call right after changing the hardware, with the ticksUs() taken when the packet's data was received
+        if receiveTime is not None: self.actuateLatency.record(ticksDiffUs(ticksUs(), receiveTime))
+
+    def sampleMemory(self):
+        free = memFree()
+        if free is not None and free < self.memFreeLow: self.memFreeLow = free
+
+    def measureAllocations(self):
+        self.allocations = histogram()
+
+    def allocated(self, numBytes):
+        # Same buckets as the time histograms, in bytes rather than us. Bucket 0 counts the passes that allocated nothing.
+        self.allocations.record(numBytes)
+
+    def bootPhase(self, phase, ms):
+        # A phase may be passed through more than once (e.g. joining the network before and after discovery)
+        self.bootTimes[phase] = ms if self.bootTimes[phase] is None else self.bootTimes[phase] + ms
+
+    def uptime(self):
+        return ticksDiff(ticksMs(), self.startTime)
+
+    def encode(self):
+        # See docs/protocol.md, only packet types with samples are included
+        types = [i for i in range(len(self.processTime)) if self.processTime[i].total()]
+        phases = [i for i in range(len(bootPhases)) if self.bootTimes[i] is not None]
+        payload = bytearray(29 + 4 * numBuckets + len(types) * (1 + 4 * numBuckets) + 5 * len(phases) + (0 if self.allocations is None else 4 * numBuckets) + 4)
+        payload[0] = statsVersion
+        payload[1] = numBuckets
+        position = 2
+        for value in (self.uptime(), self.bytesIn, self.bytesOut,
+                      self.decoder.resyncs if self.decoder is not None else 0,
+                      self.decoder.discarded if self.decoder is not None else 0,
+                      self.memFreeLow):
+            putUint32(payload, position, min(value, maxCount))
+            position += 4
+        for count in self.actuateLatency.counts:
+            putUint32(payload, position, count)
+            position += 4
+        payload[position] = len(types)
+        position += 1
+        for packetType in types:
+            payload[position] = packetType
+            position += 1
+            for count in self.processTime[packetType].counts:
+                putUint32(payload, position, count)
+                position += 4
+        payload[position] = len(phases)
+        position += 1
+        for phase in phases:
+            payload[position] = phase
+            putUint32(payload, position + 1, min(self.bootTimes[phase], maxCount))
+            position += 5
+        payload[position] = 0 if self.allocations is None else 1
+        position += 1
+        if self.allocations is not None:
+            for count in self.allocations.counts:
+                putUint32(payload, position, count)
+                position += 4
+        putUint32(payload, position, min(self.decoder.rejected, maxCount) if self.decoder is not None else 0)
+        return payload
+
+
+def decodeHistogram(payload, position, buckets):
+    result = histogram()
+    for i in range(min(buckets, numBuckets)): result.counts[i] = getUint32(payload, position + 4 * i)
+    return result
+
+def decodeStats(payload):
+    # Returns a dict of the stats, histograms are histogram objects, processTime is {packet type number: histogram},
+    # bootPhases is {phase name: ms} and allocations is a histogram of bytes, None unless the loco measures them
+    if payload[0] != statsVersion: raise ValueError('Unsupported stats version {}'.format(payload[0]))
+    buckets = payload[1]
+    values = [getUint32(payload, 2 + 4 * i) for i in range(6)]
+    stats = {
+        'uptime': values[0] / 1000,
+        'bytesIn': values[1],
+        'bytesOut': values[2],
+        'resyncs': values[3],
+        'discarded': values[4],
+        'memFreeLow': None if values[5] == memUnknown else values[5]
+    }
+    position = 26
+    stats['actuateLatency'] = decodeHistogram(payload, position, buckets)
+    position += 4 * buckets
+    numTypes = payload[position]
+    position += 1
+    stats['processTime'] = {}
+    for i in range(numTypes):
+        stats['processTime'][payload[position]] = decodeHistogram(payload, position + 1, buckets)
+        position += 1 + 4 * buckets
+    # Firmware predating boot phase timing ends here
+    stats['bootPhases'] = {}
+    stats['allocations'] = None
+    stats['rejected'] = 0
+    if position < len(payload):
+        for i in range(payload[position]):
+            phase = payload[position + 1 + 5 * i]
+            stats['bootPhases'][bootPhases[phase] if phase < len(bootPhases) else str(phase)] = getUint32(payload, position + 2 + 5 * i)
+        position += 1 + 5 * payload[position]
+    # And firmware predating allocation measurement here
+    if position < len(payload):
+        if payload[position]: stats['allocations'] = decodeHistogram(payload, position + 1, buckets)
+        position += 1 + (4 * buckets if payload[position] else 0)
+    # And firmware predating packet rejection here
+    if position + 4 <= len(payload): stats['rejected'] = getUint32(payload, position)
+    return stats
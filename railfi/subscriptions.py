@@ -0,0 +1,82 @@
+# State fields a controller asked to have pushed to it, kept by the locomotive. The controller subscribes with
+# SUBSCRIBE and the locomotive sends STATE_CHANGED when a subscribed field changes, no more often than the field's
+# minimum interval. Written to run unmodified on both MicroPython and CPython.
+from . import codec
+from .reactor import ticksMs, ticksDiff
+
+
+def encodeSubscribe(intervals):
+    # intervals is {field name: minimum ms between pushes}, an empty dict unsubscribes
+    # <field mask (1B)> followed by a uint16 interval for each field in the mask, in codec.stateFields order
+    fieldMask = 0
+    payload = [0]
+    for i in range(len(codec.stateFields)):
+        if codec.stateFields[i] in intervals:
+            fieldMask |= 1 << i
+            interval = min(int(intervals[codec.stateFields[i]]), 0xffff)
+            payload += [interval >> 8, interval & 0xff]
+    payload[0] = fieldMask
+    return bytes(payload)
+
+def decodeSubscribe(payload):
+    # Fields this side doesn't know about (newer controllers) are skipped
+    intervals = {}
+    fieldMask = payload[0]
+    position = 1
+    for i in range(8):
+        if fieldMask & (1 << i):
+            if i < len(codec.stateFields): intervals[codec.stateFields[i]] = (payload[position] << 8) | payload[position + 1]
+            position += 2
+    return intervals
+
+
+class subscriptions():
+    def __init__(self):
+        numFields = len(codec.stateFields)
+        self.intervals = [None] * numFields     # Minimum ms between pushes of each field, None if not subscribed
+        self.known = [None] * numFields         # Value the controller last learnt, from a push or a response
+        self.lastPush = [0] * numFields         # ticksMs() of each field's last push
+        self.numActive = 0
+        self.wait = None                        # Set by changes()
+
+    def subscribe(self, intervals):
+        # Replaces the whole subscription, fields not in intervals are no longer pushed
+        self.numActive = 0
+        for i in range(len(codec.stateFields)):
+            interval = intervals.get(codec.stateFields[i])
+            self.intervals[i] = interval
+            self.known[i] = None
+            if interval is not None: self.numActive += 1
+
+    def forget(self):
+        # The controller may have missed pushes (the connection dropped), so every subscribed field is pushed again
+        for i in range(len(codec.stateFields)): self.known[i] = None
+
+    # The state is passed as values, a value for each field in codec.stateFields order (see codec.encodeStateInto()),
+    # and sets of fields as field masks, so none of these allocate
+    def learnt(self, values, fieldMask=codec.allFields):
+        # The controller was sent these values in a response, they don't need pushing
+        for i in range(len(codec.stateFields)):
+            if fieldMask & (1 << i): self.known[i] = values[i]
+
+    def changes(self, values, currentTime=None):
+        # Returns the mask of the subscribed fields that differ from what the controller knows and may be pushed now.
+        # self.wait is left at the ms until a change held back by its interval may be pushed, None if none is.
+        if currentTime is None: currentTime = ticksMs()
+        changed = 0
+        self.wait = None
+        for i in range(len(codec.stateFields)):
+            if self.intervals[i] is None or values[i] == self.known[i]: continue
+            remaining = self.intervals[i] - ticksDiff(currentTime, self.lastPush[i])
+            if remaining > 0:
+                if self.wait is None or remaining < self.wait: self.wait = remaining
+                continue
+            changed |= 1 << i
+        return changed
+
+    def pushed(self, values, fieldMask, currentTime=None):
+        if currentTime is None: currentTime = ticksMs()
+        for i in range(len(codec.stateFields)):
+            if fieldMask & (1 << i):
+                self.known[i] = values[i]
+                self.lastPush[i] = currentTime
@@ -0,0 +1,135 @@
+# Binary trace ring kept in RAM by the locomotive. Hot-path events are written as fixed-size records into a buffer
+# allocated once at boot, so tracing can stay on all the time. The ring is sent to the controller on GET_TRACE and
+# written to traceback.log when the firmware crashes. Written to run unmodified on both MicroPython and CPython.
+import time
+
+if hasattr(time, 'ticks_us'):
+    ticksUs = time.ticks_us
+    timestampBits = 30     # MicroPython's ticks wrap at 2 ** 30
+else:
+    def ticksUs():
+        return time.perf_counter_ns() // 1000
+    timestampBits = 32
+
+traceVersion = 1
+recordSize = 12     # 4B timestamp (us), 1B event, 1B a, 2B b, 4B c
+
+# Events and what their arguments hold, new events must be added at the end
+traceEvents = [
+    'BOOT',         # -
+    'CONNECT',      # a: 1 on the traffic connection, 0 on a dedicated port
+    'DISCONNECT',   # -
+    'RECV',         # b: bytes received
+    'PACKET',       # a: packet type, b: payload size, c: conversation (b: 0xffff, c: stop ID if it came by UDP)
+    'ACTUATE',      # a: packet type, b: throttle (+128) or light, c: value
+    'SEND',         # a: packet type, b: packet size, c: conversation
+    'RESYNC',       # b: resyncs since the last record, c: total bytes discarded
+    'UNHANDLED',    # a: packet type, c: conversation
+    'ERROR',        # a: error code
+    'HANDLER_FAILED',   # a: packet type, c: conversation
+    'PREEMPTED',    # a: packet type, c: conversation
+    'STALE',        # b: sequence number of the datagram dropped, c: newest sequence number received
+    'RECOVERED',    # a: 1 if the session was resumed, 0 if the controller started a new one, c: ms since the drop
+    'ALLOC',        # a: type of the last packet handled (0xff if none), b: bytes allocated by the event loop pass (alloc-debug only)
+    'COLLECT',      # b: kB of heap freed, c: us the garbage collection took
+    'STEP',         # a: sequence number, b: step index (0xffff when the sequence ends), c: action << 16 | a << 8 | b
+    'REJECTED',     # b: packets rejected since the last record (implausible size or failed frame check), c: total rejected
+    'LINK'          # a: 0 lost (heartbeats missed), 1 back, b: heartbeats missed, c: smoothed round trip time (us)
+]
+BOOT = 0
+CONNECT = 1
+DISCONNECT = 2
+RECV = 3
+PACKET = 4
+ACTUATE = 5
+SEND = 6
+RESYNC = 7
+UNHANDLED = 8
+ERROR = 9
+HANDLER_FAILED = 10
+PREEMPTED = 11
+STALE = 12
+RECOVERED = 13
+ALLOC = 14
+COLLECT = 15
+STEP = 16
+REJECTED = 17
+LINK = 18
+
+
+class traceRing():
+    def __init__(self, numRecords=256):
+        self.buffer = bytearray(numRecords * recordSize)
+        self.numRecords = numRecords
+        self.next = 0       # Index of the record to overwrite next
+        self.count = 0      # Records held, up to numRecords
+        self.enabled = True
+
+    def record(self, event, a=0, b=0, c=0):
+        # Never allocates, safe to call on the hot path
+        if not self.enabled: return
+        buffer = self.buffer
+        position = self.next * recordSize
+        timestamp = ticksUs()
+        buffer[position] = (timestamp >> 24) & 0xff
+        buffer[position + 1] = (timestamp >> 16) & 0xff
+        buffer[position + 2] = (timestamp >> 8) & 0xff
+        buffer[position + 3] = timestamp & 0xff
+        buffer[position + 4] = event
+        buffer[position + 5] = a & 0xff
+        buffer[position + 6] = (b >> 8) & 0xff
+        buffer[position + 7] = b & 0xff
+        buffer[position + 8] = (c >> 24) & 0xff
+        buffer[position + 9] = (c >> 16) & 0xff
+        buffer[position + 10] = (c >> 8) & 0xff
+        buffer[position + 11] = c & 0xff
+        self.next = (self.next + 1) % self.numRecords
+        if self.count < self.numRecords: self.count += 1
+
+    def clear(self):
+        self.next = 0
+        self.count = 0
+
+    def encode(self):
+        # <version (1B)> <record size (1B)> <timestamp bits (1B)> <record count (2B)> then the records, oldest first
+        first = (self.next - self.count) % self.numRecords
+        payload = bytearray(5 + self.count * recordSize)
+        payload[0] = traceVersion
+        payload[1] = recordSize
+        payload[2] = timestampBits
+        payload[3] = self.count >> 8
+        payload[4] = self.count & 0xff
+        if first + self.count <= self.numRecords:
+            payload[5:] = self.buffer[first * recordSize:(first + self.count) * recordSize]
+        else:
+            split = (self.numRecords - first) * recordSize
+            payload[5:5 + split] = self.buffer[first * recordSize:]
+            payload[5 + split:] = self.buffer[:self.next * recordSize]
+        return payload
+
+    def write(self, file):
+        # Human readable dump, e.g. into traceback.log
+        file.write('===== Trace, newest last =====\n')
+        for line in formatTrace(decodeTrace(self.encode())): file.write(line + '\n')
+
+
+def decodeTrace(payload):
+    # Returns [(age in us relative to the newest record, event name, a, b, c)], oldest first
+    if payload[0] != traceVersion: raise ValueError('Unsupported trace version {}'.format(payload[0]))
+    size = payload[1]
+    period = 1 << payload[2]
+    count = (payload[3] << 8) | payload[4]
+    records = []
+    for i in range(count):
+        position = 5 + i * size
+        record = payload[position:position + size]
+        timestamp = (record[0] << 24) | (record[1] << 16) | (record[2] << 8) | record[3]
+        event = traceEvents[record[4]] if record[4] < len(traceEvents) else str(record[4])
+        records.append([timestamp, event, record[5], (record[6] << 8) | record[7], (record[8] << 24) | (record[9] << 16) | (record[10] << 8) | record[11]])
+    if len(records):
+        newest = records[-1][0]
+        for record in records: record[0] = (newest - record[0]) % period
+    return [tuple(record) for record in records]
+
+def formatTrace(records):
+    return ['-{:>10} us {:<10} a={} b={} c={}'.format(*record) for record in records]
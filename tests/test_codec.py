@@ -0,0 +1,149 @@
+# Unit tests of railfi.codec, run with python -m unittest discover tests
+import os, sys, unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from railfi import codec, integrity
+
+
+def packets(check, *packetList):
+    # (packetType, payload, conversation) encoded back to back with check's trailer
+    encoder = codec.encoder()
+    encoder.setFrameCheck(check)
+    return b''.join([bytes(encoder.encode(*packet)) for packet in packetList])
+
+def makeDecoder(check, data):
+    decoder = codec.decoder(maxPayload=codec.maxControllerPayload)
+    decoder.setFrameCheck(check)
+    decoder.feed(data)
+    return decoder
+
+def fakeHeader(packetType, payloadSize):
+    return b'RF-' + bytes([packetType]) + (7).to_bytes(4, 'big') + payloadSize.to_bytes(2, 'big')
+
+
+class decodeTests(unittest.TestCase):
+    def testPacketsInOrder(self):
+        decoder = makeDecoder(integrity.NONE, packets(integrity.NONE, (codec.SET_THROTTLE, b'\x10', 2), (codec.GET_STATE, b'', 4)))
+        self.assertEqual(decoder.decode(), codec.SET_THROTTLE)
+        self.assertEqual((decoder.conversation, bytes(decoder.payload)), (2, b'\x10'))
+        self.assertEqual(decoder.decode(), codec.GET_STATE)
+        self.assertEqual(decoder.decode(), -1)
+
+    def testGarbageSkipped(self):
+        decoder = makeDecoder(integrity.NONE, b'\x00R\xffRF' + packets(integrity.NONE, (codec.GET_STATE, b'', 2)))
+        self.assertEqual(decoder.decode(), codec.GET_STATE)
+        self.assertEqual(decoder.resyncs, 1)
+        self.assertEqual(decoder.discarded, 5)
+
+    def testIncompletePacketWaited(self):
+        data = packets(integrity.NONE, (codec.SET_LIGHT, b'\x00\x01', 2))
+        decoder = makeDecoder(integrity.NONE, data[:-1])
+        self.assertEqual(decoder.decode(), -1)
+        decoder.feed(data[-1:])
+        self.assertEqual(decoder.decode(), codec.SET_LIGHT)
+
+    def testImplausibleSizeRejected(self):
+        decoder = makeDecoder(integrity.NONE, fakeHeader(codec.GET_STATE, codec.maxControllerPayload + 1) + packets(integrity.NONE, (codec.GET_STATE, b'', 2)))
+        self.assertEqual(decoder.decode(), codec.GET_STATE)
+        self.assertEqual(decoder.conversation, 2)
+        self.assertEqual(decoder.rejected, 1)
+
+    def testLimitPerPacketType(self):
+        # A SET_THROTTLE claiming more than its 1 byte is corrupt, an UPLOAD_SEQUENCE may carry 255 steps
+        decoder = codec.decoder(maxPayload=codec.maxControllerPayload, payloadLimits=codec.controllerPayloads)
+        steps = bytes(2 + 255 * 5)
+        decoder.feed(fakeHeader(codec.SET_THROTTLE, 2000) + packets(integrity.NONE, (codec.UPLOAD_SEQUENCE, steps, 2), (codec.GET_STATE, b'', 4)))
+        self.assertEqual(decoder.decode(), codec.UPLOAD_SEQUENCE)
+        self.assertEqual(len(decoder.payload), len(steps))
+        self.assertEqual(decoder.decode(), codec.GET_STATE)
+        self.assertEqual(decoder.rejected, 1)
+
+    def testTypesWithoutLimit(self):
+        # e.g. a plugin's, held to maxPayload
+        decoder = codec.decoder(maxPayload=64, payloadLimits=codec.controllerPayloads)
+        decoder.feed(packets(integrity.NONE, (200, bytes(64), 2), (201, bytes(65), 4), (codec.GET_STATE, b'', 6)))
+        self.assertEqual(decoder.decode(), 200)
+        self.assertEqual(decoder.decode(), codec.GET_STATE)
+
+    def testPartialDropped(self):
+        # A corrupt header claiming the packets after it, dropped once they don't complete it in time
+        decoder = makeDecoder(integrity.NONE, fakeHeader(codec.UPLOAD_SEQUENCE, 1000) + packets(integrity.NONE, (codec.HEARTBEAT, b'\x00\x32', 2), (codec.E_STOP, b'', 4)))
+        self.assertEqual(decoder.decode(), -1)
+        self.assertTrue(decoder.waiting)
+        decoder.dropPartial()
+        self.assertEqual(decoder.decode(), codec.HEARTBEAT)
+        self.assertEqual(decoder.decode(), codec.E_STOP)
+        self.assertFalse(decoder.waiting)
+        self.assertEqual(decoder.rejected, 1)
+
+    def testNothingToDrop(self):
+        data = packets(integrity.NONE, (codec.GET_STATE, b'', 2))
+        decoder = makeDecoder(integrity.NONE, data[:5])
+        self.assertEqual(decoder.decode(), -1)
+        self.assertFalse(decoder.waiting)     # Not even a whole header yet
+        decoder.dropPartial()
+        decoder.feed(data[5:])
+        self.assertEqual(decoder.decode(), codec.GET_STATE)
+
+    def testFailedFrameCheckRejected(self):
+        for check in (integrity.CRC16, integrity.CRC32):
+            data = bytearray(packets(check, (codec.SET_THROTTLE, b'\x10', 2), (codec.GET_STATE, b'', 4)))
+            data[10] ^= 0xff    # The SET_THROTTLE's payload
+            decoder = makeDecoder(check, data)
+            self.assertEqual(decoder.decode(), codec.GET_STATE)
+            self.assertEqual(decoder.rejected, 1)
+
+
+class findTests(unittest.TestCase):
+    def testPacketsAheadCounted(self):
+        for check in (integrity.NONE, integrity.CRC16):
+            decoder = makeDecoder(check, packets(check, (codec.SET_THROTTLE, b'\x10', 2), (codec.GET_STATE, b'', 4), (codec.E_STOP, b'', 6)))
+            self.assertEqual(decoder.find(codec.E_STOP), 2)
+            self.assertEqual(decoder.decode(), codec.SET_THROTTLE)   # Nothing consumed
+            self.assertEqual(decoder.find(codec.E_STOP), 1)
+
+    def testNoneBuffered(self):
+        self.assertEqual(codec.decoder().find(codec.E_STOP), -1)
+        data = packets(integrity.NONE, (codec.GET_STATE, b'', 2), (codec.E_STOP, b'', 4))
+        self.assertEqual(makeDecoder(integrity.NONE, data[:-1]).find(codec.E_STOP), -1)
+
+    def testPayloadLookingLikeEStop(self):
+        # A sequence still arriving whose steps happen to hold 'RF-', E_STOP and a small size
+        for check in (integrity.NONE, integrity.CRC16, integrity.CRC32):
+            steps = b'\x00\x01' + fakeHeader(codec.E_STOP, 0) + bytes(40)
+            data = packets(check, (codec.GET_STATE, b'', 2), (codec.UPLOAD_SEQUENCE, steps, 4))
+            decoder = makeDecoder(check, data[:45])
+            self.assertEqual(decoder.find(codec.E_STOP), -1)
+
+    def testEStopBehindCorruptHeader(self):
+        # Only a frame check tells a real E_STOP inside a packet still arriving from payload bytes
+        fake = fakeHeader(codec.UPLOAD_SEQUENCE, 1000)
+        for check in (integrity.CRC16, integrity.CRC32):
+            decoder = makeDecoder(check, packets(check, (codec.SET_THROTTLE, b'\x10', 2)) + fake + packets(check, (codec.SET_THROTTLE, b'\x20', 4), (codec.E_STOP, b'', 6)))
+            self.assertEqual(decoder.find(codec.E_STOP), 3)
+        decoder = makeDecoder(integrity.NONE, packets(integrity.NONE, (codec.SET_THROTTLE, b'\x10', 2)) + fake + packets(integrity.NONE, (codec.E_STOP, b'', 6)))
+        self.assertEqual(decoder.find(codec.E_STOP), -1)
+
+    def testCorruptEStopSkipped(self):
+        for check in (integrity.CRC16, integrity.CRC32):
+            data = bytearray(packets(check, (codec.E_STOP, b'', 2)))
+            data[-1] ^= 0xff
+            self.assertEqual(makeDecoder(check, data).find(codec.E_STOP), -1)
+
+
+class stateTests(unittest.TestCase):
+    def testRoundTrip(self):
+        state = {'throttle': 50, 'direction': 1, 'lights': 3}
+        self.assertEqual(codec.decodeState(codec.encodeState(state)), state)
+
+    def testUnknownFieldsSkipped(self):
+        # A newer loco's field 7 is left out, the fields before it still decode
+        self.assertEqual(codec.decodeState(bytes([0x81, 40, 9])), {'throttle': 40})
+
+    def testShortPayload(self):
+        self.assertRaises(IndexError, codec.decodeState, b'')
+        self.assertRaises(IndexError, codec.decodeState, bytes([0x03, 40]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# Conformance of railfi.emulator with the loco firmware, run with python -m unittest discover tests
+import asyncio, contextlib, io, os, sys, unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from railfi import codec, emulator
+from railfi.controller import controller
+
+# Each command of the script with the response it gets, an emulated loco has to answer exactly as the firmware does
+script = [
+    (codec.SET_STATE, codec.encodeState({'throttle': 40, 'direction': 1, 'lights': 1})),
+    (codec.GET_STATE, b''),
+    (codec.SET_LIGHT, bytes([1, 1])),
+    (codec.GET_LIGHT, bytes([1])),
+    (codec.GET_THROTTLE, b''),
+    (codec.UPLOAD_SEQUENCE, bytes([3])),    # Too short, the handler fails
+    (codec.GET_SEQUENCES, b''),
+    (codec.E_STOP, (7).to_bytes(4, 'big')),
+    (codec.GET_STATE, b''),
+    (0x30, b''),                            # No such packet type
+]
+
+
+# Collects what the firmware sends
+class sink():
+    def __init__(self):
+        self.data = bytearray()
+
+    def sendall(self, data):
+        self.data += data
+
+
+def firmwareResponses():
+    # The script handed straight to a copy of the firmware's processPacket()
+    firmware = emulator.loadFirmware()
+    firmware.setReportThres(firmware.ERROR + 1)
+    firmware.controllerSocket = sink()
+    for conversation, (packetType, payload) in enumerate(script):
+        firmware.processPacket(packetType, conversation, payload)
+    decoder = codec.decoder()
+    decoder.feed(firmware.controllerSocket.data)
+    return [(packetType, bytes(payload)) for packetType, conversation, payload in decoder.packets()]
+
+def emulatorResponses():
+    # The script sent by the controller to an emulated loco
+    async def run():
+        railfi = controller(port=4100)
+        port = await railfi.start()
+        loco = emulator.emulatedLoco(emulator.makeConfig(0))
+        loco.firmware.setReportThres(loco.firmware.ERROR + 1)
+        await loco.connect('127.0.0.1', port)
+        locoTask = asyncio.get_running_loop().create_task(loco.run())
+        while not len(railfi.fleet): await asyncio.sleep(0.001)
+        session = next(iter(railfi.fleet))
+        responses = []
+        for packetType, payload in script:
+            packetType, response = await session.request(packetType, payload)
+            responses.append((packetType, bytes(response)))
+        await railfi.stop()
+        await locoTask
+        loco.close()
+        return responses, loco
+    with contextlib.redirect_stdout(io.StringIO()):
+        return asyncio.run(run())
+
+
+class conformanceTests(unittest.TestCase):
+    def testScript(self):
+        responses, loco = emulatorResponses()
+        self.assertEqual(responses, firmwareResponses())
+        self.assertEqual(codec.decodeState(responses[1][1]), {'throttle': 40, 'direction': 1, 'lights': 1, 'error': 0, 'speed': 40})
+        self.assertEqual(responses[5], (codec.ERROR, bytes([codec.HANDLER_FAILED])))
+        self.assertEqual(codec.decodeState(responses[8][1])['throttle'], 0)
+        self.assertEqual(responses[9], (codec.ERROR, bytes([codec.UNKNOWN_PACKET_TYPE])))
+        self.assertIsNotNone(loco.stopTime)
+
+
+if __name__ == '__main__':
+    unittest.main()
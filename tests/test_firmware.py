@@ -0,0 +1,63 @@
+# Unit tests of the loco firmware (locomotive/main.py in emulator mode), run with python -m unittest discover tests
+import os, sys, unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from railfi import codec, emulator
+
+
+# Collects what the firmware sends
+class sink():
+    def __init__(self):
+        self.data = bytearray()
+
+    def sendall(self, data):
+        self.data += data
+
+
+def loadFirmware():
+    # A firmware copy that sends to a sink and counts its emergency stops in stops[0]
+    firmware = emulator.loadFirmware()
+    firmware.setReportThres(firmware.ERROR + 1)
+    firmware.controllerSocket = sink()
+    firmware.stops = [0]
+    emergencyStop = firmware.emergencyStop
+    def countedStop():
+        firmware.stops[0] += 1
+        emergencyStop()
+    firmware.emergencyStop = countedStop
+    return firmware
+
+def receive(firmware, packets):
+    # Buffers the packets (packetType, conversation, payload) as if they arrived together, returns the responses
+    encoder = codec.encoder()
+    for packetType, conversation, payload in packets: firmware.packetDecoder.feed(encoder.encode(packetType, payload, conversation))
+    firmware.controllerSocket.data = bytearray()
+    firmware.handleBuffered(firmware.controllerSocket, 0)
+    decoder = codec.decoder()
+    decoder.feed(firmware.controllerSocket.data)
+    return [(packetType, conversation, bytes(payload)) for packetType, conversation, payload in decoder.packets()]
+
+
+class eStopTests(unittest.TestCase):
+    def testStopsOnce(self):
+        # Nothing ahead of the E_STOP, it is handled straight away and stops the motor once
+        firmware = loadFirmware()
+        firmware.setThrottle(50)
+        responses = receive(firmware, [(codec.E_STOP, 1, b'')])
+        self.assertEqual(responses, [(codec.ACKNOWLEDGE, 1, b'')])
+        self.assertEqual(firmware.stops[0], 1)
+        self.assertEqual(firmware.getThrottle(), 0)
+
+    def testJumpsTheQueue(self):
+        # The motor stops before the packets ahead are handled, and the throttle they set is refused
+        firmware = loadFirmware()
+        firmware.setThrottle(50)
+        responses = receive(firmware, [(codec.GET_THROTTLE, 1, b''), (codec.SET_THROTTLE, 2, bytes([60])), (codec.E_STOP, 3, b'')])
+        self.assertEqual(responses[1:], [(codec.ERROR, 2, bytes([codec.PREEMPTED])), (codec.ACKNOWLEDGE, 3, b'')])
+        self.assertEqual(responses[0][:2], (codec.ACKNOWLEDGE, 1))
+        self.assertEqual(responses[0][2][0], 0)
+        self.assertEqual(firmware.getThrottle(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
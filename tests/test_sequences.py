@@ -0,0 +1,90 @@
+# Unit tests of railfi.sequences, run with python -m unittest discover tests
+import os, sys, unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from railfi import sequences
+
+
+# Keeps the timers instead of running them, a test calls the sequencer's _due() when it wants a step taken
+class timerStub():
+    def __init__(self):
+        self.active = False
+
+class eventLoopStub():
+    def callLater(self, delay, callback):
+        timer = timerStub()
+        timer.active = True
+        return timer
+
+    def rescheduleMs(self, timer, delayMs):
+        timer.active = True
+        return timer
+
+    def cancel(self, timer):
+        timer.active = False
+
+
+def makeSequencer():
+    # Returns the sequencer, the steps it applied and the sequences it finished
+    applied = []
+    finished = []
+    sequencer = sequences.sequencer(eventLoopStub(), lambda action, a, b: applied.append((action, a, b)), finished.append)
+    return sequencer, applied, finished
+
+# Three steps a minute apart, so only the first is due when the sequence starts
+slowSteps = sequences.encodeSteps([(0, 'THROTTLE', 40), (60000, 'LIGHT', 0, 1), (60000, 'THROTTLE', 0)])
+
+
+class sequencerTests(unittest.TestCase):
+    def testStatus(self):
+        sequencer, applied, finished = makeSequencer()
+        sequencer.store(3, slowSteps)
+        sequencer.store(7, slowSteps[:5], True)
+        sequencer.start(3, 2)
+        sequencer._due()
+        self.assertEqual(applied, [(sequences.THROTTLE, 40, 0)])
+        self.assertEqual(sequences.decodeStatus(sequencer.status()), {
+            'running': 3,
+            'step': 1,
+            'repeats': 1,
+            'stored': {3: {'steps': 3, 'saved': False}, 7: {'steps': 1, 'saved': True}}
+        })
+
+    def testStop(self):
+        # A stopped sequence leaves nothing behind in the status
+        sequencer, applied, finished = makeSequencer()
+        sequencer.store(3, slowSteps)
+        sequencer.start(3, sequences.forever)
+        sequencer._due()
+        sequencer.stop()
+        self.assertEqual(finished, [3])
+        self.assertFalse(sequencer.timer.active)
+        status = sequences.decodeStatus(sequencer.status())
+        self.assertEqual((status['running'], status['step'], status['repeats']), (None, 0, 0))
+        sequencer.stop()
+        self.assertEqual(finished, [3])
+
+    def testFinish(self):
+        sequencer, applied, finished = makeSequencer()
+        sequencer.store(0, sequences.encodeSteps([(0, 'THROTTLE', 40), (0, 'DIRECTION', 1)]))
+        sequencer.start(0)
+        sequencer._due()
+        self.assertEqual(applied, [(sequences.THROTTLE, 40, 0), (sequences.DIRECTION, 1, 0)])
+        self.assertEqual(finished, [0])
+        self.assertEqual(sequences.decodeStatus(sequencer.status())['step'], 0)
+
+    def testMalformed(self):
+        sequencer, applied, finished = makeSequencer()
+        self.assertRaises(ValueError, sequencer.store, 0, slowSteps[:7])
+        self.assertRaises(ValueError, sequencer.store, 0, bytes([0, 0, len(sequences.actions), 0, 0]))
+        self.assertRaises(ValueError, sequencer.store, sequences.maxSequences, slowSteps)
+        self.assertRaises(KeyError, sequencer.start, 1)
+        self.assertEqual(sequencer.stored, {})
+
+    def testSteps(self):
+        steps = [(0, 'THROTTLE', -40, 0), (1500, 'LIGHT', 1, 1)]
+        self.assertEqual(sequences.decodeSteps(sequences.encodeSteps(steps)), steps)
+
+
+if __name__ == '__main__':
+    unittest.main()
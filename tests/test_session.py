@@ -0,0 +1,67 @@
+# Unit tests of railfi.controller.session, run with python -m unittest discover tests
+import asyncio, io, os, sys, unittest
+from concurrent.futures import Future
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from railfi import capture, codec
+from railfi.controller.session import locomotive
+
+
+def respond(callback, packetType, payload):
+    # Runs a session's response callback with the response (packetType, payload), returns the Future it resolves
+    async def run():
+        loco = locomotive('RF 0000', None, None)
+        response = Future()
+        response.set_result((packetType, payload))
+        future = Future()
+        getattr(loco, callback)(response, future)
+        return loco, future
+    return asyncio.run(run())
+
+
+class responseTests(unittest.TestCase):
+    def testState(self):
+        loco, future = respond('_stateReceived', codec.ACKNOWLEDGE, codec.encodeState({'throttle': 40, 'lights': 1}))
+        self.assertEqual(future.result(0), {'throttle': 40, 'lights': 1})
+        self.assertEqual(loco.state, {'throttle': 40, 'lights': 1})
+
+    def testShortState(self):
+        # The field mask promises two fields, one arrived. The Future fails rather than never resolving.
+        loco, future = respond('_stateReceived', codec.ACKNOWLEDGE, bytes([0x03, 40]))
+        self.assertIsInstance(future.exception(0), IndexError)
+        loco, future = respond('_stateReceived', codec.ACKNOWLEDGE, b'')
+        self.assertIsInstance(future.exception(0), IndexError)
+        self.assertEqual(loco.state, {})
+
+    def testRefused(self):
+        loco, future = respond('_stateReceived', codec.ERROR, bytes([codec.HANDLER_FAILED]))
+        self.assertIsInstance(future.exception(0), RuntimeError)
+
+    def testShortStats(self):
+        loco, future = respond('_statsReceived', codec.ACKNOWLEDGE, b'\x01')
+        self.assertIsNotNone(future.exception(0))
+
+    def testShortTrace(self):
+        loco, future = respond('_traceReceived', codec.ACKNOWLEDGE, b'\x01')
+        self.assertIsNotNone(future.exception(0))
+
+
+class resumeTests(unittest.TestCase):
+    def testCaptureStream(self):
+        # The resumed session is captured to the new connection's stream from then on
+        async def run():
+            recorder = capture.recorder(io.BytesIO(), 'controller')
+            session = locomotive('RF 0000', None, None)
+            session.startCapture(recorder)
+            loco = locomotive('127.0.0.1:50000', None, None)
+            loco.startCapture(recorder)
+            session.resume(loco)
+            return session, loco
+        session, loco = asyncio.run(run())
+        self.assertEqual(loco.captureStream, 1)
+        self.assertEqual(session.captureStream, 1)
+        self.assertIs(session.decoder, loco.decoder)
+
+
+if __name__ == '__main__':
+    unittest.main()